@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""A minimal DNS client on asyncio: one A (or AAAA) query over UDP to the system's resolver, for
+checking whether a network is hijacking DNS answers. It doesn't retry, follow referrals, or fall
+back to TCP. It only asks the configured recursive resolver and reads the addresses it answers."""
+import errno
+import random
+import ipaddress
+import socket
+import struct
+import asyncio
+import logging
+
+RESOLV_CONF = '/etc/resolv.conf'
+DNS_PORT = 53
+# The largest response we'll read. Bigger ones are truncated by the server anyway.
+MAX_RESPONSE = 4096
+TYPE_A = 1
+TYPE_AAAA = 28
+CLASS_IN = 1
+# Header flags.
+FLAG_RESPONSE = 0x8000
+FLAG_TRUNCATED = 0x0200
+FLAG_RECURSION_DESIRED = 0x0100
+RCODE_MASK = 0xf
+RCODE_NAMES = {0:'NOERROR', 1:'FORMERR', 2:'SERVFAIL', 3:'NXDOMAIN', 4:'NOTIMP', 5:'REFUSED'}
+HEADER = struct.Struct('!HHHHHH')
+QUESTION_TAIL = struct.Struct('!HH')
+RECORD_TAIL = struct.Struct('!HHIH')
+
+
+class DNSError(Exception):
+  """Raised when a response can't be understood."""
+  pass
+
+
+def read_nameservers(path=RESOLV_CONF):
+  """Get the addresses of the nameservers in resolv.conf, in order. Returns an empty list if there
+  are none, or it can't be read."""
+  nameservers = []
+  try:
+    with open(path) as resolv_conf:
+      for line in resolv_conf:
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] == 'nameserver':
+          # Drop any IPv6 zone index, like "fe80::1%wlan0".
+          nameservers.append(fields[1].split('%', 1)[0])
+  except OSError as error:
+    logging.debug('Could not read {}: {}'.format(path, error))
+  return nameservers
+
+
+async def resolve(host, nameserver=None, timeout=1, record_type=TYPE_A, bind=None):
+  """Ask the "nameserver" (default: the first in resolv.conf) for the addresses of "host".
+  Returns a tuple of the response code name (like "NOERROR" or "NXDOMAIN") and a sorted list of the
+  addresses answered. "bind" is a function to call on the socket before sending, like
+  asynchttp.ConnectionPool.bind_to_interface(). It isn't called for a loopback nameserver (a local
+  resolver like systemd-resolved's 127.0.0.53), which a socket bound to another interface can't
+  reach. Raises an OSError if there's no answer within the
+  "timeout", or a DNSError if the answer is garbled."""
+  if nameserver is None:
+    nameservers = read_nameservers()
+    if not nameservers:
+      raise OSError(errno.ENOENT, 'No nameservers in '+RESOLV_CONF)
+    nameserver = nameservers[0]
+  family = socket.AF_INET6 if ':' in nameserver else socket.AF_INET
+  query_id = random.randrange(0x10000)
+  query = build_query(query_id, host, record_type)
+  loop = asyncio.get_running_loop()
+  sock = socket.socket(family, socket.SOCK_DGRAM)
+  try:
+    sock.setblocking(False)
+    if bind and not ipaddress.ip_address(nameserver).is_loopback:
+      bind(sock)
+    await loop.sock_connect(sock, (nameserver, DNS_PORT))
+    await loop.sock_sendall(sock, query)
+    deadline = loop.time() + timeout
+    while True:
+      remaining = deadline - loop.time()
+      try:
+        data = await asyncio.wait_for(loop.sock_recv(sock, MAX_RESPONSE), max(0, remaining))
+      except asyncio.TimeoutError:
+        raise socket.timeout('No DNS answer from {} in {}s'.format(nameserver, timeout))
+      try:
+        return parse_response(data, query_id, record_type)
+      except DNSError as error:
+        # Could be a late answer to an earlier query on the same port. Keep waiting.
+        logging.debug('Ignoring DNS response: {}'.format(error))
+  finally:
+    sock.close()
+
+
+def build_query(query_id, host, record_type=TYPE_A):
+  header = HEADER.pack(query_id, FLAG_RECURSION_DESIRED, 1, 0, 0, 0)
+  return header + encode_name(host) + QUESTION_TAIL.pack(record_type, CLASS_IN)
+
+
+def encode_name(host):
+  labels = host.rstrip('.').encode('idna').split(b'.')
+  if any(not label or len(label) > 63 for label in labels):
+    raise ValueError('Invalid host name: '+host)
+  return b''.join(struct.pack('!B', len(label))+label for label in labels) + b'\0'
+
+
+def parse_response(data, query_id, record_type=TYPE_A):
+  """Parse a response to a query made with build_query(). Returns the same as resolve()."""
+  if len(data) < HEADER.size:
+    raise DNSError('Response too short.')
+  response_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+  if response_id != query_id or not flags & FLAG_RESPONSE:
+    raise DNSError('Response doesn\'t match the query.')
+  rcode = RCODE_NAMES.get(flags & RCODE_MASK, str(flags & RCODE_MASK))
+  offset = HEADER.size
+  for i in range(qdcount):
+    offset = skip_name(data, offset) + QUESTION_TAIL.size
+  addresses = []
+  for i in range(ancount):
+    offset = skip_name(data, offset)
+    if offset + RECORD_TAIL.size > len(data):
+      if flags & FLAG_TRUNCATED:
+        break
+      raise DNSError('Answer record cut off.')
+    rtype, rclass, ttl, length = RECORD_TAIL.unpack_from(data, offset)
+    offset += RECORD_TAIL.size
+    rdata = data[offset:offset+length]
+    offset += length
+    if rclass != CLASS_IN or rtype != record_type:
+      # Like the CNAMEs in front of the addresses.
+      continue
+    if rtype == TYPE_A and len(rdata) == 4:
+      addresses.append(socket.inet_ntop(socket.AF_INET, rdata))
+    elif rtype == TYPE_AAAA and len(rdata) == 16:
+      addresses.append(socket.inet_ntop(socket.AF_INET6, rdata))
+  return rcode, sorted(set(addresses))
+
+
+def skip_name(data, offset):
+  """Get the offset just past the (possibly compressed) domain name at "offset"."""
+  while True:
+    if offset >= len(data):
+      raise DNSError('Name runs past the end of the response.')
+    length = data[offset]
+    if length & 0xc0 == 0xc0:
+      # A pointer to a name elsewhere. It ends this one.
+      return offset + 2
+    offset += 1 + length
+    if length == 0:
+      return offset
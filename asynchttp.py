@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""A small HTTP/1.1 client on asyncio, for the requests wifi-login2.py makes: connection tests,
+login requests, and the redirects between them. Connections are kept alive in a ConnectionPool for
+reuse. Every request has a real timeout, covering everything from looking up the host to reading
+the last byte of the response, and can be cancelled at any point, which closes its connection."""
+import ssl
+import errno
+import socket
+import asyncio
+import logging
+import urllib.parse
+import netinfo
+
+DEFAULT_PORTS = {'http':80, 'https':443}
+# Socket errors which mean we couldn't reach the server at all.
+CONNECT_ERRNOS = (errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ECONNREFUSED, errno.ENETDOWN,
+                  errno.EADDRNOTAVAIL, errno.ETIMEDOUT)
+# The longest response body we'll read just to keep a connection open for reuse.
+MAX_DRAIN = 65536
+# Limits on response headers, so a broken server can't make us read forever.
+MAX_LINE = 65536
+MAX_HEADERS = 200
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# From <asm-generic/socket.h>, for Pythons whose socket module doesn't define it.
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+# Request and response bodies and headers are bytes on the wire, but strings everywhere else.
+# This encoding round-trips any bytes.
+ENCODING = 'utf-8'
+ERRORS = 'surrogateescape'
+
+
+class HTTPError(Exception):
+  """Raised when a response can't be understood, or the connection closes in the middle of it."""
+  pass
+
+
+class ConnectError(OSError):
+  """Raised when an HTTP connection can't be made at all."""
+  pass
+
+
+# The exceptions a request can fail with.
+NETWORK_ERRORS = (OSError, HTTPError)
+
+
+def encode(string):
+  return string.encode(ENCODING, ERRORS)
+
+
+def decode(data):
+  return data.decode(ENCODING, ERRORS)
+
+
+def split_url(url):
+  """Split a URL into the scheme, host, port, and path (including any query string) needed by
+  request()."""
+  parts = urllib.parse.urlsplit(url)
+  path = parts.path or '/'
+  if parts.query:
+    path += '?'+parts.query
+  if parts.scheme not in DEFAULT_PORTS:
+    raise ValueError('URL scheme unrecognized: '+parts.scheme)
+  return parts.scheme, parts.hostname, parts.port or DEFAULT_PORTS[parts.scheme], path
+
+
+def get_redirect(response, method, scheme, host, port, path):
+  """If the response is a redirect, work out the request it redirects to, the way browsers do.
+  Returns a tuple of (method, scheme, host, port, path), or None if it's not a redirect.
+  A POST redirected with a 301, 302, or 303 becomes a GET (without the body)."""
+  location = response.getheader('Location')
+  if response.status not in REDIRECT_STATUSES or not location:
+    return None
+  base = '{}://{}:{}{}'.format(scheme, host, port, path)
+  new_scheme, new_host, new_port, new_path = split_url(urllib.parse.urljoin(base, location))
+  if response.status in (301, 302, 303) and method != 'HEAD':
+    method = 'GET'
+  return method, new_scheme, new_host, new_port, new_path
+
+
+async def request(pool, method, scheme, host, port, path, body=None, headers=None, timeout=None):
+  """Make an HTTP request on a connection from the pool. Returns the connection and the response.
+  Once done reading the response, give both back with pool.release().
+  "headers" is a dict of header names and values (strings). The Host and Content-Length headers
+  are filled in automatically. "body" is a string, or None for no body.
+  "timeout" is in seconds, and covers the whole exchange, including reading the response body.
+  Failing to connect in time raises a ConnectError, and timing out after that raises a
+  socket.timeout.
+  If a reused connection turns out to have been closed by the server, the request is retried once
+  on a new connection."""
+  loop = asyncio.get_running_loop()
+  deadline = None if timeout is None else loop.time() + timeout
+  data = format_request(method, host, port, path, body, headers)
+  while True:
+    connection, reused = await with_deadline(pool.get(scheme, host, port), deadline,
+                                             connecting=True)
+    try:
+      response = await with_deadline(connection.send(data, method), deadline)
+      response.deadline = deadline
+      return connection, response
+    except asyncio.CancelledError:
+      connection.close()
+      raise
+    except NETWORK_ERRORS as error:
+      connection.close()
+      if not reused or isinstance(error, socket.timeout):
+        raise
+      logging.debug('Reused connection to {}:{} failed ({}). Reconnecting..'
+                    .format(host, port, type(error).__name__))
+
+
+async def with_deadline(awaitable, deadline, connecting=False):
+  """Await something, giving up at the deadline (a loop.time() value, or None for no deadline)."""
+  if deadline is None:
+    return await awaitable
+  remaining = max(0, deadline - asyncio.get_running_loop().time())
+  try:
+    return await asyncio.wait_for(awaitable, remaining)
+  except asyncio.TimeoutError:
+    if connecting:
+      raise ConnectError(errno.ETIMEDOUT, 'Timed out connecting')
+    raise socket.timeout('timed out')
+
+
+def format_request(method, host, port, path, body, headers):
+  if port == DEFAULT_PORTS['http'] or port == DEFAULT_PORTS['https']:
+    host_header = host
+  else:
+    host_header = '{}:{}'.format(host, port)
+  lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: '+host_header]
+  for name, value in (headers or {}).items():
+    if name.lower() not in ('host', 'content-length'):
+      lines.append('{}: {}'.format(name, value))
+  if body is not None:
+    body = encode(body)
+    lines.append('Content-Length: {}'.format(len(body)))
+  data = encode('\r\n'.join(lines)+'\r\n\r\n')
+  if body:
+    data += body
+  return data
+
+
+class Connection(object):
+  """One HTTP connection, over asyncio streams."""
+
+  def __init__(self, key, reader, writer):
+    self.key = key
+    self.reader = reader
+    self.writer = writer
+
+  async def send(self, data, method):
+    """Send a formatted request and read the response headers. Returns a Response."""
+    self.writer.write(data)
+    await self.writer.drain()
+    while True:
+      response = Response(self.reader, method)
+      await response.read_head()
+      # Skip any "100 Continue"s.
+      if not 100 <= response.status < 200:
+        return response
+
+  def close(self):
+    self.writer.close()
+
+
+class Response(object):
+  """An HTTP response. "headers" is a list of (name, value) tuples, in the order received."""
+
+  def __init__(self, reader, method):
+    self._reader = reader
+    self._method = method
+    self.status = None
+    self.reason = None
+    self.version = None
+    self.headers = []
+    # The number of body bytes left to read, or None if it's unknown (chunked, or until close).
+    self.length = None
+    self.chunked = False
+    self._chunk_left = 0
+    self.will_close = False
+    self.done = False
+    self.deadline = None
+
+  async def read_head(self):
+    status_line = await self._read_line()
+    if not status_line:
+      raise HTTPError('Connection closed before the response.')
+    fields = status_line.split(None, 2)
+    if len(fields) < 2 or not fields[0].startswith('HTTP/') or not fields[1].isdigit():
+      raise HTTPError('Invalid status line: {!r}'.format(status_line))
+    self.version = fields[0]
+    self.status = int(fields[1])
+    self.reason = fields[2] if len(fields) > 2 else ''
+    while True:
+      line = await self._read_line()
+      if not line:
+        break
+      if len(self.headers) >= MAX_HEADERS:
+        raise HTTPError('Too many headers in response.')
+      name, colon, value = line.partition(':')
+      if not colon:
+        raise HTTPError('Invalid header line: {!r}'.format(line))
+      self.headers.append((name.strip(), value.strip()))
+    connection_header = (self.getheader('Connection') or '').lower()
+    if self.version == 'HTTP/1.0':
+      self.will_close = 'keep-alive' not in connection_header
+    else:
+      self.will_close = 'close' in connection_header
+    if (self._method == 'HEAD' or self.status in (204, 304) or 100 <= self.status < 200):
+      self.length = 0
+    elif 'chunked' in (self.getheader('Transfer-Encoding') or '').lower():
+      self.chunked = True
+    elif self.getheader('Content-Length') is not None:
+      try:
+        self.length = int(self.getheader('Content-Length'))
+      except ValueError:
+        raise HTTPError('Invalid Content-Length: '+self.getheader('Content-Length'))
+    else:
+      # The body goes until the server closes the connection.
+      self.will_close = True
+    self.done = self.length == 0
+
+  async def _read_line(self):
+    try:
+      line = await self._reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as error:
+      line = error.partial
+    except asyncio.LimitOverrunError:
+      raise HTTPError('Response line too long.')
+    if len(line) > MAX_LINE:
+      raise HTTPError('Response line too long.')
+    return decode(line).rstrip('\r\n')
+
+  def getheader(self, name, default=None):
+    """Get the value of a header, or "default" if there isn't one. If there are several, their
+    values are joined with commas."""
+    values = self.get_all(name)
+    return ', '.join(values) if values else default
+
+  def get_all(self, name):
+    """Get a list of the values of every header with this name."""
+    name = name.lower()
+    return [value for header_name, value in self.headers if header_name.lower() == name]
+
+  async def read(self, size=-1):
+    """Read up to "size" bytes of the body (all of it, if "size" is negative). Returns b'' at the
+    end of the body."""
+    if self.done or size == 0:
+      return b''
+    if self.deadline is None:
+      return await self._read(size)
+    return await with_deadline(self._read(size), self.deadline)
+
+  async def _read(self, size):
+    if self.chunked:
+      return await self._read_chunked(size)
+    if self.length is None:
+      data = await self._reader.read(size)
+      if not data:
+        self.done = True
+      return data
+    if size < 0 or size > self.length:
+      size = self.length
+    data = await self._reader.read(size)
+    if not data:
+      raise HTTPError('Connection closed with {} bytes of the body left.'.format(self.length))
+    self.length -= len(data)
+    self.done = self.length == 0
+    return data
+
+  async def _read_chunked(self, size):
+    data = b''
+    while size < 0 or len(data) < size:
+      if self._chunk_left == 0:
+        size_line = await self._read_line()
+        try:
+          self._chunk_left = int(size_line.split(';', 1)[0], 16)
+        except ValueError:
+          raise HTTPError('Invalid chunk size: {!r}'.format(size_line))
+        if self._chunk_left == 0:
+          # Skip the trailers.
+          while await self._read_line():
+            pass
+          self.done = True
+          return data
+      wanted = self._chunk_left if size < 0 else min(self._chunk_left, size-len(data))
+      try:
+        chunk = await self._reader.readexactly(wanted)
+      except asyncio.IncompleteReadError:
+        raise HTTPError('Connection closed in the middle of a chunk.')
+      data += chunk
+      self._chunk_left -= len(chunk)
+      if self._chunk_left == 0:
+        await self._read_line()
+    return data
+
+
+class ConnectionPool(object):
+  """Keep-alive HTTP connections, kept for reuse for the rest of the run. Connections are keyed by
+  (scheme, host, port), and a connection is only handed out to one user at a time.
+  DNS lookups are cached for the life of the pool, too.
+  If an "interface" is given, connections are bound to it, so they go out through it regardless of
+  the routing table. That takes the CAP_NET_RAW capability. Without it, connections are bound to the
+  interface's IP address instead, which works when the routing table has a route for it."""
+
+  def __init__(self, interface=None):
+    self.interface = interface
+    self._source_address = None
+    self._idle = {}
+    self._addresses = {}
+    self._ssl_context = None
+
+  async def get(self, scheme, host, port):
+    """Get a connection. Returns the connection and whether it was reused."""
+    key = (scheme, host, port)
+    idle = self._idle.get(key)
+    while idle:
+      connection = idle.pop()
+      if connection.reader.at_eof():
+        connection.close()
+        continue
+      logging.debug('Reusing connection to {}:{}.'.format(host, port))
+      return connection, True
+    if scheme not in DEFAULT_PORTS:
+      raise ValueError('URL scheme unrecognized: '+scheme)
+    sock = await self.create_connection(host, port)
+    ssl_context = None
+    if scheme == 'https':
+      if self._ssl_context is None:
+        self._ssl_context = ssl.create_default_context()
+      ssl_context = self._ssl_context
+    try:
+      reader, writer = await asyncio.open_connection(sock=sock, ssl=ssl_context,
+                                                     server_hostname=host if ssl_context else None,
+                                                     limit=MAX_LINE)
+    except BaseException:
+      sock.close()
+      raise
+    return Connection(key, reader, writer), False
+
+  async def release(self, connection, response):
+    """Return a connection to the pool, after making sure the response has been read.
+    If the connection can't be reused, it's closed instead."""
+    if response.will_close or not (response.done or response.chunked or
+                                   (response.length is not None and response.length <= MAX_DRAIN)):
+      connection.close()
+      return
+    try:
+      drained = 0
+      while not response.done:
+        chunk = await response.read(MAX_DRAIN)
+        drained += len(chunk)
+        if drained > MAX_DRAIN:
+          connection.close()
+          return
+    except NETWORK_ERRORS:
+      connection.close()
+      return
+    except asyncio.CancelledError:
+      connection.close()
+      raise
+    self._idle.setdefault(connection.key, []).append(connection)
+
+  def close(self):
+    for connections in self._idle.values():
+      for connection in connections:
+        connection.close()
+    self._idle.clear()
+
+  async def resolve(self, host, port):
+    """Look up the addresses for a host, remembering the result."""
+    addresses = self._addresses.get((host, port))
+    if addresses is None:
+      loop = asyncio.get_running_loop()
+      start = loop.time()
+      try:
+        addresses = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+      except socket.gaierror as error:
+        raise ConnectError(error.errno, 'Could not resolve {}: {}'.format(host, error.strerror))
+      logging.debug('Resolved {} in {:0.3f}s.'.format(host, loop.time()-start))
+      self._addresses[(host, port)] = addresses
+    return addresses
+
+  async def create_connection(self, host, port):
+    """Connect a socket to the host, using the DNS cache, and bound to the interface if there is
+    one."""
+    loop = asyncio.get_running_loop()
+    error = None
+    for family, socktype, proto, canonname, sockaddr in await self.resolve(host, port):
+      sock = socket.socket(family, socktype, proto)
+      try:
+        sock.setblocking(False)
+        if self.interface:
+          self.bind_to_interface(sock)
+        await loop.sock_connect(sock, sockaddr)
+        return sock
+      except OSError as connect_error:
+        error = connect_error
+        sock.close()
+      except BaseException:
+        sock.close()
+        raise
+    if error.errno in CONNECT_ERRNOS:
+      raise ConnectError(error.errno, error.strerror or str(error))
+    raise error
+
+  def bind_to_interface(self, sock):
+    if self._source_address is None:
+      try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.interface.encode('ascii'))
+        return
+      except PermissionError:
+        pass
+      ip = netinfo.get_ip(self.interface)
+      if not ip:
+        raise ConnectError(errno.EADDRNOTAVAIL, 'No IP address on {}'.format(self.interface))
+      logging.debug('Not permitted to bind to {}. Binding to its address {} instead.'
+                    .format(self.interface, ip))
+      self._source_address = (ip, 0)
+    sock.bind(self._source_address)
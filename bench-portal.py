@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import shlex
+import random
+import socket
+import shutil
+import struct
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+import http.server
+import importlib.util
+import importlib.machinery
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+WIFI_SCRIPT = os.path.join(SCRIPT_DIR, 'wifi-login2.py')
+FAST_SCRIPT = os.path.join(SCRIPT_DIR, 'wifi-login-fast.py')
+PHASES = ('startup', 'lookup', 'parse', 'probe', 'login', 'total')
+PERCENTILES = (50, 95, 99)
+
+ARG_DEFAULTS = {'request_dir':os.path.join(SCRIPT_DIR, 'http-login'),
+                'redirect_dir':os.path.join(SCRIPT_DIR, 'http-redirect'), 'runs':50, 'latency':0,
+                'jitter':0, 'drop':0, 'reset':0, 'script_args':'', 'log_level':logging.WARNING,
+                'zipapp':os.path.join(SCRIPT_DIR, 'wifi-login.pyz')}
+DESCRIPTION = """Benchmark how long wifi-login2.py takes to log in, against a fake captive portal on
+the loopback interface. The portal intercepts requests with the recorded responses in the
+--redirect-dir until it receives a login request, then lets them through. Each login is timed end
+to end (by running wifi-login2.py), and phase by phase (by calling its functions directly). The
+fake portal can add latency, drop connections, and reset them, to see how those affect things.
+With --startup, compare how long wifi-login2.py, wifi-login-fast.py, and the zipapp bundle take to
+start up and decide what to do on the current network, instead."""
+
+
+def main(argv):
+
+  parser = argparse.ArgumentParser(description=DESCRIPTION)
+  parser.set_defaults(**ARG_DEFAULTS)
+
+  parser.add_argument('portals', metavar='portal', nargs='*',
+    help='The names of the portals to benchmark. Each needs a [name].txt in both the '
+         '--request-dir and --redirect-dir. Default: all such portals.')
+  parser.add_argument('-d', '--request-dir',
+    help='The directory of login request records. Default: %(default)s.')
+  parser.add_argument('-i', '--redirect-dir',
+    help='The directory of interception response records. Default: %(default)s.')
+  parser.add_argument('-n', '--runs', type=int,
+    help='How many logins to time for each portal. Default: %(default)s.')
+  parser.add_argument('-l', '--latency', type=float,
+    help='Seconds the fake portal waits before each response. Default: %(default)s.')
+  parser.add_argument('-j', '--jitter', type=float,
+    help='A random amount up to this many seconds is added to the --latency. '
+         'Default: %(default)s.')
+  parser.add_argument('-p', '--drop', type=float,
+    help='The probability the portal closes a connection instead of responding. '
+         'Default: %(default)s.')
+  parser.add_argument('-r', '--reset', type=float,
+    help='The probability the portal resets a connection (sends a TCP RST) instead of '
+         'responding. Default: %(default)s.')
+  parser.add_argument('-a', '--script-args',
+    help='Extra arguments to give wifi-login2.py in the end to end runs, as one string. Use this '
+         'to compare detection strategies, e.g. --script-args "--multi-probe".')
+  parser.add_argument('-s', '--startup', action='store_true',
+    help='Time starting wifi-login2.py, wifi-login-fast.py, and the --zipapp (if it exists) on the '
+         'current network, with the --script-args, and just the interpreter starting up, for '
+         'comparison. E.g. on an unrecognized network, use --script-args "--no-identify".')
+  parser.add_argument('-z', '--zipapp',
+    help='The zipapp bundle to time in --startup mode (see build-zipapp.py). Default: '
+         '%(default)s.')
+  parser.add_argument('-D', '--debug', dest='log_level', action='store_const', const=logging.DEBUG,
+    help='Print debug messages, including the fake portal\'s request log.')
+
+  args = parser.parse_args(argv[1:])
+
+  logging.basicConfig(stream=sys.stderr, level=args.log_level, format='%(levelname)s: %(message)s')
+
+  if args.startup:
+    return compare_startup(args.runs, shlex.split(args.script_args), args.zipapp)
+
+  portals = args.portals or find_portals(args.request_dir, args.redirect_dir)
+  if not portals:
+    fail('No portals found with records in both {} and {}.'
+         .format(args.request_dir, args.redirect_dir))
+
+  faults = {'latency':args.latency, 'jitter':args.jitter, 'drop':args.drop, 'reset':args.reset}
+  server = FakePortalServer(('127.0.0.1', 0), FakePortalHandler, faults)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  host = '{}:{}'.format(*server.server_address)
+  test_url = 'http://{}/generate_204'.format(host)
+
+  # Time the interpreter startup and the import of wifi-login2.py.
+  startup_times = time_startup(args.runs)
+  wifi_login = load_wifi_login()
+
+  temp_dir = tempfile.mkdtemp()
+  try:
+    for portal in portals:
+      request_path = copy_request(os.path.join(args.request_dir, portal+'.txt'), temp_dir, host)
+      server.load_interception(os.path.join(args.redirect_dir, portal+'.txt'))
+      times = {'startup':startup_times}
+      failures = 0
+      for run in range(args.runs):
+        server.logged_in = False
+        run_times = asyncio.run(time_phases(wifi_login, request_path, test_url))
+        if run_times is None:
+          failures += 1
+          continue
+        server.logged_in = False
+        start = time.time()
+        command = [sys.executable, WIFI_SCRIPT, request_path, '--test-url', test_url, '--no-cache',
+                   '--portal-stats', os.path.join(temp_dir, 'portals.json'),
+                   '--quiet'] + shlex.split(args.script_args)
+        returncode = subprocess.call(command)
+        run_times['total'] = time.time() - start
+        if returncode or not server.logged_in:
+          failures += 1
+          continue
+        for phase, elapsed in run_times.items():
+          times.setdefault(phase, []).append(elapsed)
+      print_report(portal, times, args.runs, failures)
+  finally:
+    shutil.rmtree(temp_dir)
+    server.shutdown()
+
+
+def find_portals(request_dir, redirect_dir):
+  """Find the portals with both a login request record and an interception response record."""
+  portals = []
+  for filename in sorted(os.listdir(request_dir)):
+    if filename.endswith('.txt') and os.path.isfile(os.path.join(redirect_dir, filename)):
+      portals.append(filename[:-4])
+  return portals
+
+
+def copy_request(request_path, dest_dir, host):
+  """Copy a request record into dest_dir, pointing its Host header at the fake portal."""
+  dest_path = os.path.join(dest_dir, os.path.basename(request_path))
+  with open(request_path, 'rb') as request_file:
+    lines = request_file.readlines()
+  with open(dest_path, 'wb') as dest_file:
+    for line in lines:
+      if line.lower().startswith(b'host:'):
+        line = 'Host: {}\r\n'.format(host).encode('ascii')
+      dest_file.write(line)
+  return dest_path
+
+
+def load_wifi_login():
+  """Import wifi-login2.py as the module "wifi_login2"."""
+  loader = importlib.machinery.SourceFileLoader('wifi_login2', WIFI_SCRIPT)
+  spec = importlib.util.spec_from_loader('wifi_login2', loader)
+  wifi_login = importlib.util.module_from_spec(spec)
+  sys.modules['wifi_login2'] = wifi_login
+  loader.exec_module(wifi_login)
+  return wifi_login
+
+
+def time_startup(runs):
+  """Time starting the interpreter and importing wifi-login2.py, in a fresh process each time."""
+  code = 'import runpy; runpy.run_path({!r}, run_name="wifi_login2")'.format(WIFI_SCRIPT)
+  times = []
+  for run in range(runs):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code], cwd=SCRIPT_DIR)
+    times.append(time.time() - start)
+  return times
+
+
+def compare_startup(runs, script_args, zipapp=None):
+  """Time running each way of starting the script, taking turns so they see the same conditions."""
+  commands = [('interpreter', [sys.executable, '-c', 'pass']),
+              ('full', [sys.executable, WIFI_SCRIPT] + script_args),
+              ('fast', [sys.executable, FAST_SCRIPT] + script_args)]
+  if zipapp and os.path.isfile(zipapp):
+    commands.append(('zipapp', [sys.executable, zipapp] + script_args))
+  times = {}
+  with open(os.devnull, 'w') as devnull:
+    for run in range(runs):
+      for name, command in commands:
+        start = time.time()
+        subprocess.call(command, stdout=devnull, stderr=devnull)
+        times.setdefault(name, []).append(time.time() - start)
+  print_report('startup', times, runs, 0, [name for name, command in commands])
+
+
+async def time_phases(wifi_login, request_path, test_url):
+  """Go through the steps of a login by calling the wifi-login2.py functions directly, timing each.
+  Returns a dict mapping phase names to seconds elapsed, or None if the login failed."""
+  times = {}
+  request_dir, filename = os.path.split(request_path)
+  sysinfo = wifi_login.SystemInfo()
+  pool = wifi_login.asynchttp.ConnectionPool()
+  start = time.time()
+  wifi_login.find_request_file(request_dir, filename[:-4])
+  times['lookup'] = time.time() - start
+  start = time.time()
+  with wifi_login.open_request_file(request_path) as request_file:
+    template = wifi_login.compile_request_file(request_file)
+  wifi_login.check_request_template(template, sysinfo)
+  times['parse'] = time.time() - start
+  try:
+    start = time.time()
+    await wifi_login.is_connection_clear(test_url, {'status':204, 'body':''}, pool=pool)
+    times['probe'] = time.time() - start
+    start = time.time()
+    await wifi_login.make_request_steps(template, sysinfo, pool=pool)
+    times['login'] = time.time() - start
+  except wifi_login.asynchttp.NETWORK_ERRORS as error:
+    logging.info('Login failed: {}'.format(error))
+    return None
+  finally:
+    pool.close()
+  return times
+
+
+def print_report(portal, times, runs, failures, phases=PHASES):
+  print('{}: {} runs, {} failed'.format(portal, runs, failures))
+  print('  {:11s}'.format('phase')+''.join('{:>10s}'.format('p{}'.format(p)) for p in PERCENTILES))
+  for phase in phases:
+    if not times.get(phase):
+      continue
+    values = sorted(times[phase])
+    print('  {:11s}'.format(phase) +
+          ''.join('{:9.1f}ms'.format(1000*percentile(values, p)) for p in PERCENTILES))
+
+
+def percentile(sorted_values, percent):
+  """Get a percentile of a sorted list, by the nearest-rank method."""
+  rank = max(1, int(round(percent/100 * len(sorted_values)+0.4999)))
+  return sorted_values[min(rank, len(sorted_values))-1]
+
+
+class FakePortalServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  """Intercepts every GET with a recorded interception response until it gets a POST (the login).
+  After that, GETs get a 204 response, like the usual test URL."""
+  daemon_threads = True
+
+  def __init__(self, address, handler, faults):
+    http.server.HTTPServer.__init__(self, address, handler)
+    self.faults = faults
+    self.logged_in = False
+    self.interception = None
+
+  def load_interception(self, record_path):
+    """Read a recorded interception response, fixing its Content-Length to match its body."""
+    with open(record_path, 'rb') as record:
+      data = record.read()
+    head, separator, body = data.partition(b'\r\n\r\n')
+    if not separator:
+      head, separator, body = data.partition(b'\n\n')
+    lines = [line for line in head.splitlines() if not line.lower().startswith(b'content-length:')]
+    lines.append('Content-Length: {}'.format(len(body)).encode('ascii'))
+    self.interception = b'\r\n'.join(lines) + b'\r\n\r\n' + body
+
+
+class FakePortalHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send each response in one go, instead of a write (and maybe a packet) per header.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    if not self.simulate_faults():
+      return
+    if self.server.logged_in:
+      self.send_response(204)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+    else:
+      self.wfile.write(self.server.interception)
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    if not self.simulate_faults():
+      return
+    self.server.logged_in = True
+    body = b'Welcome!'
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def simulate_faults(self):
+    """Delay, drop, or reset the connection, as configured. Returns False if the request shouldn't
+    be answered."""
+    faults = self.server.faults
+    delay = faults['latency'] + random.uniform(0, faults['jitter'])
+    if delay:
+      time.sleep(delay)
+    if random.random() < faults['drop']:
+      self.close_connection = 1
+      return False
+    if random.random() < faults['reset']:
+      # Closing with a zero linger time sends a RST.
+      self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+      self.close_connection = 1
+      return False
+    return True
+
+  def log_message(self, format, *args):
+    logging.debug('Fake portal: '+format % args)
+
+
+def fail(message):
+  logging.critical(message)
+  sys.exit(1)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import os
+import sys
+import stat
+import shutil
+import logging
+import zipfile
+import argparse
+import tempfile
+import py_compile
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+# The files to bundle, and the names to give them in the bundle. The main script is renamed so it
+# can be imported.
+MAIN_SCRIPT = 'wifi-login-fast.py'
+MODULES = (('wifi-login2.py', 'wifi_login2.py'), ('netinfo.py', 'netinfo.py'),
+           ('asynchttp.py', 'asynchttp.py'), ('asyncdns.py', 'asyncdns.py'),
+           ('logincommon.py', 'logincommon.py'))
+LIB_DIR = 'lib'
+
+ARG_DEFAULTS = {'output':os.path.join(SCRIPT_DIR, 'wifi-login.pyz'),
+                'python':'/usr/bin/env python3', 'log_level':logging.WARNING}
+DESCRIPTION = """Bundle wifi-login-fast.py, wifi-login2.py, and the modules they use into a single
+executable zipapp. The modules are precompiled, so nothing is compiled at startup, which means the
+bundle has to be built with the same version of Python that will run it. The bundle looks for the
+http-login and http-redirect directories beside itself, so put it in the same directory as them."""
+
+
+def main(argv):
+
+  parser = argparse.ArgumentParser(description=DESCRIPTION)
+  parser.set_defaults(**ARG_DEFAULTS)
+
+  parser.add_argument('-o', '--output',
+    help='The file to write the bundle to. Default: %(default)s.')
+  parser.add_argument('-p', '--python',
+    help='The interpreter to put in the bundle\'s #! line. Default: %(default)s.')
+  parser.add_argument('-s', '--source', action='store_true',
+    help='Bundle the source instead of bytecode, so any version of Python can run it (but it has '
+         'to compile everything each time).')
+  parser.add_argument('-v', '--verbose', dest='log_level', action='store_const', const=logging.INFO,
+    help='Print each file bundled.')
+
+  args = parser.parse_args(argv[1:])
+
+  logging.basicConfig(stream=sys.stderr, level=args.log_level, format='%(levelname)s: %(message)s')
+
+  files = [(os.path.join(SCRIPT_DIR, MAIN_SCRIPT), '__main__.py', True)]
+  for filename, archive_name in MODULES:
+    files.append((os.path.join(SCRIPT_DIR, filename), archive_name, args.source))
+  lib_dir = os.path.join(SCRIPT_DIR, LIB_DIR)
+  lib_files = []
+  if os.path.isdir(lib_dir):
+    lib_files = [filename for filename in sorted(os.listdir(lib_dir)) if filename.endswith('.py')]
+  if '__init__.py' not in lib_files:
+    fail('The lib submodule in {} is missing. Run "git submodule update --init" first.'
+         .format(lib_dir))
+  for filename in lib_files:
+    files.append((os.path.join(lib_dir, filename), LIB_DIR+'/'+filename, args.source))
+
+  temp_dir = tempfile.mkdtemp()
+  temp_path = args.output+'.tmp'
+  try:
+    with open(temp_path, 'wb') as output:
+      output.write('#!{}\n'.format(args.python).encode('utf-8'))
+      with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for path, archive_name, source in files:
+          if source:
+            logging.info('Adding {} as {}'.format(path, archive_name))
+            bundle.write(path, archive_name)
+          else:
+            bytecode_path = os.path.join(temp_dir, os.path.basename(archive_name)+'c')
+            py_compile.compile(path, bytecode_path, archive_name, doraise=True)
+            logging.info('Adding {} as {}c'.format(path, archive_name))
+            bundle.write(bytecode_path, archive_name+'c')
+    mode = os.stat(temp_path).st_mode
+    os.chmod(temp_path, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.rename(temp_path, args.output)
+  except py_compile.PyCompileError as error:
+    fail('Could not compile: {}'.format(error))
+  finally:
+    shutil.rmtree(temp_dir)
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+  print('Wrote {}'.format(args.output))
+
+
+def fail(message):
+  logging.critical(message)
+  sys.exit(1)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,987 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import zlib
+import json
+import base64
+import codecs
+import socket
+import struct
+import logging
+import argparse
+import collections
+import urllib.parse
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+# Captured bytes are turned into text the same way wifi-login2.py reads request files.
+ENCODING = 'utf-8'
+ERRORS = 'surrogateescape'
+READ_SIZE = 65536
+# The most of any one message body to keep. The rest is read past and dropped.
+MAX_BODY = 1048576
+# The most out-of-order data to hold for one direction of a TCP connection before giving up on it.
+MAX_PENDING = 1048576
+# The longest a message's start line and headers can be before the stream is given up as not HTTP.
+MAX_HEAD = 65536
+# pcap magic numbers (for microsecond and nanosecond timestamps), and the byte order each means.
+PCAP_MAGICS = {b'\xd4\xc3\xb2\xa1':'<', b'\xa1\xb2\xc3\xd4':'>', b'\x4d\x3c\xb2\xa1':'<',
+               b'\xa1\xb2\x3c\x4d':'>'}
+# The rest of a pcap file's header, after the magic number. The link type is last.
+PCAP_HEADER = struct.Struct('HHiIII')
+PCAP_RECORD = struct.Struct('IIII')
+# pcapng block types, and the magic number that tells a section's byte order.
+BLOCK_SECTION = b'\x0a\x0d\x0d\x0a'
+BLOCK_INTERFACE = 1
+BLOCK_SIMPLE_PACKET = 3
+BLOCK_ENHANCED_PACKET = 6
+BYTE_ORDER_MAGIC = 0x1a2b3c4d
+# Link-layer header types, from https://www.tcpdump.org/linktypes.html.
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLANS = (0x8100, 0x88a8)
+IPPROTO_TCP = 6
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+SEQ_MASK = 0xffffffff
+# What the start of an HTTP request looks like, to tell HTTP connections from others.
+REQUEST_START_REGEX = re.compile(rb'[A-Z]{3,10} [!-~]')
+HEAD_END_REGEX = re.compile(rb'\r?\n\r?\n')
+# The hosts operating systems and browsers test connections with. A response from one of these
+# that isn't its usual answer is a portal intercepting it.
+PROBE_HOSTS = ('www.gstatic.com', 'connectivitycheck.gstatic.com', 'clients3.google.com',
+               'connectivitycheck.android.com', 'captive.apple.com', 'www.apple.com',
+               'detectportal.firefox.com', 'www.msftconnecttest.com', 'www.msftncsi.com',
+               'nmcheck.gnome.org', 'network-test.debian.org', 'neverssl.com')
+PROBE_SUCCESS_REGEX = re.compile(rb'success|Microsoft (?:Connect Test|NCSI)|NetworkManager is '
+                                 rb'online', re.IGNORECASE)
+META_REFRESH_REGEX = re.compile(r'<meta\s[^>]*http-equiv\s*=\s*["\']?refresh[^>]*?url\s*=\s*'
+                                r'([^"\'>\s]+)', re.IGNORECASE)
+# Headers not to copy into the login request file. asynchttp sets the length itself, and doesn't
+# decompress response bodies, so asking for compressed ones would break @extract.
+DROP_REQUEST_HEADERS = ('content-length', 'accept-encoding', 'transfer-encoding', 'connection')
+# Headers not to copy into the interception record, since its body is saved decoded.
+DROP_RESPONSE_HEADERS = ('content-length', 'content-encoding', 'transfer-encoding')
+STEP_SEPARATOR = '---'
+# Request files with bodies that span lines have to be in this format (see wifi-login2.py).
+MULTILINE_FORMAT = '@format 2'
+# Characters of the name that can't go in a filename as they are, or would change what the
+# filename means to wifi-login2.py, like wildcards. They're written as "\xNN" escapes. Bytes that
+# aren't valid text are surrogate escapes (\udc80-\udcff) when decoded like filenames.
+FILENAME_UNSAFE_REGEX = re.compile(r'[\x00-\x1f\x7f/\\*?[\udc80-\udcff]|^\.|^r(?=e:)')
+# How values can be encoded in a request, and the placeholder filters that encode them that way.
+ENCODING_FILTERS = ((None, None), ('urlencode', lambda value: urllib.parse.quote(value, safe='')),
+                    ('formencode', lambda value: urllib.parse.quote_plus(value, safe='')))
+MAC_REGEX_TEMPLATE = r'(?<![0-9A-Fa-f:]){}(?![0-9A-Fa-f:])'
+IP_REGEX_TEMPLATE = r'(?<![\d.]){}(?![\d])'
+
+ARG_DEFAULTS = {'request_dir':os.path.join(SCRIPT_DIR, 'http-login'),
+                'redirect_dir':os.path.join(SCRIPT_DIR, 'http-redirect'), 'placeholders':True,
+                'log_level':logging.WARNING}
+DESCRIPTION = """Import a network's login from a capture of it, made while logging in with a
+browser: a HAR file exported from the browser's developer tools, or a pcap or pcapng file from
+tcpdump or Wireshark. The response that intercepted a connection test is saved to the
+--redirect-dir (so the portal can be identified), and the login request to the --request-dir, both
+as [name].txt. The capture is streamed, so it can be bigger than memory. Values in the login
+request that depend on the machine or network, like its MAC address, are replaced with
+placeholders. They're looked for in the capture (pcap files only), or can be given as options.
+Run with --list first to see the HTTP exchanges in the capture, and which were picked."""
+
+
+def main(argv):
+
+  parser = argparse.ArgumentParser(description=DESCRIPTION)
+  parser.set_defaults(**ARG_DEFAULTS)
+
+  parser.add_argument('capture',
+    help='The HAR, pcap, or pcapng file.')
+  parser.add_argument('-s', '--ssid',
+    help='The SSID of the network. It\'s used as the --name, and replaced with ${ssid} in the '
+         'login request.')
+  parser.add_argument('-n', '--name',
+    help='The name to save the records under, without the ".txt". Default: the --ssid.')
+  parser.add_argument('-L', '--list', action='store_true',
+    help='Just list the HTTP exchanges in the capture, numbered, marking the interception (I) and '
+         'login (L) ones that would be picked. Don\'t save anything.')
+  parser.add_argument('-i', '--interception', type=int,
+    help='The number (from --list) of the exchange whose response intercepted a connection test. '
+         'Default: the first response redirecting to another host, or answering a known connection '
+         'test host with something other than its usual answer.')
+  parser.add_argument('-l', '--login', dest='logins', type=int, action='append',
+    help='The number (from --list) of the login request. Give this more than once for a login '
+         'that takes several requests, in order. Default: the first POST after the interception '
+         'to the host it redirected to (or any host, if there\'s none).')
+  parser.add_argument('-m', '--mac',
+    help='Our MAC address when the capture was made, to replace with ${mac}. Default: the MAC '
+         'address that sent the login request (pcap files only).')
+  parser.add_argument('-a', '--ip',
+    help='Our IP address when the capture was made, to replace with ${ip}. Default: the address '
+         'that sent the login request (pcap files only).')
+  parser.add_argument('-w', '--wifimac',
+    help='The MAC address of the access point, to replace with ${wifimac}.')
+  parser.add_argument('-P', '--no-placeholders', dest='placeholders', action='store_false',
+    help='Don\'t replace any values with placeholders.')
+  parser.add_argument('-d', '--request-dir',
+    help='The directory to save the login request in. Default: %(default)s.')
+  parser.add_argument('-r', '--redirect-dir',
+    help='The directory to save the interception response in. Default: %(default)s.')
+  parser.add_argument('-f', '--force', action='store_true',
+    help='Overwrite existing records.')
+  parser.add_argument('-q', '--quiet', dest='log_level', action='store_const', const=logging.ERROR,
+    help='Print messages only on terminal errors.')
+  parser.add_argument('-v', '--verbose', dest='log_level', action='store_const', const=logging.INFO,
+    help='Print informational messages in addition to warnings and errors.')
+  parser.add_argument('-D', '--debug', dest='log_level', action='store_const', const=logging.DEBUG,
+    help='Turn debug messages on.')
+
+  args = parser.parse_args(argv[1:])
+
+  logging.basicConfig(stream=sys.stderr, level=args.log_level, format='%(levelname)s: %(message)s')
+
+  name = args.name or args.ssid
+  if not (name or args.list):
+    fail('Give an --ssid or --name to save the records under.')
+
+  try:
+    with open(args.capture, 'rb') as capture:
+      exchanges = read_capture(capture)
+      interception, logins = select_exchanges(exchanges, args.interception, args.logins or (),
+                                              args.list)
+  except OSError as error:
+    fail('Could not read {}: {}'.format(args.capture, error))
+  except CaptureError as error:
+    fail('{}: {}'.format(args.capture, error))
+  if args.list:
+    return 0
+
+  if not logins:
+    fail('No login request found. Use --list to find it, then give its number with --login.')
+  for login in logins:
+    if login['scheme'] != 'http':
+      fail('Exchange {} is over {}. Request files can only hold plain HTTP requests.'
+           .format(login['number'], login['scheme']))
+  if not interception:
+    logging.warning('No interception found, so the portal won\'t be identifiable on other '
+                    'networks. Use --list to find it, then give its number with --interception.')
+
+  values = collections.OrderedDict()
+  if args.placeholders:
+    values['ssid'] = args.ssid
+    values['mac'] = args.mac or logins[0]['client_mac']
+    values['ip'] = args.ip or logins[0]['client_ip']
+    values['wifimac'] = args.wifimac
+    for placeholder, value in values.items():
+      if value:
+        logging.info('Replacing {} with ${{{}}}.'.format(value, placeholder))
+  try:
+    request_text = format_request_file([login['request'] for login in logins], values)
+  except CaptureError as error:
+    fail(str(error))
+
+  filename = escape_filename(name)
+  if filename != name:
+    logging.info('Saving the records as {}.txt, since the name has characters that can\'t go in a '
+                 'filename.'.format(filename))
+  records = [(os.path.join(args.request_dir, filename+'.txt'),
+              request_text.encode(ENCODING, ERRORS))]
+  if interception:
+    records.append((os.path.join(args.redirect_dir, filename+'.txt'),
+                    format_response_record(interception['response'])))
+  write_records(records, args.force)
+
+
+class CaptureError(Exception):
+  pass
+
+
+def fail(message):
+  logging.critical(message)
+  sys.exit(1)
+
+
+def escape_filename(name):
+  """Escape the characters of a name (like an SSID) that can't be in a request filename, in the way
+  wifi-login2.py's unescape_filename() reverses."""
+  def escape(match):
+    code = ord(match.group(0))
+    return '\\x{:02x}'.format(code - 0xdc00 if code > 0xff else code)
+  return FILENAME_UNSAFE_REGEX.sub(escape, name)
+
+
+def write_records(records, force=False):
+  """Write a list of (path, data) records. Unless "force" is given, nothing is written if any of
+  them already exists, so a request file is never left without its redirect record."""
+  if not force:
+    for path, data in records:
+      if os.path.exists(path):
+        fail('{} already exists. Give --force to overwrite it.'.format(path))
+  for path, data in records:
+    with open(path, 'wb') as record:
+      record.write(data)
+    print('Wrote {}'.format(path))
+
+
+##### Picking out the login #####
+
+def select_exchanges(exchanges, interception_num=None, login_nums=(), listing=False):
+  """Go through the HTTP exchanges (see read_capture()), picking out the interception and the login
+  request(s), either by their numbers or as described in --interception and --login. Only the ones
+  picked are kept in memory. If "listing", print each one as it goes by.
+  Returns the interception exchange (or None) and a list of the login exchanges."""
+  interception = None
+  portal_host = None
+  logins = {}
+  portal_login = any_login = first_post = None
+  for exchange in exchanges:
+    number = exchange['number']
+    marks = ''
+    if interception_num is not None:
+      if number == interception_num:
+        interception = exchange
+        portal_host = exchange['response'] and get_redirect_host(exchange)
+        marks += 'I'
+    elif interception is None and is_interception(exchange):
+      interception = exchange
+      portal_host = get_redirect_host(exchange)
+      marks += 'I'
+    if login_nums:
+      if number in login_nums:
+        logins[number] = exchange
+    elif exchange['request']['method'] == 'POST':
+      host = (get_header(exchange['request']['headers'], 'Host') or '').lower()
+      if interception and portal_login is None and host == portal_host:
+        portal_login = exchange
+        marks += 'L'
+      elif interception and any_login is None:
+        any_login = exchange
+      elif first_post is None:
+        first_post = exchange
+    if listing:
+      print_exchange(exchange, marks)
+  if login_nums:
+    missing = [number for number in login_nums if number not in logins]
+    if missing:
+      raise CaptureError('No exchange numbered {}.'.format(missing[0]))
+    return interception, [logins[number] for number in login_nums]
+  if interception_num is not None and interception is None:
+    raise CaptureError('No exchange numbered {}.'.format(interception_num))
+  login = portal_login or any_login or first_post
+  if listing:
+    print('Interception: {}. Login: {}.'.format(interception and interception['number'],
+                                                login and login['number']))
+  return interception, [login] if login else []
+
+
+def is_interception(exchange):
+  """Decide whether an exchange looks like a portal intercepting a request: a redirect to another
+  host, or a known connection test host answering with something other than its usual answer."""
+  response = exchange['response']
+  if not response:
+    return False
+  host = (get_header(exchange['request']['headers'], 'Host') or '').lower()
+  redirect_host = get_redirect_host(exchange)
+  if redirect_host and redirect_host != host:
+    return True
+  if host.split(':')[0] in PROBE_HOSTS:
+    return response['status'] != 204 and not PROBE_SUCCESS_REGEX.search(response['body'])
+  return False
+
+
+def get_redirect_host(exchange):
+  """Get the host (lowercase) an exchange's response redirects to, with a Location header or a
+  meta refresh tag, or None."""
+  response = exchange['response']
+  url = None
+  if 300 <= response['status'] < 400:
+    url = get_header(response['headers'], 'Location')
+  if not url:
+    match = META_REFRESH_REGEX.search(response['body'][:MAX_HEAD].decode(ENCODING, ERRORS))
+    url = match and match.group(1)
+  return url and urllib.parse.urlsplit(url.strip()).netloc.lower() or None
+
+
+def print_exchange(exchange, marks=''):
+  request = exchange['request']
+  response = exchange['response']
+  host = get_header(request['headers'], 'Host') or '?'
+  url = '{}://{}{}'.format(exchange['scheme'], host, request['path'])
+  status = response['status'] if response else '(none)'
+  print('{:5d} {:2s} {:7s} {} -> {}'.format(exchange['number'], marks, request['method'], url,
+                                            status))
+
+
+##### Writing records #####
+
+def format_request_file(requests, values=None):
+  """Format requests as the steps of a request file, with the "values" dict's values replaced by
+  placeholders named after its keys. If any body spans lines, the file is written in format 2,
+  with a Content-Length header on each step with a body, giving its length in the file."""
+  substitutions = get_substitutions(values or {})
+  bodies = [substitute(request['body'].decode(ENCODING, ERRORS), substitutions)
+            for request in requests]
+  multiline = any('\n' in body or '\r' in body for body in bodies)
+  steps = []
+  for request, body in zip(requests, bodies):
+    lines = ['{} {} HTTP/1.1'.format(request['method'], substitute(request['path'], substitutions))]
+    for name, value in request['headers']:
+      if name.lower() in DROP_REQUEST_HEADERS:
+        continue
+      if name.lower() != 'host':
+        value = substitute(value, substitutions)
+      lines.append('{}: {}'.format(name, value))
+    if multiline and body:
+      lines.append('Content-Length: {}'.format(len(body.encode(ENCODING, ERRORS))))
+    lines.append('')
+    lines.append(body)
+    steps.append('\r\n'.join(lines))
+  if multiline:
+    steps[0] = MULTILINE_FORMAT+'\r\n'+steps[0]
+  return ('\r\n'+STEP_SEPARATOR+'\r\n').join(steps)
+
+
+def get_substitutions(values):
+  """Make a list of (regex, placeholder) pairs to replace the values in the "values" dict (like
+  {'mac':'00:1a:2b:3c:4d:5e'}) with placeholders, for substitute(). MAC addresses match in either
+  case, and uppercase ones get an "upper" filter, like ${mac|upper}. URL-encoded (and form-encoded)
+  values are matched too, and get an "urlencode" (or "formencode") filter."""
+  substitutions = []
+  for placeholder, value in values.items():
+    if not value:
+      continue
+    flags = re.IGNORECASE if placeholder in ('mac', 'wifimac') else 0
+    seen = set()
+    for encoding, encode in ENCODING_FILTERS:
+      encoded = encode(value) if encode else value
+      if encoded in seen:
+        continue
+      seen.add(encoded)
+      if placeholder in ('mac', 'wifimac'):
+        regex = MAC_REGEX_TEMPLATE.format(re.escape(encoded))
+      elif placeholder == 'ip':
+        regex = IP_REGEX_TEMPLATE.format(re.escape(encoded))
+      else:
+        regex = re.escape(encoded)
+      substitutions.append((re.compile(regex, flags), placeholder, encoding))
+  return substitutions
+
+
+def substitute(string, substitutions):
+  for regex, placeholder, encoding in substitutions:
+    def replace(match):
+      filters = [placeholder]
+      # An uppercase MAC address. Percent-escapes are uppercase anyway, so only letters count.
+      if regex.flags & re.IGNORECASE and re.sub('%[0-9A-F]{2}', '', match.group(0)).isupper():
+        filters.append('upper')
+      if encoding:
+        filters.append(encoding)
+      return '${'+'|'.join(filters)+'}'
+    string = regex.sub(replace, string)
+  return string
+
+
+def format_response_record(response):
+  """Format a response as an interception record, with its body decoded."""
+  lines = ['HTTP/1.1 {} {}'.format(response['status'], response['reason'])]
+  for name, value in response['headers']:
+    if name.lower() not in DROP_RESPONSE_HEADERS:
+      lines.append('{}: {}'.format(name, value))
+  lines.append('Content-Length: {}'.format(len(response['body'])))
+  head = '\r\n'.join(lines)+'\r\n\r\n'
+  return head.encode(ENCODING, ERRORS) + response['body']
+
+
+def get_header(headers, name):
+  name = name.lower()
+  for key, value in headers:
+    if key.lower() == name:
+      return value
+  return None
+
+
+##### Reading captures #####
+
+def read_capture(capture):
+  """Read the HTTP exchanges in a capture file (opened in binary mode), one at a time.
+  Each is a dict:
+  "number": Its number, counting from 1 in the order they were read.
+  "scheme": "http" or "https".
+  "request": A dict with the "method", "path", "headers" (a list of (name, value) pairs), and
+             "body" (bytes) of the request.
+  "response": A dict with the "status", "reason", "headers", and "body" (bytes, decompressed) of the
+              response, or None if there was none.
+  "client_ip", "client_mac": The addresses the request came from, if known."""
+  start = capture.read(4)
+  if start in PCAP_MAGICS:
+    packets = read_pcap(capture, start)
+  elif start == BLOCK_SECTION:
+    packets = read_pcapng(capture, start)
+  elif start.lstrip().startswith(b'{') or start.startswith(b'\xef\xbb\xbf'):
+    exchanges = (read_har_entry(entry) for entry in read_har_entries(capture, start))
+    return number_exchanges(exchanges)
+  else:
+    raise CaptureError('Not a HAR, pcap, or pcapng file.')
+  return number_exchanges(read_packets(packets))
+
+
+def number_exchanges(exchanges):
+  for number, exchange in enumerate(exchanges, 1):
+    exchange['number'] = number
+    yield exchange
+
+
+def read_har_entries(capture, start=b''):
+  """Read the "entries" of a HAR file one at a time, without reading the whole file into memory.
+  Each is only parsed once all of it has been read."""
+  decoder = json.JSONDecoder()
+  reader = capture_reader(capture, start)
+  buffer = ''
+  while True:
+    match = re.search(r'"entries"\s*:\s*\[', buffer)
+    if match:
+      buffer = buffer[match.end():]
+      break
+    # Keep enough to find the key if it's split across reads.
+    buffer = buffer[-32:]
+    data = reader(READ_SIZE)
+    if not data:
+      raise CaptureError('No "entries" found in the HAR file.')
+    buffer += data
+  eof = False
+  while True:
+    buffer = buffer.lstrip(' \t\r\n,')
+    if buffer.startswith(']'):
+      return
+    if buffer:
+      try:
+        entry, end = decoder.raw_decode(buffer)
+      except ValueError:
+        if eof:
+          raise CaptureError('The HAR file is cut off or invalid.')
+      else:
+        buffer = buffer[end:]
+        yield entry
+        continue
+    elif eof:
+      raise CaptureError('The HAR file is cut off.')
+    # Entries can be big, so read more each time one doesn't fit, to keep re-parsing it cheap.
+    data = reader(max(READ_SIZE, len(buffer)))
+    eof = not data
+    buffer += data
+
+
+def capture_reader(capture, start=b''):
+  """Make a function to read text from the binary "capture" file, which already had "start" read
+  from it."""
+  decoder = codecs.getincrementaldecoder('utf-8-sig')(ERRORS)
+  pending = [start]
+  def read(size):
+    data = pending.pop() if pending else capture.read(size)
+    return decoder.decode(data, final=not data)
+  return read
+
+
+def read_har_entry(entry):
+  """Turn a HAR entry into an exchange (see read_capture())."""
+  try:
+    return parse_har_entry(entry)
+  except (KeyError, TypeError, AttributeError, ValueError) as error:
+    raise CaptureError('Invalid HAR entry: {}'.format(error))
+
+
+def parse_har_entry(entry):
+  request = entry['request']
+  url = urllib.parse.urlsplit(request['url'])
+  path = url.path or '/'
+  if url.query:
+    path += '?'+url.query
+  # HTTP/2 pseudo-headers (":authority", etc.) aren't sent in HTTP/1.1.
+  headers = [(header['name'], header['value']) for header in request.get('headers', ())
+             if not header['name'].startswith(':')]
+  if not get_header(headers, 'Host'):
+    headers.insert(0, ('Host', url.netloc))
+  post_data = request.get('postData') or {}
+  body = post_data.get('text', '').encode(ENCODING, ERRORS)
+  response = entry.get('response')
+  if response and response.get('status', 0) > 0:
+    content = response.get('content') or {}
+    response_body = content.get('text') or ''
+    if content.get('encoding') == 'base64':
+      response_body = base64.b64decode(response_body)
+    else:
+      response_body = response_body.encode(ENCODING, ERRORS)
+    response = {'status':response['status'], 'reason':response.get('statusText', ''),
+                'headers':[(header['name'], header['value'])
+                           for header in response.get('headers', ())
+                           if not header['name'].startswith(':')],
+                'body':response_body[:MAX_BODY]}
+  else:
+    response = None
+  return {'scheme':url.scheme, 'request':{'method':request['method'], 'path':path,
+                                          'headers':headers, 'body':body},
+          'response':response, 'client_ip':None, 'client_mac':None}
+
+
+def read_pcap(capture, start):
+  """Read the frames in a pcap file, as (link type, frame) tuples."""
+  endian = PCAP_MAGICS[start]
+  header = capture.read(PCAP_HEADER.size)
+  if len(header) < PCAP_HEADER.size:
+    raise CaptureError('The pcap file is cut off.')
+  linktype = struct.unpack(endian+'I', header[-4:])[0] & 0xffff
+  record = struct.Struct(endian+PCAP_RECORD.format)
+  while True:
+    head = capture.read(record.size)
+    if len(head) < record.size:
+      return
+    seconds, fraction, captured_length, length = record.unpack(head)
+    frame = capture.read(captured_length)
+    if len(frame) < captured_length:
+      logging.warning('The capture is cut off.')
+      return
+    yield linktype, frame
+
+
+def read_pcapng(capture, start):
+  """Read the frames in a pcapng file, as (link type, frame) tuples."""
+  block_type = start
+  endian = '<'
+  linktypes = []
+  while len(block_type) == 4:
+    if block_type == BLOCK_SECTION:
+      head = capture.read(8)
+      if len(head) < 8:
+        raise CaptureError('The pcapng file is cut off.')
+      endian = '<' if struct.unpack('<I', head[4:])[0] == BYTE_ORDER_MAGIC else '>'
+      length = struct.unpack(endian+'I', head[:4])[0]
+      body = capture.read(length-12)
+      # Interface numbers start over in each section.
+      linktypes = []
+    else:
+      head = capture.read(4)
+      length = struct.unpack(endian+'I', head)[0] if len(head) == 4 else 0
+      body = capture.read(length-8) if length >= 12 else b''
+      if len(body) < length-8 or length < 12:
+        logging.warning('The capture is cut off.')
+        return
+      block_number = struct.unpack(endian+'I', block_type)[0]
+      if block_number == BLOCK_INTERFACE:
+        linktypes.append(struct.unpack_from(endian+'H', body)[0])
+      elif block_number == BLOCK_ENHANCED_PACKET and linktypes:
+        interface, high, low, captured_length, length = struct.unpack_from(endian+'IIIII', body)
+        yield linktypes[interface], body[20:20+captured_length]
+      elif block_number == BLOCK_SIMPLE_PACKET and linktypes:
+        length = struct.unpack_from(endian+'I', body)[0]
+        yield linktypes[0], body[4:4+length]
+    block_type = capture.read(4)
+
+
+def read_packets(packets):
+  """Reassemble the TCP connections in a series of (link type, frame) tuples, and parse the HTTP
+  exchanges in them. Yields each exchange (see read_capture()) once its response is complete. The
+  ones never answered come at the end."""
+  connections = {}
+  unsupported = set()
+  for linktype, frame in packets:
+    ip_packet, mac = parse_link_layer(linktype, frame)
+    if ip_packet is None:
+      if mac is False and linktype not in unsupported:
+        logging.warning('Skipping frames of unsupported link type {}.'.format(linktype))
+        unsupported.add(linktype)
+      continue
+    segment = parse_tcp_segment(ip_packet)
+    if segment is None:
+      continue
+    source, destination, seq, flags, data = segment
+    key = (min(source, destination), max(source, destination))
+    connection = connections.get(key)
+    if connection is None:
+      if flags & TCP_RST or not (data or flags & TCP_SYN):
+        continue
+      connection = connections[key] = TCPConnection()
+    for exchange in connection.add(source, mac, seq, flags, data):
+      yield exchange
+    if connection.finished():
+      for exchange in connection.close():
+        yield exchange
+      del connections[key]
+  for connection in connections.values():
+    for exchange in connection.close():
+      yield exchange
+
+
+def parse_link_layer(linktype, frame):
+  """Get the IP packet from a frame, and the MAC address that sent it, if the link layer has one.
+  Returns (None, None) if it doesn't hold an IP packet, and (None, False) if the link type isn't
+  supported."""
+  mac = None
+  if linktype == LINKTYPE_ETHERNET:
+    if len(frame) < 14:
+      return None, None
+    ethertype = struct.unpack_from('!H', frame, 12)[0]
+    offset = 14
+    while ethertype in ETHERTYPE_VLANS and len(frame) >= offset+4:
+      ethertype = struct.unpack_from('!H', frame, offset+2)[0]
+      offset += 4
+    mac = format_mac(frame[6:12])
+  elif linktype == LINKTYPE_LINUX_SLL:
+    if len(frame) < 16:
+      return None, None
+    address_length, ethertype = struct.unpack_from('!H8xH', frame, 4)
+    offset = 16
+    if address_length == 6:
+      mac = format_mac(frame[6:12])
+  elif linktype == LINKTYPE_LINUX_SLL2:
+    if len(frame) < 20:
+      return None, None
+    ethertype = struct.unpack_from('!H', frame)[0]
+    offset = 20
+    if frame[11] == 6:
+      mac = format_mac(frame[12:18])
+  elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+    ethertype = None
+    offset = 0
+  elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+    ethertype = None
+    offset = 4
+  else:
+    return None, False
+  if ethertype not in (None, ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+    return None, None
+  return frame[offset:], mac
+
+
+def format_mac(raw):
+  return ':'.join('{:02x}'.format(byte) for byte in raw)
+
+
+def parse_tcp_segment(packet):
+  """Parse an IP packet holding a TCP segment. Returns a tuple of the source and destination (each
+  an (address, port) tuple), the sequence number, the TCP flags, and the data. Returns None if it
+  isn't TCP, or is a fragment."""
+  if not packet:
+    return None
+  version = packet[0] >> 4
+  if version == 4 and len(packet) >= 20:
+    header_length = (packet[0] & 0xf) * 4
+    total_length, fragment, protocol = struct.unpack_from('!2xH2xHxB', packet)
+    if protocol != IPPROTO_TCP or fragment & 0x3fff:
+      return None
+    source_ip = socket.inet_ntop(socket.AF_INET, packet[12:16])
+    destination_ip = socket.inet_ntop(socket.AF_INET, packet[16:20])
+    # The total length is 0 in packets captured before segmentation offload splits them.
+    segment = packet[header_length:total_length or len(packet)]
+  elif version == 6 and len(packet) >= 40:
+    payload_length, next_header = struct.unpack_from('!4xHB', packet)
+    if next_header != IPPROTO_TCP:
+      return None
+    source_ip = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+    destination_ip = socket.inet_ntop(socket.AF_INET6, packet[24:40])
+    segment = packet[40:40+payload_length] if payload_length else packet[40:]
+  else:
+    return None
+  if len(segment) < 20:
+    return None
+  source_port, destination_port, seq, offset_flags = struct.unpack_from('!HHI4xH', segment)
+  data = segment[(offset_flags >> 12) * 4:]
+  return ((source_ip, source_port), (destination_ip, destination_port), seq, offset_flags & 0x3f,
+          data)
+
+
+class TCPConnection(object):
+  """A TCP connection being reassembled, and the HTTP exchanges in it. Which end is the client is
+  decided by who sends the first SYN, or else who sends the first HTTP request."""
+
+  def __init__(self):
+    self.streams = {}
+    self.client = None
+    self.client_mac = None
+    self.http = False
+    self.ignored = False
+    self.closed = set()
+    self.requests = collections.deque()
+    self.request_parser = HTTPParser(False)
+    self.response_parser = HTTPParser(True, self.get_request_method)
+
+  def add(self, source, mac, seq, flags, data):
+    """Add a segment sent from "source". Returns a list of the exchanges it completed."""
+    if self.ignored:
+      return []
+    if flags & TCP_SYN and not flags & TCP_ACK and self.client is None:
+      self.client = source
+      self.client_mac = mac
+    stream = self.streams.setdefault(source, TCPStream())
+    try:
+      data = stream.add(seq, flags, data)
+    except CaptureError as error:
+      self.ignore(error)
+      return []
+    if flags & (TCP_FIN | TCP_RST):
+      self.closed.add(source)
+      if flags & TCP_RST:
+        self.closed.update(self.streams)
+    if not data:
+      return []
+    if self.client is None:
+      self.client = source
+      self.client_mac = mac
+    if source == self.client and not self.http:
+      if not REQUEST_START_REGEX.match(data):
+        self.ignore('Not HTTP.')
+        return []
+      self.http = True
+    try:
+      if source == self.client:
+        for request in self.request_parser.feed(data):
+          self.requests.append({'request':request, 'response':None, 'scheme':'http',
+                                'client_ip':self.client[0], 'client_mac':self.client_mac})
+        return []
+      return [self.finish_exchange(response) for response in self.response_parser.feed(data)]
+    except CaptureError as error:
+      self.ignore(error)
+      return []
+
+  def ignore(self, reason):
+    """Give up on the connection, and drop everything held for it."""
+    if self.http:
+      logging.debug('Giving up on the connection from {}: {}'.format(self.client, reason))
+    self.ignored = True
+    self.streams = {}
+    self.request_parser = self.response_parser = None
+
+  def get_request_method(self):
+    return self.requests[0]['request']['method'] if self.requests else None
+
+  def finish_exchange(self, response):
+    if not self.requests:
+      raise CaptureError('Response without a request.')
+    exchange = self.requests.popleft()
+    exchange['response'] = response
+    return exchange
+
+  def finished(self):
+    return len(self.closed) >= 2 or (self.ignored and self.closed)
+
+  def close(self):
+    """The connection is over. Returns a list of the exchanges left: the last, if its response ran
+    until the connection closed, and any never answered."""
+    exchanges = []
+    if not self.ignored:
+      response = self.response_parser.close()
+      if response and self.requests:
+        exchanges.append(self.finish_exchange(response))
+    exchanges.extend(self.requests)
+    self.requests.clear()
+    return exchanges
+
+
+class TCPStream(object):
+  """Puts the data sent in one direction of a TCP connection back in order, dropping
+  retransmissions."""
+
+  def __init__(self):
+    self.next_seq = None
+    self.pending = {}
+    self.pending_size = 0
+
+  def add(self, seq, flags, data):
+    """Add a segment. Returns the data it (and any segments held waiting for it) adds to the end of
+    the stream, in order."""
+    if flags & TCP_SYN:
+      self.next_seq = (seq + 1) & SEQ_MASK
+      seq = self.next_seq
+    if not data:
+      return b''
+    if self.next_seq is None:
+      # The capture started in the middle of the connection.
+      self.next_seq = seq
+    offset = (seq - self.next_seq) & SEQ_MASK
+    if offset and offset < 0x80000000:
+      # It's ahead of a segment we haven't seen yet.
+      if len(data) > len(self.pending.get(seq, b'')):
+        self.pending_size += len(data) - len(self.pending.get(seq, b''))
+        self.pending[seq] = data
+      if self.pending_size > MAX_PENDING:
+        raise CaptureError('Too much data missing from the capture.')
+      return b''
+    chunks = []
+    while data is not None:
+      # Drop anything we already have (retransmissions), then add the rest.
+      overlap = (self.next_seq - seq) & SEQ_MASK
+      if overlap < len(data):
+        chunks.append(data[overlap:])
+        self.next_seq = (seq + len(data)) & SEQ_MASK
+      data = None
+      for pending_seq in list(self.pending):
+        if (pending_seq - self.next_seq) & SEQ_MASK >= 0x80000000 or pending_seq == self.next_seq:
+          seq = pending_seq
+          data = self.pending.pop(pending_seq)
+          self.pending_size -= len(data)
+          break
+    return b''.join(chunks)
+
+
+class HTTPParser(object):
+  """Parses the HTTP messages in one direction of a connection, as its data arrives. For responses,
+  "get_method" gets the method of the request being answered, since that can decide whether it has
+  a body. Bodies are kept up to MAX_BODY bytes, and the rest is skipped."""
+
+  def __init__(self, responses, get_method=None):
+    self.responses = responses
+    self.get_method = get_method
+    self.buffer = b''
+    self.message = None
+    # How the body of the message is delimited: "length" (with self.remaining bytes left),
+    # "chunk size", "chunk" (self.remaining bytes left), "chunk end", "trailer", or "close".
+    self.state = None
+    self.remaining = 0
+    self.body = []
+    self.body_size = 0
+
+  def feed(self, data):
+    """Add data. Returns a list of the messages it completes."""
+    self.buffer += data
+    messages = []
+    while True:
+      if self.message is None:
+        if not (self.buffer and self.read_head()):
+          break
+        if self.message is None:
+          # It was an interim response.
+          continue
+      elif not self.read_body():
+        break
+      if self.state is None:
+        messages.append(self.finish())
+    return messages
+
+  def close(self):
+    """The stream ended. Returns the message whose body ran until then, if any."""
+    if self.message is not None and self.state == 'close':
+      self.read_body()
+      return self.finish()
+    return None
+
+  def read_head(self):
+    match = HEAD_END_REGEX.search(self.buffer)
+    if not match:
+      if len(self.buffer) > MAX_HEAD:
+        raise CaptureError('HTTP headers too long.')
+      return False
+    head = self.buffer[:match.start()].decode(ENCODING, ERRORS)
+    self.buffer = self.buffer[match.end():]
+    lines = head.splitlines()
+    fields = lines[0].split(None, 2) if lines else []
+    if len(fields) < 2:
+      raise CaptureError('Invalid start line: '+(lines[0] if lines else ''))
+    headers = []
+    for line in lines[1:]:
+      name, colon, value = line.partition(':')
+      if colon:
+        headers.append((name.strip(), value.strip()))
+    if self.responses:
+      if not fields[1].isdigit():
+        raise CaptureError('Invalid status line: '+lines[0])
+      status = int(fields[1])
+      if 100 <= status < 200:
+        # An interim response, like "100 Continue". The real one comes next.
+        return True
+      self.message = {'status':status, 'reason':fields[2] if len(fields) > 2 else '',
+                      'headers':headers}
+    else:
+      self.message = {'method':fields[0], 'path':fields[1], 'headers':headers}
+    self.body = []
+    self.body_size = 0
+    length = get_header(headers, 'Content-Length')
+    if self.responses and (self.get_method() == 'HEAD' or status in (204, 304)):
+      self.state = None
+    elif 'chunked' in (get_header(headers, 'Transfer-Encoding') or '').lower():
+      self.state = 'chunk size'
+    elif length is not None and length.strip().isdigit():
+      self.state = 'length' if int(length) else None
+      self.remaining = int(length)
+    elif self.responses:
+      self.state = 'close'
+    else:
+      self.state = None
+    return True
+
+  def read_body(self):
+    """Read as much of the body as is buffered. Returns whether progress was made."""
+    progress = False
+    while self.state is not None:
+      if self.state == 'length' and not self.remaining:
+        self.state = None
+      elif self.state in ('length', 'chunk', 'close'):
+        if not self.buffer:
+          return progress
+        size = len(self.buffer) if self.state == 'close' else min(self.remaining, len(self.buffer))
+        self.keep(self.buffer[:size])
+        self.buffer = self.buffer[size:]
+        self.remaining -= size
+        if self.state == 'chunk' and not self.remaining:
+          self.state = 'chunk end'
+      else:
+        line_end = self.buffer.find(b'\n')
+        if line_end < 0:
+          if len(self.buffer) > MAX_HEAD:
+            raise CaptureError('Invalid chunked encoding.')
+          return progress
+        line = self.buffer[:line_end].strip()
+        self.buffer = self.buffer[line_end+1:]
+        if self.state == 'chunk size':
+          try:
+            self.remaining = int(line.split(b';')[0], 16)
+          except ValueError:
+            raise CaptureError('Invalid chunk size: {!r}'.format(line))
+          self.state = 'chunk' if self.remaining else 'trailer'
+        elif self.state == 'chunk end':
+          self.state = 'chunk size'
+        elif not line:
+          # The end of the trailer.
+          self.state = None
+      progress = True
+    return True
+
+  def keep(self, data):
+    if self.body_size < MAX_BODY:
+      self.body.append(data[:MAX_BODY-self.body_size])
+    self.body_size += len(data)
+
+  def finish(self):
+    message = self.message
+    message['body'] = b''.join(self.body)
+    if self.responses:
+      message['body'] = decompress(message['body'], get_header(message['headers'],
+                                                               'Content-Encoding'))
+    self.message = None
+    self.state = None
+    self.body = []
+    return message
+
+
+def decompress(body, encoding):
+  """Decode a body sent with a Content-Encoding. Returns as much as can be decoded."""
+  encoding = (encoding or '').strip().lower()
+  if encoding in ('gzip', 'x-gzip', 'deflate'):
+    # 47 accepts a gzip or zlib header. Some servers send "deflate" without one.
+    for wbits in (47, -zlib.MAX_WBITS):
+      try:
+        return zlib.decompressobj(wbits).decompress(body, MAX_BODY)
+      except zlib.error:
+        pass
+    logging.warning('Could not decode a {} response body.'.format(encoding))
+  return body
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
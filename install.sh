@@ -1,7 +1,7 @@
 #!/usr/bin/env bash
 set -ue
 
-WifiScriptName='wifi-login2.py'
+WifiScriptName='wifi-login-fast.py'
 HookScriptName="90_wifi_login.sh"
 NmHookDir='/etc/NetworkManager/dispatcher.d'
 
@@ -54,9 +54,9 @@ case "$platform" in
 #!/usr/bin/env bash
 # Run when the interface (\$1) starts with "wl" (as in "wlan0" or "wlp2s0") and status (\$2) is "up".
 if [[ \${1:0:2} == wl ]] && [[ \$2 == up ]]; then
-  # Wait 1 second before running the script. If you run it immediately, sometimes the connection
-  # still isn't set up properly and you'll get network errors.
-  python $ScriptDir/$WifiScriptName -w 1
+  # Wait (up to 5 seconds) for the connection to be set up before testing it. If you test it
+  # immediately, sometimes it still isn't set up properly and you'll get network errors.
+  python3 $ScriptDir/$WifiScriptName --wait-ready 5
 fi
 EOF
     sudo chmod 755 $NmHookDir/$HookScriptName
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""What wifi-login2.py and wifi-login-fast.py share: the default locations of their files, and how
+an SSID is looked up in the index of request files. wifi-login-fast.py imports this on every
+network connection, so it only imports what it has to, when it has to."""
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+if os.path.isfile(SCRIPT_DIR):
+  # We're inside a zipapp (see build-zipapp.py). Use the directory it's in.
+  SCRIPT_DIR = os.path.dirname(SCRIPT_DIR)
+REQUEST_DIR_DEFAULT = 'http-login'
+REDIRECT_DIR_DEFAULT = 'http-redirect'
+SILENCE_FILE = '~/.local/share/nbsdata/SILENCE'
+LOGIN_CACHE = '~/.local/share/nbsdata/wifi-login-cache.json'
+# The defaults of the options both scripts understand.
+DEFAULTS = {'request_dir':os.path.join(SCRIPT_DIR, REQUEST_DIR_DEFAULT),
+            'redirect_dir':os.path.join(SCRIPT_DIR, REDIRECT_DIR_DEFAULT), 'cache':LOGIN_CACHE,
+            'cache_ttl':300, 'wait':0, 'wait_ready':0}
+# The index of request files by SSID is cached in a file of this name in the request directory.
+REQUEST_INDEX_NAME = '.index'
+# Increment this whenever the structure of the request index changes.
+REQUEST_INDEX_VERSION = 4
+# Request filenames starting with this are regular expressions to match SSIDs against.
+REGEX_PREFIX = 're:'
+
+
+def get_expected_filenames(ssid):
+  """The names a request file for the SSID can have, besides patterns, in order of preference."""
+  return (ssid, ssid+'.txt', ssid.replace(' ', '-')+'.txt')
+
+
+def find_in_index(index, ssid):
+  """Find the request file for an SSID in a request index (see wifi-login2.py's
+  load_request_index()). Returns its filename, or None."""
+  for expected_filename in get_expected_filenames(ssid):
+    if expected_filename in index['files']:
+      return expected_filename
+    if expected_filename in index['escaped']:
+      return index['escaped'][expected_filename]
+  for candidate in (ssid, ssid.replace(' ', '-')):
+    filename = match_ssid_pattern(index['patterns'], candidate)
+    if filename:
+      return filename
+  return None
+
+
+def match_ssid_pattern(patterns, ssid, chunk_size=50):
+  """Match an SSID against the patterns in a request index, returning the first matching filename.
+  Patterns without groups are combined into a few big alternations so the regex engine can try
+  them all at once. Ones with groups are matched on their own, since in an alternation their group
+  names could clash and their backreferences would point to the wrong groups."""
+  for compiled, filenames in compile_pattern_chunks(tuple(patterns), chunk_size):
+    match = compiled.match(ssid)
+    if match:
+      if len(filenames) == 1:
+        return filenames[0]
+      return filenames[int(match.lastgroup[2:])]
+  return None
+
+
+_pattern_chunks = {}
+def compile_pattern_chunks(patterns, chunk_size):
+  """Compile the patterns for match_ssid_pattern(), in order. Returns a list of (compiled regex,
+  filenames) tuples. Combined regexes name the group each pattern is in by its index in
+  "filenames"."""
+  chunks = _pattern_chunks.get((patterns, chunk_size))
+  if chunks is not None:
+    return chunks
+  import re
+  chunks = []
+  pending = []
+  for i, (regex, filename) in enumerate(patterns):
+    alone = re.compile(regex).groups > 0
+    if not alone:
+      pending.append((regex, filename))
+    if pending and (alone or len(pending) >= chunk_size or i == len(patterns)-1):
+      alternatives = ['(?P<_p{}>{})'.format(j, pattern)
+                      for j, (pattern, name) in enumerate(pending)]
+      chunks.append((re.compile('(?:'+'|'.join(alternatives)+r')\Z'),
+                     [name for pattern, name in pending]))
+      pending = []
+    if alone:
+      chunks.append((re.compile('(?:'+regex+r')\Z'), [filename]))
+  _pattern_chunks[(patterns, chunk_size)] = chunks
+  return chunks
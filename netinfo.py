@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""Look up network interface information directly from the kernel, without running external tools.
+MAC addresses come from sysfs, IP addresses from an ioctl, and wifi SSIDs and access point MACs
+from nl80211 over a generic netlink socket. Everything raises NetinfoError when the kernel interface
+needed isn't available, so callers can fall back to other methods.
+Run this directly to benchmark it against the lib.ipwraplib and lib.maclib functions."""
+from __future__ import division
+from __future__ import print_function
+import os
+import sys
+import time
+import errno
+import fcntl
+import socket
+import select
+import struct
+
+SYSFS_NET = '/sys/class/net'
+SIOCGIFADDR = 0x8915
+PROC_ROUTE = '/proc/net/route'
+PROC_ARP = '/proc/net/arp'
+# Route flags, from linux/route.h, and ARP entry flags, from linux/if_arp.h.
+RTF_UP = 0x1
+RTF_GATEWAY = 0x2
+ATF_COM = 0x2
+# Where solicit_neighbor() sends its datagram. Nothing answers, which is fine.
+DISCARD_PORT = 9
+
+# Netlink constants, from linux/netlink.h, linux/rtnetlink.h, and linux/genetlink.h.
+NETLINK_ROUTE = 0
+NETLINK_GENERIC = 16
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTM_NEWLINK = 16
+RTM_NEWADDR = 20
+IFF_RUNNING = 0x40
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+# nl80211 constants, from linux/nl80211.h.
+NL80211_CMD_GET_INTERFACE = 5
+NL80211_CMD_GET_SCAN = 32
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_IFNAME = 4
+NL80211_ATTR_BSS = 47
+NL80211_ATTR_SSID = 52
+NL80211_BSS_BSSID = 1
+NL80211_BSS_INFORMATION_ELEMENTS = 6
+NL80211_BSS_STATUS = 9
+NL80211_BSS_STATUS_ASSOCIATED = 1
+# The information element holding the SSID, in 802.11 beacons.
+WLAN_EID_SSID = 0
+
+NLMSGHDR = struct.Struct('=IHHII')
+GENLMSGHDR = struct.Struct('=BBH')
+NLATTR = struct.Struct('=HH')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+
+
+class NetinfoError(Exception):
+  pass
+
+
+def list_wireless_interfaces():
+  """Return the names of all wireless interfaces, in sorted order."""
+  try:
+    interfaces = os.listdir(SYSFS_NET)
+  except OSError as error:
+    raise NetinfoError('Could not list {}: {}'.format(SYSFS_NET, error))
+  return sorted(interface for interface in interfaces
+                if os.path.isdir(os.path.join(SYSFS_NET, interface, 'wireless')))
+
+
+def get_mac(interface):
+  """Return the MAC address of an interface, like "00:1a:2b:3c:4d:5e"."""
+  path = os.path.join(SYSFS_NET, interface, 'address')
+  try:
+    with open(path) as address_file:
+      return address_file.read().strip()
+  except IOError as error:
+    raise NetinfoError('Could not read {}: {}'.format(path, error))
+
+
+def get_ip(interface):
+  """Return the IPv4 address of an interface, or None if it doesn't have one."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    # The kernel's limit (IFNAMSIZ, including the null) is in bytes, not characters.
+    request = struct.pack('256s', encode_interface(interface)[:15])
+    response = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)
+  except IOError as error:
+    if error.errno == errno.EADDRNOTAVAIL:
+      return None
+    raise NetinfoError('SIOCGIFADDR failed on {}: {}'.format(interface, error))
+  finally:
+    sock.close()
+  return socket.inet_ntoa(response[20:24])
+
+
+def get_default_gateway(interface):
+  """Return the IPv4 address of the gateway the interface's default route goes through, "0.0.0.0"
+  if the default route has no gateway (it's on-link), or None if the interface has no default
+  route."""
+  for fields in read_proc_table(PROC_ROUTE):
+    # Fields: Iface, Destination, Gateway, Flags, ...
+    if len(fields) < 4 or fields[0] != interface or fields[1] != '00000000':
+      continue
+    flags = int(fields[3], 16)
+    if not flags & RTF_UP:
+      continue
+    if not flags & RTF_GATEWAY:
+      return '0.0.0.0'
+    # The address is in hex, in the machine's byte order.
+    return socket.inet_ntoa(struct.pack('=I', int(fields[2], 16)))
+  return None
+
+
+def get_neighbor_mac(ip, interface):
+  """Return the MAC address the kernel has resolved an IPv4 address to on the interface, from the
+  ARP table, or None if it hasn't (yet)."""
+  for fields in read_proc_table(PROC_ARP):
+    # Fields: IP address, HW type, Flags, HW address, Mask, Device
+    if len(fields) >= 6 and fields[0] == ip and fields[5] == interface:
+      if int(fields[2], 16) & ATF_COM:
+        return fields[3]
+  return None
+
+
+def solicit_neighbor(ip):
+  """Make the kernel resolve the MAC address of an IPv4 address on the local network, by sending it
+  an empty UDP datagram. Errors (like the network being unreachable) are ignored."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    sock.sendto(b'', (ip, DISCARD_PORT))
+  except socket.error:
+    pass
+  finally:
+    sock.close()
+
+
+def read_proc_table(path):
+  """Read one of the tables in /proc/net, as a list of the fields on each line after the header."""
+  try:
+    with open(path) as table_file:
+      return [line.split() for line in table_file.readlines()[1:]]
+  except IOError as error:
+    raise NetinfoError('Could not read {}: {}'.format(path, error))
+
+
+def get_interface_name(index):
+  """Get the name of the interface with the given index."""
+  try:
+    return socket.if_indextoname(index)
+  except AttributeError:
+    # Python 2 doesn't have if_indextoname().
+    for interface in os.listdir(SYSFS_NET):
+      try:
+        with open(os.path.join(SYSFS_NET, interface, 'ifindex')) as ifindex_file:
+          if int(ifindex_file.read()) == index:
+            return interface
+      except (IOError, ValueError):
+        pass
+  except socket.error:
+    pass
+  return None
+
+
+def get_wifi_info(interface=None):
+  """Return a tuple of the wifi interface, the SSID, and the MAC address of the access point.
+  If no interface is given, use the first one that's connected. If not connected, the SSID and
+  access point MAC are None."""
+  with GenericNetlink() as netlink:
+    family = netlink.get_family_id('nl80211')
+    connected = None
+    first = None
+    for attrs in netlink.dump(family, NL80211_CMD_GET_INTERFACE):
+      name = attrs.get(NL80211_ATTR_IFNAME, b'').rstrip(b'\0').decode('ascii')
+      if interface and name != interface:
+        continue
+      ifindex = struct.unpack('=I', attrs[NL80211_ATTR_IFINDEX])[0]
+      bssid, ssid = get_associated_bss(netlink, family, ifindex)
+      # Older kernels don't report the SSID with the interface. Then it has to come from the BSS.
+      ssid = decode_ssid(attrs.get(NL80211_ATTR_SSID, ssid))
+      if first is None:
+        first = (name, None, None)
+      if bssid:
+        connected = (name, ssid, bssid)
+        break
+  if connected:
+    return connected
+  if interface is None and first is None:
+    raise NetinfoError('No nl80211 wireless interfaces found.')
+  return first or (interface, None, None)
+
+
+def encode_interface(interface):
+  """Interface names are bytes to the kernel. In Python 3, encode them the way the OS encodes
+  filenames. In Python 2, they're left as they are."""
+  if isinstance(interface, bytes):
+    return interface
+  return os.fsencode(interface)
+
+
+def decode_ssid(ssid):
+  """SSIDs are raw bytes. In Python 3, decode them the way the OS decodes filenames, with any
+  invalid bytes kept as surrogate escapes, so they can be matched against filenames. In Python 2,
+  they're left as they are."""
+  if ssid is None or isinstance(ssid, str):
+    return ssid
+  return ssid.decode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+def get_associated_bss(netlink, family, ifindex):
+  """Find the access point an interface is associated with, from its scan results.
+  Returns its MAC address and SSID, or (None, None) if not associated."""
+  request_attrs = {NL80211_ATTR_IFINDEX:struct.pack('=I', ifindex)}
+  for attrs in netlink.dump(family, NL80211_CMD_GET_SCAN, request_attrs):
+    if NL80211_ATTR_BSS not in attrs:
+      continue
+    bss = parse_attrs(attrs[NL80211_ATTR_BSS])
+    if NL80211_BSS_STATUS not in bss:
+      continue
+    if struct.unpack('=I', bss[NL80211_BSS_STATUS])[0] != NL80211_BSS_STATUS_ASSOCIATED:
+      continue
+    bssid = ':'.join('{:02x}'.format(byte) for byte in bytearray(bss[NL80211_BSS_BSSID]))
+    ssid = None
+    elements = bss.get(NL80211_BSS_INFORMATION_ELEMENTS, b'')
+    i = 0
+    while i+2 <= len(elements):
+      element_id, length = bytearray(elements[i:i+2])
+      if element_id == WLAN_EID_SSID:
+        ssid = elements[i+2:i+2+length]
+        break
+      i += 2+length
+    return bssid, ssid
+  return None, None
+
+
+class LinkMonitor(object):
+  """Watch for interfaces connecting, using an rtnetlink socket. An interface counts as connecting
+  when its link starts running (it has a carrier, e.g. it associated with an access point) or it
+  gets an IPv4 address."""
+
+  def __init__(self):
+    try:
+      self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+      self.sock.bind((0, RTMGRP_LINK|RTMGRP_IPV4_IFADDR))
+    except (AttributeError, socket.error) as error:
+      raise NetinfoError('Could not open an rtnetlink socket: {}'.format(error))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exception):
+    self.sock.close()
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def wait(self, timeout=None):
+    """Wait for interfaces to connect. Returns the set of names of the ones which did, which is
+    empty if the timeout (in seconds) expired first. Raises an OSError (socket.error on Python 2)
+    with errno ENOBUFS if events came faster than they were read, and some were lost."""
+    if not select.select([self.sock], [], [], timeout)[0]:
+      return set()
+    data = self.sock.recv(65536)
+    interfaces = set()
+    offset = 0
+    while offset+NLMSGHDR.size <= len(data):
+      length, msg_type, msg_flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+      if length < NLMSGHDR.size:
+        break
+      body_offset = offset+NLMSGHDR.size
+      offset += align(length)
+      if msg_type == RTM_NEWLINK:
+        family, type_, index, flags, change = IFINFOMSG.unpack_from(data, body_offset)
+        if not (flags & IFF_RUNNING and change & IFF_RUNNING):
+          continue
+      elif msg_type == RTM_NEWADDR:
+        family, prefixlen, flags, scope, index = IFADDRMSG.unpack_from(data, body_offset)
+        if family != socket.AF_INET:
+          continue
+      else:
+        continue
+      interface = get_interface_name(index)
+      if interface:
+        interfaces.add(interface)
+    return interfaces
+
+
+class GenericNetlink(object):
+  """A minimal generic netlink client, enough to send requests and read dumps."""
+
+  def __init__(self):
+    try:
+      self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+      self.sock.bind((0, 0))
+    except (AttributeError, socket.error) as error:
+      raise NetinfoError('Could not open a generic netlink socket: {}'.format(error))
+    self.seq = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exception):
+    self.sock.close()
+
+  def get_family_id(self, name):
+    attrs = {CTRL_ATTR_FAMILY_NAME:name.encode('ascii')+b'\0'}
+    for reply in self.request(GENL_ID_CTRL, CTRL_CMD_GETFAMILY, attrs, flags=NLM_F_REQUEST):
+      return struct.unpack('=H', reply[CTRL_ATTR_FAMILY_ID])[0]
+    raise NetinfoError('Generic netlink family {} not found.'.format(name))
+
+  def dump(self, family, command, attrs=None):
+    return self.request(family, command, attrs or {}, flags=NLM_F_REQUEST|NLM_F_DUMP)
+
+  def request(self, family, command, attrs, flags):
+    """Send a request and return a list of the replies, each one a dict of its attributes."""
+    self.seq += 1
+    payload = GENLMSGHDR.pack(command, 1, 0) + b''.join(pack_attr(type_, value)
+                                                      for type_, value in attrs.items())
+    header = NLMSGHDR.pack(NLMSGHDR.size+len(payload), family, flags, self.seq, 0)
+    self.sock.send(header+payload)
+    replies = []
+    while True:
+      data = self.sock.recv(65536)
+      offset = 0
+      while offset < len(data):
+        length, msg_type, msg_flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+          raise NetinfoError('Malformed netlink message.')
+        body = data[offset+NLMSGHDR.size:offset+length]
+        offset += align(length)
+        if msg_type == NLMSG_DONE:
+          return replies
+        elif msg_type == NLMSG_ERROR:
+          code = struct.unpack_from('=i', body)[0]
+          if code == 0:
+            return replies
+          raise NetinfoError('Netlink error: {}'.format(os.strerror(-code)))
+        replies.append(parse_attrs(body[GENLMSGHDR.size:]))
+        if not flags & NLM_F_DUMP:
+          return replies
+
+
+def parse_attrs(data):
+  attrs = {}
+  offset = 0
+  while offset+NLATTR.size <= len(data):
+    length, type_ = NLATTR.unpack_from(data, offset)
+    if length < NLATTR.size:
+      break
+    # Mask off the NLA_F_NESTED and NLA_F_NET_BYTEORDER flags.
+    attrs[type_ & 0x3fff] = data[offset+NLATTR.size:offset+length]
+    offset += align(length)
+  return attrs
+
+
+def pack_attr(type_, value):
+  length = NLATTR.size+len(value)
+  return NLATTR.pack(length, type_) + value + b'\0'*(align(length)-length)
+
+
+def align(length):
+  return (length+3) & ~3
+
+
+def main(argv):
+  # Imported here to keep importing this module quick (see wifi-login-fast.py).
+  import argparse
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-i', '--interface',
+    help='The wifi interface to query. Default: the first connected one.')
+  parser.add_argument('-n', '--repeats', type=int, default=100,
+    help='How many times to repeat each lookup. Default: %(default)s.')
+  args = parser.parse_args(argv[1:])
+
+  interface, ssid, wifimac = get_wifi_info(args.interface)
+  print('Interface: {}\nSSID: {}\nAccess point MAC: {}'.format(interface, ssid, wifimac))
+  if interface is None:
+    return 1
+  print('MAC: {}\nIP: {}'.format(get_mac(interface), get_ip(interface)))
+
+  lookups = [
+    ('native wifi info', lambda: get_wifi_info(args.interface)),
+    ('native MAC', lambda: get_mac(interface)),
+    ('native IP', lambda: get_ip(interface)),
+  ]
+  try:
+    from lib import ipwraplib
+    from lib import maclib
+  except ImportError:
+    print('lib submodule not found. Only benchmarking the native lookups.', file=sys.stderr)
+  else:
+    lookups.extend([
+      ('ipwraplib wifi info', ipwraplib.get_wifi_info),
+      ('maclib MAC', maclib.get_mac),
+      ('ipwraplib IP', ipwraplib.get_ip),
+    ])
+  print()
+  for name, lookup in lookups:
+    start = time.time()
+    for i in range(args.repeats):
+      lookup()
+    elapsed = time.time() - start
+    print('{:20s}{:9.3f} ms per lookup'.format(name+':', 1000*elapsed/args.repeats))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -1,9 +1,9 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # Note: This is for connecting to 'NIH-CRC-Patient'
 
-import cookielib
-import httplib
-import urllib
+import http.cookiejar
+import http.client
+import urllib.parse
 import sys
 
 b12 = 'b12-wireless-gateway.cit.nih.gov'
@@ -11,7 +11,7 @@ fernwood = 'fernwood-wireless-gateway.cit.nih.gov'
 
 domain = b12
 
-params = urllib.urlencode(
+params = urllib.parse.urlencode(
   {
     'buttonClicked':'4',
     'redirect_url':'www.nih.gov',
@@ -32,15 +32,15 @@ headers = {
   'Cookie':'ncbi_sid=50C95150116F7891_0000SID',
 }
 
-sys.stderr.write("calling httplib.HTTPConnection()\n")
-conex = httplib.HTTPConnection('www.nsto.co')
+sys.stderr.write("calling http.client.HTTPConnection()\n")
+conex = http.client.HTTPConnection('www.nsto.co')
 sys.stderr.write("calling conex.request()\n")
 conex.request('POST', '/misc/userinfo.cgi', params, headers)
 
 sys.stderr.write("calling conex.getresponse()\n")
 try:
   response = conex.getresponse()
-except Exception, e:
+except Exception:
   sys.stderr.write("Error: Probably a bad status line. Trying a different domain..\n")
   conex.close()
 
@@ -1,12 +1,12 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # Run this when connected to NIH wifi to get internet access. It will
 # automatically check the internet access first and only act if it's blocked.
 # Or, set it to run periodically (or on wake) with the -d argument to check if
 # it's connected to NIH wifi and get access if it is.
 
 import datetime
-import httplib
-import urllib
+import http.client
+import urllib.parse
 import sys
 import os
 import re
@@ -98,7 +98,7 @@ debug_fh.close()
 # send an http request to determine which network we're connected to
 sys.stderr.write("making request to "+TESTSITE+" to determine which wifi "
   +"network you're on\n")
-conex = httplib.HTTPConnection(TESTSITE)
+conex = http.client.HTTPConnection(TESTSITE)
 try:
   conex.request('GET', '/')
 except Exception:
@@ -117,7 +117,7 @@ if location_url is None:
     if (response.getheader('Date') is not None and
       str(response.getheader('Transfer-Encoding')) == 'chunked' and
       str(response.getheader('Server')) == 'Sun-Java-System-Web-Server/7.0'):
-      print "Looks like you're already connected!"
+      print("Looks like you're already connected!")
     else:
       sys.stderr.write("Either you've connected to a novel wifi network "
         +"without the 'Location:' header\nin its response or www.nih.gov has "
@@ -138,24 +138,24 @@ else:
 if domain not in nicknames:
   sys.stderr.write("Error: connected to a new, unrecognized network: "+domain)
   exit()
-print "determined you are connected to "+domain
+print("determined you are connected to "+domain)
 gateway = nicknames[domain]
 
 
 # send accept POST
-conex = httplib.HTTPConnection(domain+ports[gateway])
+conex = http.client.HTTPConnection(domain+ports[gateway])
 sys.stderr.write("sending login HTTP request\n")
 conex.request(
   'POST',
   paths[gateway],
-  urllib.urlencode(params[gateway]),
+  urllib.parse.urlencode(params[gateway]),
   headers[gateway],
 )
 sys.stderr.write("reading response\n")
 try:
   response = conex.getresponse()
   conex.close()
-  print "Login looks successful!"
+  print("Login looks successful!")
 except Exception:
   sys.stderr.write("Error: Probably a bad status line. Trying a different domain..\n")
   conex.close()
\ No newline at end of file
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""A quick-starting front end for wifi-login2.py, for running on every network connection.
+It decides whether there could be anything to do using only cheap imports: it exits right away if
+we're not on wifi, we logged in to this network recently, or the SSID has no request file (and
+portal identification is off). Otherwise, it loads wifi-login2.py and hands over to it, with the
+same arguments. Options it doesn't know about are handed over without looking at anything first.
+When bundled as a zipapp, this is the __main__.py, and the request directories are looked for
+beside the bundle."""
+import os
+import sys
+import time
+import netinfo
+import logincommon
+
+WIFI_SCRIPT = os.path.join(logincommon.SCRIPT_DIR, 'wifi-login2.py')
+DEFAULTS = dict(logincommon.DEFAULTS, identify=True, quiet=False)
+# The options understood here: the ones taking values, and the flags.
+VALUE_OPTIONS = {'-d':'request_dir', '--request-dir':'request_dir', '-i':'redirect_dir',
+                 '--redirect-dir':'redirect_dir', '-k':'cache', '--cache':'cache',
+                 '-t':'cache_ttl', '--cache-ttl':'cache_ttl', '-w':'wait', '--wait':'wait',
+                 '-W':'wait_ready', '--wait-ready':'wait_ready', '-Y':'ready_stats',
+                 '--ready-stats':'ready_stats'}
+FLAG_OPTIONS = {'-I':('identify', False), '--no-identify':('identify', False),
+                '-K':('cache', None), '--no-cache':('cache', None), '-q':('quiet', True),
+                '--quiet':('quiet', True), '-v':('quiet', False), '--verbose':('quiet', False)}
+
+
+def main(argv):
+  options = parse_options(argv[1:])
+  if options is not None:
+    status = quick_check(options)
+    if status is not None:
+      return status
+    if options['wait']:
+      # We've already waited.
+      argv = argv + ['--wait', '0']
+  return hand_over(argv)
+
+
+def parse_options(args):
+  """Parse the arguments, if they're all ones we understand. Returns a dict of options, or None."""
+  options = dict(DEFAULTS)
+  args = list(args)
+  while args:
+    arg = args.pop(0)
+    name, equals, value = arg.partition('=')
+    if name in VALUE_OPTIONS and (equals or args):
+      options[VALUE_OPTIONS[name]] = value if equals else args.pop(0)
+    elif arg in FLAG_OPTIONS:
+      key, value = FLAG_OPTIONS[arg]
+      options[key] = value
+    else:
+      return None
+  try:
+    options['cache_ttl'] = float(options['cache_ttl'])
+    options['wait'] = float(options['wait'])
+    options['wait_ready'] = float(options['wait_ready'])
+  except ValueError:
+    return None
+  return options
+
+
+def quick_check(options):
+  """Decide whether we can exit without wifi-login2.py, doing the same checks it does first.
+  Returns the exit status, or None if wifi-login2.py is needed."""
+  try:
+    interface, ssid, wifimac = netinfo.get_wifi_info()
+    mac = interface and netinfo.get_mac(interface)
+  except netinfo.NetinfoError:
+    # wifi-login2.py may be able to find it with the tools instead.
+    return None
+  if ssid and options['cache'] and is_login_cached(options, '\t'.join((ssid, wifimac or '', mac))):
+    return 0
+  if options['wait']:
+    time.sleep(options['wait'])
+  if not ssid:
+    log(options, 'Error', 'It doesn\'t look like you\'re connected to wifi.')
+    return 1
+  known = has_request_file(options['request_dir'], ssid)
+  if known is None:
+    return None
+  if not known:
+    if options['identify'] and has_redirect_records(options['redirect_dir']):
+      return None
+    log(options, 'Warning', 'Unrecognized SSID "{}". No request record found in directory {}.'
+                            .format(ssid, options['request_dir']))
+    return 0
+  if os.path.exists(os.path.expanduser(logincommon.SILENCE_FILE)):
+    log(options, 'Warning', 'Silence file ({}) exists. Exiting instead of creating network '
+                            'traffic.'.format(logincommon.SILENCE_FILE))
+    return 0
+  return None
+
+
+def has_request_file(request_dir, ssid):
+  """Check whether there's a request file for the SSID, using the index wifi-login2.py keeps, and
+  the same rules as its find_request_file(). Returns None if that can't be told without
+  wifi-login2.py (like if the index is out of date)."""
+  if os.path.isfile(os.path.join(request_dir, ssid+'.txt')):
+    return True
+  import pickle
+  try:
+    mtime = os.stat(request_dir).st_mtime
+    with open(os.path.join(request_dir, logincommon.REQUEST_INDEX_NAME), 'rb') as index_file:
+      version, index = pickle.load(index_file)
+  except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+    return None
+  if version != logincommon.REQUEST_INDEX_VERSION or index['mtime'] != mtime:
+    return None
+  return logincommon.find_in_index(index, ssid) is not None
+
+
+def has_redirect_records(redirect_dir):
+  try:
+    return any(not filename.startswith('.') for filename in os.listdir(redirect_dir))
+  except OSError:
+    return False
+
+
+def is_login_cached(options, key):
+  """A quick version of wifi-login2.py's check of the login cache."""
+  import json
+  try:
+    with open(os.path.expanduser(options['cache'])) as cache_file:
+      entry = json.load(cache_file).get(key)
+  except (OSError, ValueError):
+    return False
+  if not entry:
+    return False
+  if entry.get('login') and entry.get('lease'):
+    expiration = entry['login'] + entry['lease']
+  else:
+    last_good = entry.get('login') or 0
+    if entry.get('clear'):
+      last_good = max(last_good, entry.get('checked') or 0)
+    expiration = last_good + options['cache_ttl']
+  return time.time() < expiration
+
+
+def log(options, level, message):
+  """Print a message like wifi-login2.py's log would, without loading the logging module."""
+  if not (options['quiet'] and level == 'Warning'):
+    print('{}: {}'.format(level, message), file=sys.stderr)
+
+
+def hand_over(argv):
+  """Load wifi-login2.py and run it with the same arguments."""
+  try:
+    # In a zipapp, it's bundled as an importable module.
+    import wifi_login2
+  except ImportError:
+    import importlib.util
+    import importlib.machinery
+    loader = importlib.machinery.SourceFileLoader('wifi_login2', WIFI_SCRIPT)
+    spec = importlib.util.spec_from_loader('wifi_login2', loader)
+    wifi_login2 = importlib.util.module_from_spec(spec)
+    # Register it like an import would, so --compile-all's worker processes can find its functions.
+    sys.modules['wifi_login2'] = wifi_login2
+    loader.exec_module(wifi_login2)
+  return wifi_login2.main(argv)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
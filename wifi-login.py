@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # Run this when connected to NIH wifi to get internet access. It will
 # automatically check the internet access first and only act if it's blocked.
 # Or, set it to run periodically (or on wake) with the -d argument to check if
@@ -10,12 +10,12 @@ import copy
 import uuid
 import errno
 import socket
-import urllib
-import httplib
-import urlparse
+import urllib.parse
+import http.client
 import datetime
 from lib import ipwraplib
 from lib import maclib
+import netinfo
 
 LOG = sys.stderr
 
@@ -76,7 +76,7 @@ post_data = {
   'upmc'    :'email=guestuser%40upmc.com&cmd=authenticate&Login=I+ACCEPT',
   'thecloud':'username=nma.psy%2Btc%40gmail.com&password=blabbitybloo',
   #TODO: Will have to scrape the 'ValidationHash' from the interception page HTML
-  'attwifi' :'aupAgree=1&x=67&y=17&NmdId=489467&ReturnHost=nmd.pennst03.univepa.wayport.net&MacAddr='+urllib.quote(maclib.get_mac().string)+'&IpAddr='+maclib.get_ip()+'&NduMacAddr=&NduPort=&PortType=Wireless&PortDesc=&UseCount=1&PaymentMethod=Passthrough&ChargeAmount=0.00&Style=AWS&vsgpId=&pVersion=2&ValidationHash=ee0d7b169225c151c211ec38a93528e6&origDest=&ProxyHost=&vsgId=1100844&Ip6Addr=&VlanId=24&TunnelIfId=6771040&ts=1412777213'
+  'attwifi' :'aupAgree=1&x=67&y=17&NmdId=489467&ReturnHost=nmd.pennst03.univepa.wayport.net&MacAddr='+urllib.parse.quote(maclib.get_mac().string)+'&IpAddr='+maclib.get_ip()+'&NduMacAddr=&NduPort=&PortType=Wireless&PortDesc=&UseCount=1&PaymentMethod=Passthrough&ChargeAmount=0.00&Style=AWS&vsgpId=&pVersion=2&ValidationHash=ee0d7b169225c151c211ec38a93528e6&origDest=&ProxyHost=&vsgId=1100844&Ip6Addr=&VlanId=24&TunnelIfId=6771040&ts=1412777213'
 }
 
 HEADERS_BASE = {
@@ -111,7 +111,7 @@ headers['nih-b45']['Referer'] = 'http://wlan-gateway-b45-outside.net.nih.gov:81/
 headers['nih-b45']['Cookie']  = 'ncbi_sid=50C95150116F7891_0000SID'
 headers['upmc']['Referer'] = 'http://10.1.123.5/upload/custom/upmc-guest/index.html?cmd=login&switchip=10.1.123.5&mac='+maclib.get_mac().string+'&ip='+ipwraplib.get_ip()+'&essid=%20&apname=tunnel%2020&apgroup=&url=http%3A%2F%2Fgoogle%2Ecom%2F'
 headers['upmc']['Origin']  = 'http://10.1.123.5'
-headers['attwifi']['Referer'] = 'http://nmd.pennst03.univepa.wayport.net/index.adp?MacAddr='+urllib.quote(maclib.get_mac().string)+'&IpAddr='+urllib.quote(ipwraplib.get_ip())+'&Ip6Addr=&vsgpId=&vsgId=1100844&UserAgent=&ProxyHost=&TunnelIfId=6771040&VlanId=24'
+headers['attwifi']['Referer'] = 'http://nmd.pennst03.univepa.wayport.net/index.adp?MacAddr='+urllib.parse.quote(maclib.get_mac().string)+'&IpAddr='+urllib.parse.quote(ipwraplib.get_ip())+'&Ip6Addr=&vsgpId=&vsgId=1100844&UserAgent=&ProxyHost=&TunnelIfId=6771040&VlanId=24'
 headers['attwifi']['Origin']  = 'http://nmd.pennst03.univepa.wayport.net'
 headers['thecloud']['Referer'] = 'https://service.thecloud.net/service-platform/login/'
 headers['thecloud']['Origin'] = 'https://service.thecloud.net'
@@ -144,7 +144,7 @@ def main():
   (content, response) = make_request(TEST_URL)
   if response.status == 200 and content == EXPECTED:
     LOG.write('You look connected. Response from '+TEST_URL+' is as expected.\n')
-    print "connected"
+    print("connected")
     sys.exit(0)
   else:
     LOG.write('Your connection seems intercepted. Response from '+TEST_URL
@@ -164,9 +164,9 @@ def main():
 
   # send accept POST
   if protocol == 'http':
-    conex = httplib.HTTPConnection(domain)
+    conex = http.client.HTTPConnection(domain)
   elif protocol == 'https':
-    conex = httplib.HTTPSConnection(domain)
+    conex = http.client.HTTPSConnection(domain)
   LOG.write("sending login HTTP request\n")
   conex.request(
     'POST',
@@ -179,14 +179,17 @@ def main():
     response = conex.getresponse()
     conex.close()
     LOG.write("Login looks successful!\n")
-    print "connected"
+    print("connected")
   except Exception:
     LOG.write("Error: Login unsuccessful. Maybe a bad status line?\n")
     conex.close()
 
 
-#TODO: replace with ipwraplib.get_wifi_info()
 def get_ssid():
+  try:
+    return netinfo.get_wifi_info()[1]
+  except netinfo.NetinfoError:
+    pass
   for line in os.popen('/sbin/iwconfig wlan0'):
     match = re.search(r'SSID:"([^"]+)"', line)
     if match:
@@ -196,7 +199,7 @@ def get_ssid():
 def make_request(url):
   """Make a request to the given URL and return the result.
   Return values are the returned content and the response object."""
-  url_parsed = urlparse.urlsplit(url)
+  url_parsed = urllib.parse.urlsplit(url)
   domain = url_parsed[1]
   path = url_parsed[2]
   if not path:
@@ -208,9 +211,9 @@ def make_request(url):
   sys.stderr.write("Making request to "+url+" to determine whether "
     "your network access is being intercepted.\n")
   if url.startswith('https://'):
-    conex = httplib.HTTPSConnection(domain)
+    conex = http.client.HTTPSConnection(domain)
   else:
-    conex = httplib.HTTPConnection(domain)
+    conex = http.client.HTTPConnection(domain)
 
   try:
     conex.request('GET', path)
@@ -224,7 +227,8 @@ def make_request(url):
     raise
   try:
     response = conex.getresponse()
-    content = response.read()
+    # Only as much as it takes to tell whether it's the expected content.
+    content = response.read(len(EXPECTED)+1).decode('utf-8', 'replace')
     conex.close()
   except Exception:
     sys.stderr.write("Error: Failed to retrieve response or close connection.\n")
@@ -1,32 +1,137 @@
-#!/usr/bin/env python
-from __future__ import division
-from __future__ import print_function
+#!/usr/bin/env python3
 import os
 import sys
 import time
 import errno
-import socket
+import random
+import contextlib
+import json
+import re
+import pickle
+import asyncio
+import fnmatch
+import hashlib
 import logging
-import httplib
-import urlparse
 import argparse
 import datetime
+import contextvars
 import collections
+import ipaddress
+import multiprocessing
+import urllib.parse
 from lib import ipwraplib
 from lib import maclib
+import netinfo
+import asynchttp
+import asyncdns
+import logincommon
 
-#TODO: There may be security concerns arising from the fact that an SSID can be any sequence of
-#      32 bytes instead of a normal string. Check handling of ssid's through the script.
-#TODO: Allow an SSID wildcard system so that we could, say, match "Fullington - 759" and
-#      "Fullington - 936" to the same request file.
+# SSIDs can be any sequence of 32 bytes. netinfo decodes them the way the OS decodes filenames (with
+# surrogate escapes for invalid bytes), so they match request filenames byte for byte. Request files
+# and response bodies are decoded the same way (see asynchttp.decode()), so no bytes are lost.
 
-SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-REQUEST_DIR_DEFAULT = 'http-login'
-SILENCE_FILE = '~/.local/share/nbsdata/SILENCE'
+# The file locations and option defaults shared with wifi-login-fast.py are in logincommon.
+# Forget networks we haven't seen in this long (in seconds).
+LOGIN_CACHE_MAX_AGE = 30*24*60*60
+PORTAL_STATS = '~/.local/share/nbsdata/wifi-login-portals.json'
+# How many of the latest times until access opened to remember for each portal.
+PORTAL_HISTORY = 10
+# Polling to verify a login starts this many seconds apart, and backs off to VERIFY_MAX_INTERVAL.
+VERIFY_MIN_INTERVAL = 0.2
+VERIFY_MAX_INTERVAL = 2
+VERIFY_BACKOFF = 1.5
+# When we know how long a portal usually takes to open, start polling at this fraction of that.
+VERIFY_HEAD_START = 0.8
+DNS_STATS = '~/.local/share/nbsdata/wifi-login-dns.json'
+# How many addresses to remember for each test URL host, per network and connection state.
+DNS_HISTORY = 16
+# How long the --dns-check waits for an answer before leaving it to the connection test.
+DNS_TIMEOUT = 0.5
+READY_STATS = '~/.local/share/nbsdata/wifi-login-ready.json'
+# How many past readiness times to remember for each network.
+READY_HISTORY = 10
+# When we know how long a network usually takes to be ready, resume checking at this fraction of
+# that. Until then, and after, check this often (in seconds). The checks only read /proc.
+READY_HEAD_START = 0.8
+READY_POLL_INTERVAL = 0.05
+# How often to re-send the datagram that gets the gateway's MAC address resolved.
+READY_SOLICIT_INTERVAL = 1
+# How long the --daemon pauses after an error watching for connections, before trying again.
+DAEMON_ERROR_PAUSE = 1
+# Compiled request files are cached in a file named like this, beside the request file.
+TEMPLATE_CACHE_NAME = '.{}.compiled'
+# In request filenames that aren't regular expressions (see logincommon.REGEX_PREFIX), these
+# stand for raw bytes of the SSID, like "\x2f" for a "/".
+FILENAME_ESCAPE_REGEX = re.compile(rb'\\x([0-9a-fA-F]{2})')
+# The index of portal fingerprints is cached in a file of this name in the redirect directory.
+FINGERPRINT_INDEX_NAME = '.fingerprints'
+# Increment this whenever the way fingerprints are computed changes.
+FINGERPRINT_VERSION = 3
+# Without a matching body, an interception has to match a record in at least this many ways to
+# identify it.
+MIN_WEAK_FINGERPRINTS = 2
+# The most of an interception response body to read when identifying the portal.
+MAX_FINGERPRINT_BODY = 65536
+# The most of a test URL response body to read when checking it against a hash or regex.
+MAX_PROBE_BODY = 1048576
+# How much of a response body to read at a time.
+READ_CHUNK_SIZE = 4096
+# Prefixes for --expected-body values which aren't literal.
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256')
+REGEX_BODY_PREFIX = 're:'
+# For finding <meta http-equiv="refresh" content="1; URL=http://example.com/"> redirects.
+META_TAG_REGEX = re.compile(r'<meta\s[^>]*>', re.IGNORECASE)
+REFRESH_REGEX = re.compile(r'http-equiv\s*=\s*["\']?refresh', re.IGNORECASE)
+REFRESH_URL_REGEX = re.compile(r'content\s*=\s*["\']?[\d.]*\s*;\s*url\s*=\s*([^"\'>]+)',
+                               re.IGNORECASE)
+# Increment this whenever the structure or validation of compiled templates changes, to invalidate
+# old caches.
+TEMPLATE_VERSION = 7
+# Request files can hold a series of requests, separated by lines like this.
+STEP_SEPARATOR = '---'
+SEPARATOR_LINE_REGEX = re.compile(rb'^---\r?(?:\n|\Z)', re.MULTILINE)
+# The request file formats we can read, and the directive that gives the format on the first line.
+# Files without one are format 1.
+REQUEST_FORMATS = (1, 2)
+FORMAT_DIRECTIVE = '@format'
+# What a request method can be (an HTTP "token").
+METHOD_REGEX = re.compile(r"[!#$%&'*+.^_`|~0-9A-Za-z-]+\Z")
+# Lines starting with this, before the first line of a request, are directives for that step.
+DIRECTIVE_PREFIX = '@'
+EXTRACT_SOURCES = ('form', 'body', 'header', 'location', 'cookie')
+# How many redirects an "@follow" directive follows, if it doesn't say.
+MAX_REDIRECTS = 5
+# How many verified logins a request file marked "@speculative" needs before --speculative uses it.
+SPECULATIVE_MIN_VERIFIED = 1
+# The filters that can be applied to placeholder values, like "${mac|upper|urlencode}".
+PLACEHOLDER_FILTERS = {
+  'upper': lambda value: value.upper(),
+  'lower': lambda value: value.lower(),
+  'nocolons': lambda value: value.replace(':', ''),
+  'urlencode': lambda value: urllib.parse.quote(value, safe=''),
+  'formencode': lambda value: urllib.parse.quote_plus(value, safe=''),
+}
+# Placeholder names that stand for another with filters applied.
+PLACEHOLDER_ALIASES = {'MAC':('mac', ('upper',))}
+# How many random bytes a ${nonce} has (it's written in hex).
+NONCE_BYTES = 8
+INPUT_TAG_REGEX = re.compile(r'<input\s[^>]*>', re.IGNORECASE)
+TAG_ATTR_REGEX = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+HTML_ENTITIES = (('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'), ('&#39;', "'"), ('&amp;', '&'))
+# How long to wait before retrying when we couldn't even connect (the network isn't ready yet).
+CONNECT_RETRY_PAUSE = 0.2
+# The probes run by --multi-probe, in addition to the --test-url.
+PROBES = (
+  {'url':'http://www.gstatic.com/generate_204', 'status':204, 'body':''},
+  {'url':'https://www.google.com/generate_204', 'status':204, 'body':''},
+)
 
-ARG_DEFAULTS = {'request_dir':os.path.join(SCRIPT_DIR, REQUEST_DIR_DEFAULT), 'log':sys.stderr,
-                'log_level':logging.WARNING, 'test_url':'http://www.gstatic.com/generate_204',
-                'expected_status':204, 'expected_body':'', 'wait':0, 'retries':2, 'retry_pause':0.5}
+ARG_DEFAULTS = {'log':sys.stderr, 'log_level':logging.WARNING,
+                'test_url':'http://www.gstatic.com/generate_204', 'expected_status':204,
+                'expected_body':'', 'retries':2, 'retry_pause':0.5, 'max_pause':8, 'timeout':3,
+                'deadline':30, 'metrics_format':'json', 'backend':'auto', 'verify_time':15,
+                'portal_stats':PORTAL_STATS, 'dns_stats':DNS_STATS, 'ready_stats':READY_STATS}
+ARG_DEFAULTS.update(logincommon.DEFAULTS)
 USAGE = "%(prog)s [options]"
 DESCRIPTION = """Automatically log in to wifi networks which prevent access until you accept their
 terms of service, provide an email address, etc. First, log in normally and capture the HTTP request
@@ -43,12 +148,44 @@ def main(argv):
     help='A text file containing the full HTTP request that grants access.')
   parser.add_argument('-d', '--request-dir',
     help='The directory containing records of the HTTP requests. Default: %(default)s (A directory '
-         'named '+REQUEST_DIR_DEFAULT+' under the script\'s directory).')
+         'named '+logincommon.REQUEST_DIR_DEFAULT+' under the script\'s directory).')
+  parser.add_argument('-i', '--redirect-dir',
+    help='The directory containing records of the responses portals intercept connections with. '
+         'When the SSID is unrecognized, the response to the connection test is compared to these '
+         'to identify the portal. A record named [name].txt identifies the portal whose login '
+         'request is named [name].txt in the --request-dir. Default: %(default)s.')
+  parser.add_argument('-I', '--no-identify', dest='redirect_dir', action='store_const', const=None,
+    help='Don\'t try to identify portals on unrecognized SSIDs.')
   parser.add_argument('-c', '--check-request', action='store_true',
     help='Just check the request file for validity; don\'t try to test the connection or log in. '
          'This will print any errors found in the request file, then print out the request so you '
          'can see if the parser understood it properly. All placeholders will be replaced with '
          'their current values.')
+  parser.add_argument('-C', '--compile-all', action='store_true',
+    help='Check every request file in the --request-dir and response record in the '
+         '--redirect-dir, in parallel, then exit. Valid request files are compiled and cached '
+         'beside them, so future logins don\'t have to parse them. Prints every error found, with '
+         'its line number, and a summary.')
+  parser.add_argument('-j', '--jobs', type=int,
+    help='The number of processes to use for --compile-all. Default: one per CPU.')
+  parser.add_argument('-N', '--manifest',
+    help='With --compile-all, write a JSON description of every file checked, with any errors, to '
+         'this file.')
+  parser.add_argument('-a', '--daemon', action='store_true',
+    help='Keep running, and try to log in whenever a wifi interface connects or gets an address '
+         '(as reported by rtnetlink), instead of just once. The --wait is used as the time to let '
+         'the connection settle after a change before acting on it.')
+  parser.add_argument('-A', '--all-interfaces', action='store_true',
+    help='Log in on every wireless interface at once, each on its own network. The requests for '
+         'each one are sent out through that interface.')
+  parser.add_argument('-f', '--interface', dest='interfaces', action='append',
+    help='Log in on this wireless interface, sending the requests out through it. Give this more '
+         'than once to log in on several interfaces at once.')
+  parser.add_argument('-P', '--speculative', action='store_true',
+    help='For request files marked with an "@speculative" directive, which have logged in '
+         'successfully before, send the login at the same time as the connection test instead of '
+         'waiting for the test to say it\'s needed. Only mark request files whose requests are '
+         'harmless to repeat while already logged in, like accepting terms of service.')
   parser.add_argument('-S', '--skip-test', action='store_true',
     help='Skip the connection test and assume we need to log in.')
   parser.add_argument('-u', '--test-url',
@@ -58,13 +195,80 @@ def main(argv):
     help='The HTTP status code expected in response to the test url. Default: %(default)s.')
   #TODO: Allow a None body.
   parser.add_argument('-b', '--expected-body',
-    help='The body of the expected response to the test url. Default: "%(default)s".')
+    help='The body of the expected response to the test url. Default: "%(default)s". Can also be '
+         'a hash of the body, like "sha1:[hex digest]" ('+', '.join(HASH_ALGORITHMS)+' are '
+         'supported), or "re:[regex]" to require a line of the body to match a regular '
+         'expression.')
+  parser.add_argument('-m', '--multi-probe', action='store_true',
+    help='Test the connection with several probes at once instead of just the --test-url: '
+         +', '.join([probe['url'] for probe in PROBES])+', plus the --test-url. Decide as soon as '
+         'a --quorum of them agree.')
+  parser.add_argument('-Q', '--quorum', type=int,
+    help='How many probes have to agree before --multi-probe decides whether the connection is '
+         'clear. Default: a majority of the probes.')
+  parser.add_argument('-n', '--dns-check', action='store_true',
+    help='Before the connection test, look up the --test-url\'s host with a single DNS query, and '
+         'compare the answer to the ones seen on past runs. If it\'s an address only ever seen '
+         'while connections were intercepted (a portal hijacking DNS), or one only seen on this '
+         'network while it was clear, skip the connection test. Otherwise, the test decides, and '
+         'its result is remembered along with the answer.')
+  parser.add_argument('-g', '--dns-stats',
+    help='The file to remember DNS answers in for --dns-check. Default: %(default)s.')
   parser.add_argument('-w', '--wait', type=float,
     help='The amount of time to wait before execution, in seconds. Default: %(default)s.')
+  parser.add_argument('-W', '--wait-ready', type=float,
+    help='Before the connection test, wait up to this many seconds for the network to be ready: '
+         'the interface has an IP address (its DHCP lease), a default route, and the gateway\'s '
+         'MAC address resolves. How long that took is remembered for each network, and used to '
+         'time the checks next time. If it isn\'t ready in time, test anyway. Default: '
+         '%(default)s (don\'t wait).')
+  parser.add_argument('-Y', '--ready-stats',
+    help='The file to record how long each network takes to be ready in, for --wait-ready. '
+         'Default: %(default)s.')
   parser.add_argument('-r', '--retries', type=int,
     help='The number of times to retry an HTTP request if it fails. Default: %(default)s.')
   parser.add_argument('-R', '--retry-pause', type=float,
-    help='The number of seconds to wait between HTTP request retries. Default: %(default)s.')
+    help='The number of seconds to wait before the first retry of an HTTP request that got a bad '
+         'response. Each further retry waits twice as long as the last (with some randomness). '
+         'Default: %(default)s.')
+  parser.add_argument('-M', '--max-pause', type=float,
+    help='The longest to wait between retries, in seconds. Default: %(default)s.')
+  parser.add_argument('-T', '--timeout', type=float,
+    help='Give up on an HTTP request attempt after this many seconds. Default: %(default)s.')
+  parser.add_argument('-e', '--deadline', type=float,
+    help='Stop retrying this many seconds after starting to test the connection. Failures to even '
+         'connect (usually because the network isn\'t ready yet) are retried quickly until this '
+         'deadline, without counting against the --retries. Default: %(default)s.')
+  parser.add_argument('-k', '--cache',
+    help='The file to record logins in. If we logged in to the same network (SSID, access point '
+         'MAC, and client MAC) recently enough that the login should still be valid, exit without '
+         'touching the network. Default: %(default)s.')
+  parser.add_argument('-K', '--no-cache', dest='cache', action='store_const', const=None,
+    help='Don\'t read or write the login cache.')
+  parser.add_argument('-t', '--cache-ttl', type=float,
+    help='How long, in seconds, to trust a past login or connection test when we haven\'t yet '
+         'observed how long this network\'s logins last. Default: %(default)s.')
+  parser.add_argument('-V', '--verify-time', type=float,
+    help='After logging in, poll the --test-url for up to this many seconds until access opens. '
+         'Portals often take a few seconds after accepting the login to let traffic through. The '
+         'time it took is remembered for each portal, and used to time the polling next time. '
+         'If access is still blocked after it, the exit status is 2. Give 0 to skip verifying. '
+         'Default: %(default)s.')
+  parser.add_argument('-p', '--portal-stats',
+    help='The file to record how long each portal takes to open after a login. '
+         'Default: %(default)s.')
+  parser.add_argument('-B', '--backend', choices=('auto', 'native', 'tools'),
+    help='How to look up the SSID, MAC address, etc. "native" asks the kernel directly (sysfs, '
+         'ioctl, and nl80211). "tools" uses the lib submodule, which runs external commands. '
+         '"auto" tries native first and falls back to tools. Default: %(default)s.')
+  parser.add_argument('-x', '--metrics',
+    help='Write timings of each phase of the run to this file. Phases include the --wait, the '
+         '--wait-ready, the SSID lookup, finding and parsing the request file, and each attempt at '
+         'the connection test and login request.')
+  parser.add_argument('-X', '--metrics-format', choices=('json', 'prometheus'),
+    help='"json" appends a JSON object for each run to the --metrics file, one per line. '
+         '"prometheus" keeps the --metrics file up to date in the format read by the Prometheus '
+         'node exporter\'s textfile collector, with counters per SSID. Default: %(default)s.')
   parser.add_argument('-q', '--quiet', dest='log_level', action='store_const', const=logging.ERROR,
     help='Print messages only on terminal errors.')
   parser.add_argument('-v', '--verbose', dest='log_level', action='store_const', const=logging.INFO,
@@ -85,7 +289,13 @@ def main(argv):
     log_level = logging.WARNING
   else:
     log_level = args.log_level
-  logging.basicConfig(stream=args.log, level=log_level, format='%(levelname)s: %(message)s')
+  if args.all_interfaces or args.interfaces:
+    log_format = '%(levelname)s: %(interface)s: %(message)s'
+  else:
+    log_format = '%(levelname)s: %(message)s'
+  logging.basicConfig(stream=args.log, level=log_level, format=log_format)
+  for handler in logging.getLogger().handlers:
+    handler.addFilter(InterfaceLogFilter())
   tone_down_logger()
 
   # Print a starting timestamp to the log.
@@ -93,121 +303,1624 @@ def main(argv):
   now_time = int(time.mktime(now_dt.timetuple()))
   logging.info('Started at {} ({})'.format(str(now_dt)[:19], now_time))
 
+  if args.compile_all:
+    return compile_request_dir(args.request_dir, args.redirect_dir, args.manifest, args.jobs)
+
+  if args.daemon:
+    return run_daemon(args)
+
+  if args.all_interfaces or args.interfaces:
+    if args.all_interfaces:
+      interfaces = netinfo.list_wireless_interfaces()
+    else:
+      interfaces = args.interfaces
+    if not interfaces:
+      logging.error('No wireless interfaces found.')
+      return 1
+    return asyncio.run(login_interfaces(args, interfaces))
+
+  metrics = Metrics()
+  result = asyncio.run(login_interface(args, metrics=metrics))
+  if args.metrics:
+    metrics.write(args.metrics, args.metrics_format)
+  return result
+
+
+async def login(args, sysinfo, pool, templates=None, metrics=None):
+  """Check whether we need to log in to the current network and, if so, send the request.
+  "templates" can be a dict to hold compiled request files in memory between calls (see
+  load_request_template()). "metrics" is a Metrics object to record the timing of each phase in.
+  Returns the exit status: 0 if there was nothing to do or the login worked, 1 if something failed,
+  or 2 if we logged in but access was still blocked after --verify-time."""
+  metrics = metrics or Metrics()
+  start = time.time()
+
+  # Exit early if we logged in to this network recently enough that the login should still be valid.
+  # With --skip-test, we were told to log in regardless, but the login still gets recorded.
+  cache_key = None
+  if args.cache and not (args.request or args.check_request):
+    with metrics.phase('cache'):
+      cache_key = get_login_cache_key(sysinfo)
+      cached = cache_key and not args.skip_test and is_login_cached(args.cache, cache_key,
+                                                                    args.cache_ttl)
+    if cached:
+      logging.info('Already logged in to this network within its login lifetime. Exiting.')
+      metrics.finish('cached', ssid=sysinfo.ssid)
+      return 0
+
   # Pause before execution, if requested.
   if args.wait:
     logging.debug('Pausing {} seconds as requested by --wait option..'.format(args.wait))
-    time.sleep(args.wait)
+    with metrics.phase('wait'):
+      await asyncio.sleep(args.wait)
 
   # Find the file containing a record of an HTTP request which grants access to this wifi network.
   if args.request:
     request_file = args.request
   else:
-    ssid = ipwraplib.get_wifi_info()[1]
+    with metrics.phase('ssid'):
+      ssid = sysinfo.ssid
+    metrics.ssid = ssid
     if not ssid:
-      fail('It doesn\'t look like you\'re connected to wifi.')
-    request_file = find_request_file(args.request_dir, ssid)
+      logging.error('It doesn\'t look like you\'re connected to wifi.')
+      metrics.finish('disconnected')
+      return 1
+    with metrics.phase('find_request_file'):
+      request_file = find_request_file(args.request_dir, ssid)
     if request_file:
       logging.debug('Located request file "{}".'.format(request_file))
+    elif args.redirect_dir and not (args.check_request or args.skip_test):
+      logging.info('Unrecognized SSID "{}". Will try to identify the portal instead.'.format(ssid))
     else:
-      logging.warn('Unrecognized SSID "{}". No request record found in directory {}.'
-                   .format(ssid, args.request_dir))
+      logging.warning('Unrecognized SSID "{}". No request record found in directory {}.'
+                      .format(ssid, args.request_dir))
+      metrics.finish('unrecognized')
       return 0
 
-  # Read the request file.
-  with open(request_file) as request:
-    headers, method, path, protocol, post_data = parse_request_file(request)
-
   if args.check_request:
-    return
+    return check_request_file(request_file, sysinfo)
+
+  # Read the request file.
+  if request_file:
+    with metrics.phase('parse_request_file'):
+      template = load_request_template(request_file, templates)
 
   # Exit if we're not supposed to be network-silent right now.
-  if os.path.exists(os.path.expanduser(SILENCE_FILE)):
-    logging.warn('Silence file ({}) exists. Exiting instead of creating network traffic.'
-                 .format(SILENCE_FILE))
+  if os.path.exists(os.path.expanduser(logincommon.SILENCE_FILE)):
+    logging.warning('Silence file ({}) exists. Exiting instead of creating network traffic.'
+                    .format(logincommon.SILENCE_FILE))
+    metrics.finish('silenced')
     return 0
 
+  # Wait for the network to be set up enough for the connection test to get anywhere.
+  if args.wait_ready and sysinfo.interface:
+    ssid = sysinfo.ssid
+    history = read_ready_stats(args.ready_stats).get(ssid, {}).get('ready')
+    with metrics.phase('wait_ready'):
+      ready, waited = await wait_until_ready(sysinfo.interface, start, args.wait_ready, history)
+    if ready is None and waited:
+      logging.info('Network still not ready after {} seconds. Testing anyway.'
+                   .format(args.wait_ready))
+    elif ready is not None and waited and ssid:
+      logging.debug('Network ready {:0.2f} seconds after starting.'.format(ready))
+      record_ready_time(args.ready_stats, ssid, ready)
+
   # Check if our connection is being intercepted by the wifi access point.
-  #TODO: Check where the intercepted response is redirecting us, if it is ("Location" header).
+  deadline = time.time() + args.deadline
+  interception = {}
+  expected = {'status':args.expected_status, 'body':args.expected_body}
+  if args.multi_probe:
+    probes = [probe for probe in PROBES if probe['url'] != args.test_url]
+    probes.append(dict(expected, url=args.test_url))
+    quorum = args.quorum or len(probes)//2 + 1
+    check = lambda timeout: probe_concurrently(probes, quorum, timeout=timeout, pool=pool,
+                                               interception=interception)
+  else:
+    check = lambda timeout: is_connection_clear(args.test_url, expected, timeout, pool=pool,
+                                                interception=interception)
+  login_task = None
+  dns_answer = verdict = None
   if not args.skip_test:
-    expected = {'status':args.expected_status, 'body':args.expected_body}
-    tries_left = args.retries + 1
-    clear = False
-    while tries_left > 0:
+    # A DNS answer can settle it with one UDP round trip. But an unrecognized portal still has to
+    # be identified from how it intercepts the HTTP test.
+    if args.dns_check:
+      with metrics.phase('dns_check'):
+        dns_answer, verdict = await check_dns(args.test_url, sysinfo.ssid, args.dns_stats, pool)
+    if verdict == 'clear' or (verdict == 'intercepted' and request_file):
+      logging.info('DNS answer says the connection is {}. Skipping the connection test.'
+                   .format(verdict))
+      clear = verdict == 'clear'
+    else:
+      # If the portal's login is safe to repeat, don't wait for the test to say it's needed.
+      if args.speculative and request_file and can_speculate(template, request_file,
+                                                             args.portal_stats):
+        logging.info('Sending the login request along with the connection test.')
+        schedule = RetrySchedule(args.retries, args.retry_pause, args.max_pause, args.timeout,
+                                 deadline)
+        login_task = asyncio.ensure_future(send_login(template, sysinfo, pool, schedule, metrics))
+      schedule = RetrySchedule(args.retries, args.retry_pause, args.max_pause, args.timeout,
+                               deadline)
       try:
-        clear = is_connection_clear(args.test_url, expected)
-        tries_left = 0
-      except (socket.error, httplib.HTTPException) as e:
-        logging.warn('Test connection failure. Raised a {}: {}'.format(type(e).__name__, e))
-        tries_left -= 1
-        time.sleep(args.retry_pause)
+        clear = await call_with_retries(check, schedule, 'Test connection', metrics,
+                                        'is_connection_clear')
+      except asynchttp.NETWORK_ERRORS:
+        clear = None
+      if (clear and login_task and login_task.done() and not login_task.cancelled()
+          and login_task.exception() is None):
+        # The login may be what let the test through, so the test can't say whether it was needed.
+        # Don't throw it away: verify and record it like any other login.
+        logging.info('The login finished before the connection test did. Keeping it.')
+        clear = None
+      if dns_answer and clear is not None:
+        record_dns_answer(args.dns_stats, sysinfo.ssid, dns_answer, clear,
+                          interception.get('address'))
+    if cache_key and clear is not None:
+      record_in_login_cache(args.cache, cache_key, clear=clear)
     if clear:
+      if login_task:
+        login_task.cancel()
+        await asyncio.gather(login_task, return_exceptions=True)
       logging.info('Looks like you\'re already connected!')
+      metrics.finish('clear')
+      return 0
+
+  # If the SSID was unrecognized, identify the portal from how it intercepted the connection test.
+  if not request_file:
+    with metrics.phase('identify_portal'):
+      request_file = identify_portal(interception, args.redirect_dir, args.request_dir)
+    if not request_file:
+      logging.warning('Unrecognized SSID "{}" and portal. No request record found.'.format(ssid))
+      metrics.finish('unrecognized')
       return 0
+    logging.info('Identified the portal. Using request file "{}".'.format(request_file))
+    with metrics.phase('parse_request_file'):
+      template = load_request_template(request_file, templates)
+
+  # Make the HTTP request(s) to (hopefully) grant access, unless they're already on their way.
+  try:
+    if login_task:
+      logged_in = await login_task
+    else:
+      schedule = RetrySchedule(args.retries, args.retry_pause, args.max_pause, args.timeout,
+                               deadline)
+      logged_in = await send_login(template, sysinfo, pool, schedule, metrics)
+  except asynchttp.NETWORK_ERRORS:
+    metrics.finish('failed')
+    return 1
+
+  # Make sure the login worked, by waiting for the connection test to get through.
+  if args.verify_time:
+    portal = os.path.basename(request_file)
+    stats = read_portal_stats(args.portal_stats).get(portal, {})
+    opened = await verify_access(check, args.verify_time, args.timeout, stats.get('opened'),
+                                 metrics, logged_in)
+    record_portal_login(args.portal_stats, portal, opened)
+    if opened is None:
+      logging.warning('Logged in, but access was still blocked after {} seconds.'
+                      .format(args.verify_time))
+      metrics.finish('unverified')
+      return 2
+    logging.info('Access opened {:0.2f} seconds after logging in.'.format(opened))
+  if cache_key:
+    record_in_login_cache(args.cache, cache_key, login=True)
+  metrics.finish('login')
+  # If we skipped the connection test because of the DNS answer, nothing checked that verdict.
+  # Now that the connection is clear, teach the DNS stats what a clear answer looks like, so a
+  # wrong "intercepted" verdict doesn't keep repeating.
+  if verdict == 'intercepted' and args.verify_time:
+    dns_answer, verdict = await check_dns(args.test_url, sysinfo.ssid, args.dns_stats, pool)
+    if dns_answer:
+      record_dns_answer(args.dns_stats, sysinfo.ssid, dns_answer, True)
+  return 0
+
+
+async def send_login(template, sysinfo, pool, schedule, metrics=None):
+  """Make the login request(s) in the template, retrying as the RetrySchedule says. If it takes
+  more than one, a failure at any step retries all of them, from the first. Returns the time they
+  finished."""
+  await call_with_retries(lambda timeout: make_request_steps(template, sysinfo, pool, timeout),
+                          schedule, 'Request', metrics, 'make_request')
+  return time.time()
+
 
-  # Make the HTTP request to (hopefully) grant access.
-  tries_left = args.retries + 1
-  while tries_left > 0:
+def can_speculate(template, request_file, stats_path):
+  """Decide whether the request file can be sent before the connection test says it's needed. It
+  has to be marked "@speculative", and have logged in successfully SPECULATIVE_MIN_VERIFIED
+  times."""
+  if not template.get('speculative'):
+    return False
+  stats = read_portal_stats(stats_path).get(os.path.basename(request_file), {})
+  if stats.get('verified', 0) < SPECULATIVE_MIN_VERIFIED:
+    logging.debug('Request file is marked @speculative, but hasn\'t logged in successfully '
+                  'enough times yet.')
+    return False
+  return True
+
+
+async def verify_access(check, verify_time, timeout, history=None, metrics=None, start=None):
+  """Poll with check(timeout) until it says the connection is clear, for up to "verify_time"
+  seconds after "start" (the time of the login, default now). "history" is a list of how long the
+  portal took to open before (in seconds), if known. Polling starts at VERIFY_HEAD_START of the
+  median of those, then happens every VERIFY_MIN_INTERVAL seconds, backing off to
+  VERIFY_MAX_INTERVAL. Returns how long it took for the connection to clear, or None if it didn't
+  in time."""
+  metrics = metrics or Metrics()
+  start = start or time.time()
+  deadline = start + verify_time
+  if history:
+    delay = VERIFY_HEAD_START * sorted(history)[len(history)//2]
+    logging.debug('Portal usually opens in {:0.2f}s. Polling in {:0.2f}s.'
+                  .format(sorted(history)[len(history)//2], delay))
+    await asyncio.sleep(max(0, min(start + delay, deadline) - time.time()))
+  interval = VERIFY_MIN_INTERVAL
+  while True:
     try:
-      make_request(headers, method, path, protocol, post_data)
-      tries_left = 0
-    except (socket.error, httplib.HTTPException) as e:
-      logging.warn('Request failure. Raised a {}: {}'.format(type(e).__name__, e))
-      tries_left -= 1
-      time.sleep(args.retry_pause)
+      with metrics.phase('verify'):
+        clear = await check(max(CONNECT_RETRY_PAUSE, min(timeout, deadline - time.time())))
+    except asynchttp.NETWORK_ERRORS as error:
+      logging.debug('Verification probe failed: {}'.format(error))
+      clear = False
+    now = time.time()
+    if clear:
+      return now - start
+    if now + interval > deadline:
+      return None
+    await asyncio.sleep(interval)
+    interval = min(interval * VERIFY_BACKOFF, VERIFY_MAX_INTERVAL)
+
+
+async def wait_until_ready(interface, start, timeout, history=None):
+  """Wait until the interface looks ready for the connection test: it has an IPv4 address, a
+  default route, and the gateway's MAC address has been resolved. "start" is the time to measure
+  from, and "history" is a list of how long (in seconds since the start) this network took to be
+  ready before, if known. If it isn't ready at first, the checks resume at READY_HEAD_START of the
+  median of those, then happen every READY_POLL_INTERVAL seconds.
+  Returns a tuple: how long it took to be ready (or None if it wasn't "timeout" seconds after
+  starting to wait), and whether we had to wait at all."""
+  deadline = time.time() + timeout
+  solicited = gateway = None
+  checks = 0
+  while True:
+    checks += 1
+    try:
+      missing = None
+      if not netinfo.get_ip(interface):
+        missing = 'an IP address'
+      else:
+        gateway = netinfo.get_default_gateway(interface)
+        if gateway is None:
+          missing = 'a default route'
+        elif gateway != '0.0.0.0' and not netinfo.get_neighbor_mac(gateway, interface):
+          missing = 'the gateway\'s MAC address'
+          # The kernel only resolves it when something is sent to it. So send something.
+          if solicited is None or time.time() - solicited >= READY_SOLICIT_INTERVAL:
+            netinfo.solicit_neighbor(gateway)
+            solicited = time.time()
+    except netinfo.NetinfoError as error:
+      logging.warning('Could not tell whether the network is ready: {}'.format(error))
+      return None, False
+    now = time.time()
+    if missing is None:
+      return now - start, checks > 1
+    if checks == 1:
+      logging.debug('Waiting for {} on {}.'.format(missing, interface))
+    if now + READY_POLL_INTERVAL > deadline:
+      logging.debug('Still waiting for {}.'.format(missing))
+      return None, True
+    delay = READY_POLL_INTERVAL
+    if checks == 1 and history:
+      usual = sorted(history)[len(history)//2]
+      delay = max(delay, min(start + READY_HEAD_START*usual - now, deadline - now))
+      logging.debug('Network is usually ready in {:0.2f}s. Checking again in {:0.2f}s.'
+                    .format(usual, delay))
+    await asyncio.sleep(delay)
+
+
+def run_daemon(args):
+  """Wait for wifi interfaces to connect, and run login() each time one does.
+  Compiled request files stay in memory between logins, but everything learned about the system
+  and network (SSID, addresses, DNS, connections) is looked up fresh each time. Each login gets its
+  own event loop, so nothing from one can hold up the next."""
+  templates = {}
+  login_args = argparse.Namespace(**vars(args))
+  login_args.wait = 0
+  with netinfo.LinkMonitor() as monitor:
+    logging.info('Watching for wifi connections..')
+    # Try right away, in case we're already connected. None means to try every wifi interface.
+    interfaces = None
+    while True:
+      try:
+        if interfaces is None:
+          interfaces = set(netinfo.list_wireless_interfaces())
+        if interfaces:
+          # Let the connection settle, and gather any further events in the meantime.
+          while True:
+            more_interfaces = monitor.wait(args.wait or 0)
+            if not more_interfaces:
+              break
+            interfaces |= more_interfaces
+          wireless = interfaces & set(netinfo.list_wireless_interfaces())
+          if wireless:
+            logging.info('Wifi interface {} connected. Checking connection..'
+                         .format(', '.join(sorted(wireless))))
+            if len(wireless) > 1:
+              asyncio.run(login_interfaces(login_args, sorted(wireless), templates))
+            else:
+              metrics = Metrics()
+              asyncio.run(login_interface(login_args, None, templates, metrics))
+              if args.metrics:
+                metrics.write(args.metrics, args.metrics_format)
+        interfaces = monitor.wait()
+      except (OSError, netinfo.NetinfoError) as error:
+        logging.warning('Error watching for wifi connections: {}'.format(error))
+        if getattr(error, 'errno', None) == errno.ENOBUFS:
+          # The kernel dropped link events, so any interface could have connected unseen.
+          interfaces = None
+        else:
+          interfaces = set()
+        time.sleep(DAEMON_ERROR_PAUSE)
+
+
+async def login_interfaces(args, interfaces, templates=None):
+  """Run login() for each of several interfaces at once, each in its own task. Each gets its own
+  SystemInfo and ConnectionPool, both tied to its interface, so its requests go out through it.
+  Returns the highest exit status of the logins."""
+  metrics = [Metrics() for interface in interfaces]
+  results = await asyncio.gather(*[login_interface(args, interface, templates, interface_metrics)
+                                   for interface, interface_metrics in zip(interfaces, metrics)])
+  if args.metrics:
+    for interface_metrics in metrics:
+      interface_metrics.write(args.metrics, args.metrics_format)
+  return max(result or 0 for result in results)
+
+
+# The interface the current task is logging in on, for the log (see InterfaceLogFilter).
+_log_interface = contextvars.ContextVar('interface', default=None)
+async def login_interface(args, interface=None, templates=None, metrics=None):
+  """Run login() with a SystemInfo and ConnectionPool for the "interface" (or the first connected
+  one, if None). Connections are closed once it's done. Errors are logged, and return 1."""
+  _log_interface.set(interface)
+  pool = asynchttp.ConnectionPool(interface)
+  try:
+    return await login(args, SystemInfo(args.backend, interface), pool, templates, metrics)
+  except Exception:
+    logging.exception('Login attempt failed.')
+    return 1
+  finally:
+    pool.close()
+
+
+class InterfaceLogFilter(logging.Filter):
+  """Give log records an "interface" attribute: the interface of the login they came from."""
+
+  def filter(self, record):
+    record.interface = _log_interface.get() or '-'
+    return True
+
+
+class Metrics(object):
+  """Timings of the phases of a run, and its outcome, for the --metrics file."""
+
+  def __init__(self):
+    self.start = time.time()
+    self.ssid = None
+    self.result = None
+    self.elapsed = None
+    self.phases = []
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    """Time the code in a "with" block as a phase of the run. Phases can be repeated (like retried
+    requests), and each repetition is recorded as a separate attempt."""
+    start = time.time()
+    success = False
+    try:
+      yield
+      success = True
+    finally:
+      elapsed = time.time() - start
+      self.phases.append({'phase':name, 'seconds':elapsed, 'success':success})
+      logging.debug('Phase {} took {:0.3f}s.'.format(name, elapsed))
+
+  def finish(self, result, ssid=None):
+    self.result = result
+    self.ssid = ssid or self.ssid
+    self.elapsed = time.time() - self.start
+
+  def get_attempts(self):
+    """Count the attempts at each phase. Returns a dict mapping phase names to counts."""
+    attempts = collections.OrderedDict()
+    for phase in self.phases:
+      attempts[phase['phase']] = attempts.get(phase['phase'], 0) + 1
+    return attempts
+
+  def write(self, path, format):
+    if self.elapsed is None:
+      self.finish('error')
+    try:
+      if format == 'json':
+        self.write_json(path)
+      elif format == 'prometheus':
+        self.write_prometheus(path)
+    except (IOError, OSError, UnicodeError) as error:
+      logging.warning('Could not write metrics to {}: {}'.format(path, error))
+
+  def write_json(self, path):
+    attempts = self.get_attempts()
+    retries = {phase:count-1 for phase, count in attempts.items() if count > 1}
+    data = collections.OrderedDict((('time', self.start), ('ssid', self.ssid),
+                                    ('result', self.result), ('seconds', self.elapsed),
+                                    ('retries', retries), ('phases', self.phases)))
+    with open(os.path.expanduser(path), 'a') as metrics_file:
+      metrics_file.write(json.dumps(data)+'\n')
+
+  def write_prometheus(self, path):
+    """Update a Prometheus textfile with this run. Counters are read from the existing file and
+    added to, and series for other SSIDs are kept, so the file accumulates stats across runs."""
+    path = os.path.expanduser(path)
+    samples = collections.OrderedDict()
+    try:
+      with open(path, encoding='utf-8') as metrics_file:
+        for line in metrics_file:
+          if line.startswith('#') or not line.strip():
+            continue
+          series, value = line.rstrip('\n').rsplit(' ', 1)
+          samples[series] = float(value)
+    except (IOError, ValueError):
+      pass
+    ssid_label = 'ssid="{}"'.format(escape_prometheus_label(self.ssid or ''))
+    def add(name, labels, value):
+      series = '{}{{{}}}'.format(name, ','.join([ssid_label]+labels))
+      samples[series] = samples.get(series, 0) + value
+    def put(name, labels, value):
+      samples['{}{{{}}}'.format(name, ','.join([ssid_label]+labels))] = value
+    add('wifi_login_runs_total', ['result="{}"'.format(self.result)], 1)
+    put('wifi_login_run_seconds', [], self.elapsed)
+    put('wifi_login_last_run_timestamp_seconds', [], self.start)
+    phase_seconds = collections.OrderedDict()
+    for phase in self.phases:
+      phase_seconds[phase['phase']] = phase_seconds.get(phase['phase'], 0) + phase['seconds']
+    for name, seconds in phase_seconds.items():
+      put('wifi_login_phase_seconds', ['phase="{}"'.format(name)], seconds)
+    for name, count in self.get_attempts().items():
+      add('wifi_login_attempts_total', ['phase="{}"'.format(name)], count)
+      add('wifi_login_retries_total', ['phase="{}"'.format(name)], count-1)
+    lines = []
+    described = set()
+    for series, value in sorted(samples.items()):
+      name = series.split('{', 1)[0]
+      if name not in described:
+        described.add(name)
+        metric_type = 'counter' if name.endswith('_total') else 'gauge'
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+      lines.append('{} {!r}'.format(series, value))
+    # Write to a temporary file and rename it, so the collector never sees a partial file.
+    temp_path = path+'.tmp'
+    try:
+      with open(temp_path, 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write('\n'.join(lines)+'\n')
+      os.rename(temp_path, path)
+    finally:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+
+def escape_prometheus_label(value):
+  """Escape a label value for a Prometheus textfile. Bytes that aren't valid UTF-8 (like in some
+  SSIDs, which netinfo.decode_ssid() keeps as surrogate escapes) are written as "\\xNN"."""
+  value = asynchttp.encode(value).decode('utf-8', 'backslashreplace')
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_login_cache_key(sysinfo):
+  """Identify the current network connection by the SSID, access point MAC, and our MAC address.
+  Returns None if we don't look connected to wifi."""
+  if not sysinfo.ssid:
+    return None
+  return '\t'.join((sysinfo.ssid, sysinfo.wifimac or '', sysinfo.mac))
+
+
+def read_login_cache(cache_path):
+  """Read the login cache file, dropping networks we haven't seen in LOGIN_CACHE_MAX_AGE seconds.
+  Returns a dict mapping cache keys (see get_login_cache_key()) to entries. Each entry is a dict:
+  "login": When we last logged in (a timestamp), or None.
+  "lease": The longest time after a login we've seen the connection still clear, or None.
+  "checked": When we last tested the connection.
+  "clear": Whether the connection was clear at that point."""
+  cache = read_state_file(cache_path, 'login cache')
+  oldest = time.time() - LOGIN_CACHE_MAX_AGE
+  for key, entry in list(cache.items()):
+    if max(entry.get('login') or 0, entry.get('checked') or 0) < oldest:
+      del cache[key]
+  return cache
+
+
+def write_login_cache(cache_path, cache):
+  """Atomically replace the login cache file."""
+  write_state_file(cache_path, cache, 'login cache')
+
+
+def write_state_file(path, data, description):
+  """Atomically replace a JSON file, creating its directory if needed."""
+  path = os.path.expanduser(path)
+  state_dir = os.path.dirname(path)
+  temp_path = path+'.tmp'
+  try:
+    if state_dir and not os.path.isdir(state_dir):
+      os.makedirs(state_dir)
+    with open(temp_path, 'w') as state_file:
+      json.dump(data, state_file)
+    os.rename(temp_path, path)
+  except (IOError, OSError) as error:
+    logging.warning('Could not write {} {}: {}'.format(description, path, error))
+
+
+def read_state_file(path, description):
+  """Read a JSON file written by write_state_file(). Returns an empty dict if it doesn't exist or
+  can't be read."""
+  try:
+    with open(os.path.expanduser(path)) as state_file:
+      return json.load(state_file)
+  except IOError as error:
+    if error.errno != errno.ENOENT:
+      logging.warning('Could not read {} {}: {}'.format(description, path, error))
+  except ValueError:
+    logging.warning('{} {} is corrupted. Ignoring it.'.format(description.capitalize(), path))
+  return {}
+
+
+def get_cache_expiration(entry, ttl):
+  """Compute when a login cache entry stops vouching for the connection.
+  If we've observed how long logins last on this network, trust the last login for that long.
+  Otherwise, trust the last login or clear connection test for "ttl" seconds."""
+  if entry.get('login') and entry.get('lease'):
+    return entry['login'] + entry['lease']
+  last_good = entry.get('login') or 0
+  if entry.get('clear'):
+    last_good = max(last_good, entry.get('checked') or 0)
+  return last_good + ttl
+
+
+def is_login_cached(cache_path, key, ttl):
+  entry = read_login_cache(cache_path).get(key)
+  if entry is None:
+    return False
+  expiration = get_cache_expiration(entry, ttl)
+  logging.debug('Login cache entry: {} (valid for {:0.1f} more seconds).'
+                .format(entry, expiration - time.time()))
+  return time.time() < expiration
+
+
+def record_in_login_cache(cache_path, key, login=False, clear=None):
+  """Record a successful login or the result of a connection test in the login cache.
+  A connection test after a login also tells us about how long logins last on this network:
+  If it's still clear, logins last at least this long. If it's intercepted, they last less."""
+  now = time.time()
+  cache = read_login_cache(cache_path)
+  entry = cache.setdefault(key, {'login':None, 'lease':None, 'checked':None, 'clear':None})
+  if login:
+    entry['login'] = now
+  if clear is not None:
+    entry['checked'] = now
+    entry['clear'] = clear
+    if entry['login']:
+      elapsed = now - entry['login']
+      if clear:
+        entry['lease'] = max(entry['lease'] or 0, elapsed)
+      elif entry['lease'] and elapsed < entry['lease']:
+        entry['lease'] = elapsed
+  write_login_cache(cache_path, cache)
+
+
+def read_portal_stats(stats_path):
+  """Read the portal stats file. Returns a dict mapping request file names to entries. Each entry
+  is a dict:
+  "logins": How many times we've logged in with the request file.
+  "verified": How many of those logins were verified to have opened access.
+  "opened": The latest (up to PORTAL_HISTORY) times it took access to open after a login.
+  "last": When we last logged in with it."""
+  return read_state_file(stats_path, 'portal stats')
+
+
+def record_portal_login(stats_path, portal, opened):
+  """Record a login with the request file named "portal", and how long it took for access to open
+  afterward (None if it didn't)."""
+  stats = read_portal_stats(stats_path)
+  entry = stats.setdefault(portal, {'logins':0, 'verified':0, 'opened':[], 'last':None})
+  entry['logins'] += 1
+  entry['last'] = time.time()
+  if opened is not None:
+    entry['verified'] += 1
+    entry['opened'] = (entry['opened'] + [round(opened, 3)])[-PORTAL_HISTORY:]
+  write_state_file(stats_path, stats, 'portal stats')
+
+
+def read_ready_stats(stats_path):
+  """Read the readiness stats file, dropping networks we haven't seen in LOGIN_CACHE_MAX_AGE
+  seconds. Returns a dict mapping SSIDs to entries. Each entry is a dict:
+  "last": When we last had to wait for the network to be ready.
+  "ready": How long it took to be ready (in seconds after starting), the latest (up to
+           READY_HISTORY) times we had to wait for it."""
+  stats = read_state_file(stats_path, 'readiness stats')
+  oldest = time.time() - LOGIN_CACHE_MAX_AGE
+  for ssid, entry in list(stats.items()):
+    if (entry.get('last') or 0) < oldest:
+      del stats[ssid]
+  return stats
+
+
+def record_ready_time(stats_path, ssid, ready):
+  """Record how long (in seconds) the network "ssid" took to be ready."""
+  stats = read_ready_stats(stats_path)
+  entry = stats.setdefault(ssid, {'last':None, 'ready':[]})
+  entry['last'] = time.time()
+  entry['ready'] = (entry['ready'] + [round(ready, 3)])[-READY_HISTORY:]
+  write_state_file(stats_path, stats, 'readiness stats')
+
+
+async def check_dns(url, ssid, stats_path, pool=None):
+  """Look up the host of the test "url" with one DNS query, and judge the answer against the DNS
+  stats (see judge_dns_answer()). Returns a tuple of the answer, as a (host, addresses) tuple (or
+  None if there was no usable answer), and the verdict: "clear", "intercepted", or None."""
+  host = asynchttp.split_url(url)[1]
+  try:
+    ipaddress.ip_address(host)
+    return None, None
+  except ValueError:
+    pass
+  if not ssid:
+    return None, None
+  bind = pool.bind_to_interface if pool and pool.interface else None
+  try:
+    rcode, addresses = await asyncdns.resolve(host, timeout=DNS_TIMEOUT, bind=bind)
+  except (OSError, ValueError, asyncdns.DNSError) as error:
+    logging.debug('DNS check failed: {}'.format(error))
+    return None, None
+  logging.debug('DNS answer for {}: {} {}'.format(host, rcode, ' '.join(addresses)))
+  if not addresses:
+    return None, None
+  verdict = judge_dns_answer(read_dns_stats(stats_path), ssid, host, addresses)
+  return (host, addresses), verdict
+
+
+def judge_dns_answer(stats, ssid, host, addresses):
+  """Decide what a DNS answer for "host" says about the connection, from the answers seen before.
+  It's "intercepted" if every address in it has only been seen as the address of an intercepting
+  portal, on any network. A portal hijacking DNS answers with its own address, which a clear
+  connection never gets.
+  It's "clear" if every address in it has been seen on this network while it was clear, but never
+  while it was intercepted, and the network has hijacked DNS before. Networks whose DNS answers
+  don't change when they intercept connections (like when a login expires) can't be judged by it.
+  Otherwise, the answer is ambiguous, and this returns None."""
+  answer = set(addresses)
+  portal = set()
+  good = set()
+  for entry in stats.values():
+    seen = entry['hosts'].get(host, {})
+    portal.update(seen.get('intercepted', ()))
+    good.update(seen.get('clear', ()))
+  if answer <= portal and not answer & good:
+    return 'intercepted'
+  seen = stats.get(ssid, {}).get('hosts', {}).get(host, {})
+  clear_here = set(seen.get('clear', ()))
+  intercepted_here = set(seen.get('intercepted', ()))
+  if intercepted_here and answer <= clear_here and not answer & intercepted_here:
+    return 'clear'
+  return None
+
+
+def read_dns_stats(stats_path):
+  """Read the DNS stats file, dropping networks we haven't seen in LOGIN_CACHE_MAX_AGE seconds.
+  Returns a dict mapping SSIDs to entries. Each entry is a dict:
+  "last": When we last recorded a DNS answer on the network.
+  "hosts": A dict mapping test URL hosts to dicts with two lists of the latest (up to DNS_HISTORY)
+           addresses answered for it: "clear" ones, answered while the connection was clear, and
+           "intercepted" ones, answered while it was intercepted, by a portal at that address."""
+  stats = read_state_file(stats_path, 'DNS stats')
+  oldest = time.time() - LOGIN_CACHE_MAX_AGE
+  for ssid, entry in list(stats.items()):
+    if (entry.get('last') or 0) < oldest:
+      del stats[ssid]
+  return stats
+
+
+def record_dns_answer(stats_path, ssid, answer, clear, portal_address=None):
+  """Record the DNS "answer" (a (host, addresses) tuple) from check_dns(), and whether the
+  connection test found the connection "clear". If it didn't, only "portal_address" (the address
+  the intercepting response came from) is recorded, since an answer with the real address can
+  still be intercepted further along."""
+  host, addresses = answer
+  if not clear:
+    addresses = [address for address in addresses if address == portal_address]
+    if not addresses:
+      return
+  stats = read_dns_stats(stats_path)
+  entry = stats.setdefault(ssid, {'last':None, 'hosts':{}})
+  entry['last'] = time.time()
+  seen = entry['hosts'].setdefault(host, {'clear':[], 'intercepted':[]})
+  state = 'clear' if clear else 'intercepted'
+  kept = [address for address in seen[state] if address not in addresses]
+  seen[state] = (kept + addresses)[-DNS_HISTORY:]
+  write_state_file(stats_path, stats, 'DNS stats')
 
 
 def find_request_file(request_dir, ssid):
-  expected_filenames = (ssid, ssid+'.txt', ssid.replace(' ', '-')+'.txt')
-  logging.debug('Expected request filenames: {}'.format(expected_filenames))
-  for filename in os.listdir(request_dir):
-    path = os.path.join(request_dir, filename)
-    if not os.path.isfile(path):
+  """Find the request file for an SSID. An exact filename match is preferred. Otherwise, the SSID is
+  matched against filenames which are patterns: either shell-style wildcards, like
+  "Fullington - *.txt", or regular expressions prefixed with "re:", like "re:Fullington - \\d+.txt".
+  The ".txt" extension isn't part of the pattern. Outside of regular expressions, SSID bytes that
+  can't go in a filename can be written as escapes like "\\x2f" (see unescape_filename())."""
+  index = load_request_index(request_dir)
+  logging.debug('Expected request filenames: {}'
+                .format(logincommon.get_expected_filenames(ssid)))
+  filename = logincommon.find_in_index(index, ssid)
+  if filename is None:
+    return None
+  logging.debug('SSID "{}" has request file "{}".'.format(ssid, filename))
+  return os.path.join(request_dir, filename)
+
+
+def load_request_index(request_dir):
+  """Get the index of the request files in a directory, updating the cached one if the directory has
+  changed since it was made. The index is a dict:
+  "mtime": The modification time of the directory when it was indexed.
+  "seen": The set of all filenames in the directory.
+  "files": The set of request filenames.
+  "escaped": A dict mapping the unescaped forms of request filenames with escapes in them (see
+             unescape_filename()) to the filenames.
+  "patterns": A list of (regex, filename) tuples for the request filenames which are patterns, most
+              specific first."""
+  index_path = os.path.join(request_dir, logincommon.REQUEST_INDEX_NAME)
+  mtime = os.stat(request_dir).st_mtime
+  index = None
+  try:
+    with open(index_path, 'rb') as index_file:
+      version, index = pickle.load(index_file)
+    if version != logincommon.REQUEST_INDEX_VERSION:
+      index = None
+  except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+    pass
+  if index is None:
+    index = {'mtime':None, 'seen':set(), 'files':set(), 'escaped':{}, 'patterns':[]}
+  elif index['mtime'] == mtime:
+    return index
+  update_request_index(index, request_dir)
+  index['mtime'] = mtime
+  try:
+    write_request_index(index_path, index)
+    # Creating the index file changes the directory's mtime. Overwriting it won't.
+    new_mtime = os.stat(request_dir).st_mtime
+    if new_mtime != mtime:
+      index['mtime'] = new_mtime
+      write_request_index(index_path, index)
+  except IOError as error:
+    logging.debug('Could not cache request file index: {}'.format(error))
+  return index
+
+
+def write_request_index(index_path, index):
+  with open(index_path, 'wb') as index_file:
+    pickle.dump((logincommon.REQUEST_INDEX_VERSION, index), index_file, pickle.HIGHEST_PROTOCOL)
+
+
+def update_request_index(index, request_dir):
+  """Add new filenames to the index and remove deleted ones. Only new files are examined."""
+  filenames = set(os.listdir(request_dir))
+  removed = index['seen'] - filenames
+  added = filenames - index['seen']
+  logging.debug('Updating request file index: {} files added, {} removed.'
+                .format(len(added), len(removed)))
+  index['files'] -= removed
+  escaped = index['escaped']
+  for name, filename in list(escaped.items()):
+    if filename in removed:
+      del escaped[name]
+  patterns = [pattern for pattern in index['patterns'] if pattern[1] not in removed]
+  for filename in added:
+    if filename.startswith('.') or not os.path.isfile(os.path.join(request_dir, filename)):
+      continue
+    index['files'].add(filename)
+    regex = filename_to_regex(filename)
+    if regex is not None:
+      patterns.append((regex, filename))
+    elif unescape_filename(filename) != filename:
+      escaped[unescape_filename(filename)] = filename
+  # Try the longest (most specific) patterns first.
+  patterns.sort(key=lambda pattern: (-len(pattern[0]), pattern[1]))
+  index['patterns'] = patterns
+  index['seen'] = filenames
+
+
+def filename_to_regex(filename):
+  """Return the regular expression a pattern filename stands for, or None if it's not a pattern."""
+  if filename.endswith('.txt'):
+    filename = filename[:-4]
+  if filename.startswith(logincommon.REGEX_PREFIX):
+    regex = filename[len(logincommon.REGEX_PREFIX):]
+  elif any(char in filename for char in '*?['):
+    # Python 2 puts the flags at the end ("...\Z(?ms)"), Python 3 in a group ("(?s:...)\Z").
+    translated = fnmatch.translate(unescape_filename(filename))
+    match = (re.search(r'^\(\?s:(.*)\)\\Z$', translated) or
+             re.search(r'^(.*)\\Z\(\?ms\)$', translated))
+    regex = '(?:'+match.group(1)+')'
+  else:
+    return None
+  try:
+    # Check it the way it'll be used. Global flags like "(?i)" don't work there, for instance.
+    re.compile('(?:'+regex+r')\Z')
+  except re.error as error:
+    logging.warning('Invalid SSID pattern in request filename "{}": {}'.format(filename, error))
+    return None
+  return regex
+
+
+def unescape_filename(filename):
+  """Replace the "\\xNN" escapes in a request filename with the SSID bytes they stand for (decoded
+  like netinfo.decode_ssid() does). SSIDs are up to 32 arbitrary bytes, including ones like "/" and
+  NUL, which can't be in filenames, and ones that aren't valid text."""
+  if '\\x' not in filename:
+    return filename
+  raw = FILENAME_ESCAPE_REGEX.sub(lambda match: bytes((int(match.group(1), 16),)),
+                                  os.fsencode(filename))
+  return os.fsdecode(raw)
+
+
+def identify_portal(interception, redirect_dir, request_dir):
+  """Identify a portal by how it intercepted a request, and find the request file to log in with.
+  "interception" is a dict as filled in by test_connection(). Returns None if the interception
+  doesn't match any of the records in redirect_dir, or the one it matches has no request file."""
+  if not (interception and redirect_dir):
+    return None
+  index = load_fingerprint_index(redirect_dir)
+  matches = collections.defaultdict(list)
+  for fingerprint in get_fingerprints(interception['headers'], interception['body']):
+    name = index.get(fingerprint)
+    if not name:
+      continue
+    if fingerprint[0] == 'body':
+      logging.debug('Interception matches record "{}" by {}.'.format(name, fingerprint))
+      return find_request_file(request_dir, name)
+    matches[name].append(fingerprint)
+  # The rest are things like the host redirected to, which unrelated portals can share (like the
+  # 1.1.1.1 of many Cisco controllers). They only identify a portal when enough of them agree.
+  for name, fingerprints in matches.items():
+    if len(fingerprints) >= MIN_WEAK_FINGERPRINTS and len(matches) == 1:
+      logging.debug('Interception matches record "{}" by {}.'.format(name, fingerprints))
+      return find_request_file(request_dir, name)
+    logging.info('Interception resembles record "{}" (by {}), but not closely enough to log in '
+                 'with it.'.format(name, fingerprints))
+  return None
+
+
+def load_fingerprint_index(redirect_dir):
+  """Get a dict mapping fingerprints (see get_fingerprints()) to the names of the records in
+  redirect_dir which have them (without the ".txt"). Fingerprints shared by records with different
+  names don't identify anything, so they're left out. The index is cached in redirect_dir, and
+  rebuilt whenever the name, modification time, or size of any record changes."""
+  index_path = os.path.join(redirect_dir, FINGERPRINT_INDEX_NAME)
+  signature = [FINGERPRINT_VERSION]
+  for filename in sorted(os.listdir(redirect_dir)):
+    path = os.path.join(redirect_dir, filename)
+    if filename.startswith('.') or not os.path.isfile(path):
+      continue
+    stats = os.stat(path)
+    signature.append((filename, stats.st_mtime, stats.st_size))
+  try:
+    with open(index_path, 'rb') as index_file:
+      cached_signature, index = pickle.load(index_file)
+    if cached_signature == signature:
+      return index
+  except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+    pass
+  index = {}
+  ambiguous = set()
+  for filename, mtime, size in signature[1:]:
+    name = filename[:-4] if filename.endswith('.txt') else filename
+    try:
+      with open(os.path.join(redirect_dir, filename), 'rb') as record:
+        status, headers, body = parse_response_record(record)
+    except ValueError as error:
+      logging.warning('Invalid redirect record {}: {}'.format(filename, error))
+      continue
+    for fingerprint in get_fingerprints(headers, body):
+      if index.get(fingerprint, name) != name:
+        ambiguous.add(fingerprint)
+      index[fingerprint] = name
+  for fingerprint in ambiguous:
+    del index[fingerprint]
+  try:
+    with open(index_path, 'wb') as index_file:
+      pickle.dump((signature, index), index_file, pickle.HIGHEST_PROTOCOL)
+  except IOError as error:
+    logging.debug('Could not cache fingerprint index: {}'.format(error))
+  return index
+
+
+def parse_response_record(record, errors=None):
+  """Parse a file containing an HTTP response in plain text. The file should be opened in binary
+  mode. Returns the status code, a dict of headers (with lowercase names), and the body (as bytes),
+  or as much of it as read_portal_page() reads.
+  Problems raise a RecordError, or are appended to "errors" if it's a list (see
+  compile_request_file())."""
+  status_line = asynchttp.decode(record.readline()).rstrip('\r\n')
+  fields = status_line.split(None, 2)
+  status = None
+  if len(fields) < 2 or not fields[0].startswith('HTTP/') or not fields[1].isdigit():
+    report_error(errors, RecordError('First line invalid (should look like "HTTP/1.1 200 OK"): '
+                                     +status_line, 1))
+  else:
+    status = int(fields[1])
+  headers = {}
+  line_num = 1
+  while True:
+    line = asynchttp.decode(record.readline()).rstrip('\r\n')
+    line_num += 1
+    if not line:
+      break
+    name, colon, value = line.partition(':')
+    if not colon:
+      report_error(errors, RecordError('Invalid header line: '+line, line_num))
+      continue
+    headers[name.strip().lower()] = value.strip()
+  return status, headers, trim_portal_page(record.read(MAX_FINGERPRINT_BODY))
+
+
+def get_fingerprints(headers, body):
+  """Compute the features that identify a portal from a response intercepting a request.
+  The body should be what read_portal_page() returns, so it's comparable between responses.
+  Returns a list of (kind, value) tuples, from the most to least specific: a hash of the body
+  (ignoring query strings, which often echo the intercepted URL), then the host and the path of the
+  URL redirected to (by the Location header or a meta refresh tag). The path is left out if it's
+  just "/". Only the body identifies a portal on its own (see identify_portal())."""
+  fingerprints = [('body', hashlib.sha1(re.sub(rb'\?[^"\'\s<>]*', b'', body)).hexdigest())]
+  for url in (headers.get('location'), get_meta_refresh_url(asynchttp.decode(body))):
+    if not url:
       continue
-    for expected_filename in expected_filenames:
-      if filename == expected_filename:
-        return path
+    parts = urllib.parse.urlsplit(url.strip())
+    for fingerprint in (('host', parts.netloc.lower()), ('path', parts.path)):
+      if fingerprint[1] not in ('', '/') and fingerprint not in fingerprints:
+        fingerprints.append(fingerprint)
+  return fingerprints
+
+
+def get_meta_refresh_url(html):
+  """Find the URL a page redirects to with a <meta http-equiv="refresh"> tag, or None."""
+  for tag in META_TAG_REGEX.findall(html):
+    if REFRESH_REGEX.search(tag):
+      match = REFRESH_URL_REGEX.search(tag)
+      if match:
+        return match.group(1).strip()
   return None
 
 
-def parse_request_file(request_file):
+def parse_request_file(request_file, sysinfo=None):
   """Parse a file with the login HTTP request represented in plain text.
   Placeholders of the format ${name} can be used in the path, header values, or
-  POST data. Unrecognized placeholders will raise a warning and be replaced with
-  an empty string."""
-  headers = collections.OrderedDict()
+  POST data, with filters like ${name|upper|urlencode} (see PLACEHOLDER_FILTERS).
+  Unrecognized placeholders will raise a warning and be replaced with an empty string.
+  If the file holds a series of requests, this returns the first one."""
+  template = compile_request_file(request_file)
+  return render_request(template['steps'][0], sysinfo or SystemInfo())
+
+
+def compile_request_file(request_file, errors=None):
+  """Parse a request file (opened in binary mode) into a template which can be filled in with
+  render_request(). The template is a dict with two keys: "steps", a list of the requests to make,
+  in order, and "speculative", whether the file has a "@speculative" directive (see --speculative).
+  Each step is a dict with the keys "method", "path", "protocol", "headers", "body", "extract", and
+  "follow". "path" and "body" are compiled strings (see compile_placeholders()). "headers" is a
+  list of (name, compiled value) pairs. "extract" is a list of (name, source, argument) tuples
+  saying what values to pull out of the step's response (see extract_values()). "follow" is how
+  many redirects to follow from the step's response (0 unless there's an "@follow" directive).
+  Steps are separated by STEP_SEPARATOR lines. Directives for a step go on lines before its first
+  line, like "@extract hash form ValidationHash" or "@follow 3". "@speculative" is for the whole
+  file, so it has to go before the first step.
+  The first line can give the file's format, like "@format 2". In format 1 (the default), a body
+  is the one line after the headers. In format 2, a body runs until the next STEP_SEPARATOR line
+  or the end of the file (not counting the line break before it), or is delimited by a
+  Content-Length header (counting the bytes in the file) or chunked Transfer-Encoding, like in
+  HTTP. Either way, the file is parsed as bytes, in one pass.
+  Problems with the file raise a RecordError. If "errors" is a list, they're appended to it
+  instead, and parsing carries on to find the rest. The template is then incomplete if any were
+  found."""
+  reader = RequestFileReader(request_file.read())
+  version = 1
+  first_line = reader.peekline()
+  if first_line and first_line[1].split()[:1] == [FORMAT_DIRECTIVE]:
+    line_num, line = reader.readline()
+    fields = line.split()
+    if len(fields) == 2 and fields[1].isdigit() and int(fields[1]) in REQUEST_FORMATS:
+      version = int(fields[1])
+    else:
+      report_error(errors, RecordError('Unsupported format (should be "{} N", where N is one of '
+                                       '{}): {}'.format(FORMAT_DIRECTIVE,
+                                                        ', '.join(map(str, REQUEST_FORMATS)),
+                                                        line), line_num))
+      version = REQUEST_FORMATS[-1]
+  steps = []
+  speculative = False
+  while not reader.at_end():
+    step = compile_request_step(reader, version, errors)
+    if not step:
+      continue
+    speculative_line = step.pop('speculative')
+    if speculative_line is not None:
+      if steps:
+        report_error(errors, RecordError('The "@speculative" directive has to go before the first '
+                                         'request.', speculative_line))
+      else:
+        speculative = True
+    steps.append(step)
+  if not steps:
+    report_error(errors, RecordError('No request found in request file.'))
+  return {'steps':steps, 'speculative':speculative}
+
+
+def compile_request_step(reader, version=1, errors=None):
+  """Parse the next step of a request file from a RequestFileReader, through the STEP_SEPARATOR
+  line after it (see compile_request_file()). Returns None if the step is blank, or too broken to
+  parse (when "errors" is a list)."""
+  headers = []
+  extract = []
+  follow = 0
+  speculative = None
+  content_line_num = None
+  # Read the directives, up to the first line of the request.
+  while True:
+    line_num, line = reader.readline() or (None, None)
+    if line is None or line == STEP_SEPARATOR:
+      if content_line_num is not None:
+        report_error(errors, RecordError('Request file has a step with no request in it.',
+                                         content_line_num))
+      return None
+    if not line:
+      continue
+    if content_line_num is None:
+      content_line_num = line_num
+    if not line.startswith(DIRECTIVE_PREFIX):
+      break
+    try:
+      if line.split()[0] == FORMAT_DIRECTIVE:
+        raise RecordError('The "{}" directive has to be the first line of the file.'
+                          .format(FORMAT_DIRECTIVE), line_num)
+      directive = parse_directive(line, line_num)
+      if directive[0] == 'extract':
+        extract.append(directive[1:])
+      elif directive[0] == 'speculative':
+        speculative = line_num
+      else:
+        follow = directive[1]
+    except RecordError as error:
+      report_error(errors, error)
+  first_line_num = line_num
+  fields = line.split()
+  if not (len(fields) == 3 and METHOD_REGEX.match(fields[0]) and fields[2].startswith('HTTP/')):
+    report_error(errors, RecordError('First line of request invalid (should look like "GET /path '
+                                     'HTTP/1.1"): '+line, line_num))
+    # Carry on, to check the rest of the step.
+    fields = None
+  # Read the headers. The step can end right after them, with no body.
+  ended = True
+  while True:
+    line_num, line = reader.readline() or (None, None)
+    if line is None or line == STEP_SEPARATOR:
+      break
+    if not line:
+      # This is the empty line after the headers.
+      ended = False
+      break
+    c_index = line.find(':')
+    if c_index > 0:
+      key = normalize_header_name(line[:c_index])
+      value = line[c_index+1:].lstrip(' ')
+      headers.append((key, compile_line(value, line_num, errors)))
+    else:
+      report_error(errors, RecordError('Invalid header line: '+line, line_num))
   post_data = ''
-  section = 'first'
-  for line_raw in request_file:
-    line = line_raw.rstrip('\r\n')
-    if section == 'first':
-      fields = line.split()
-      if not len(fields) == 3 or fields[0] not in ('GET', 'POST'):
-        logging.error('First line of request file invalid (should look like "GET /path HTTP/1.1"):'
-                      '\n\t'+line)
-        raise ValueError
-      method, path, protocol = fields
-      path = substitute_placeholders(path)
-      section = 'headers'
-    elif section == 'headers':
-      c_index = line.find(':')
-      if c_index > 0:
-        key = normalize_header_name(line[:c_index])
-        value = line[c_index+1:].lstrip(' ')
-        headers[key] = substitute_placeholders(value)
-      elif c_index == -1:
-        # This should be an empty line after the headers.
-        assert not line, line
-        section = 'data'
+  body_line_num = reader.line_num
+  if not ended:
+    if version == 1:
+      line_num, line = reader.readline() or (None, STEP_SEPARATOR)
+      if line != STEP_SEPARATOR:
+        post_data = line
+        skip_to_separator(reader, errors, 'Non-blank line found after the first POST data line. '
+                                          'All POST data must be on one line in format 1 request '
+                                          'files (see "{} 2").'.format(FORMAT_DIRECTIVE))
+    else:
+      post_data = read_request_body(reader, headers, errors)
+  if not any(key == 'Host' for key, value in headers):
+    report_error(errors, RecordError('"Host:" header not found.', first_line_num))
+  body = compile_line(post_data, body_line_num, errors)
+  if not fields:
+    return None
+  method, path, protocol = fields
+  return {'method':method, 'path':compile_line(path, first_line_num, errors), 'protocol':protocol,
+          'headers':headers, 'body':body, 'extract':extract, 'follow':follow,
+          'speculative':speculative}
+
+
+def compile_line(string, line_num, errors=None):
+  """Compile a string from a request file with compile_placeholders(), reporting any problem with
+  its placeholders as an error on the line it starts on."""
+  try:
+    return compile_placeholders(string)
+  except ValueError as error:
+    report_error(errors, RecordError(str(error), line_num))
+    return [string]
+
+
+def read_request_body(reader, headers, errors=None):
+  """Read the body of a request in a format 2 request file (see compile_request_file()), and the
+  rest of its step. A chunked body's Transfer-Encoding header is removed from the "headers", since
+  it's sent whole. Returns the body."""
+  header_values = dict((key, format_placeholders(value)) for key, value in headers)
+  start_line_num = reader.line_num
+  if 'chunked' in header_values.get('Transfer-Encoding', '').lower():
+    headers[:] = [(key, value) for key, value in headers if key != 'Transfer-Encoding']
+    chunks = []
+    message = 'Non-blank line found after the chunked body.'
+    while True:
+      line_num, line = reader.readline() or (None, '')
+      try:
+        size = int(line.split(';')[0], 16)
+      except ValueError:
+        report_error(errors, RecordError('Invalid chunk size line: '+line, line_num))
+        message = None
+        break
+      if not size:
+        break
+      chunk = reader.read(size)
+      chunks.append(chunk)
+      # The chunk should end at the end of a line.
+      rest = reader.readline()
+      if len(asynchttp.encode(chunk)) < size or not rest or rest[1]:
+        report_error(errors, RecordError('Chunk doesn\'t match its size.', line_num))
+        message = None
+        break
+    body = ''.join(chunks)
+    # After a broken chunk, the rest of the step is just more of the body. Don't report it.
+    skip_to_separator(reader, errors, message)
+  elif 'Content-Length' in header_values:
+    length = header_values['Content-Length'].strip()
+    if not length.isdigit():
+      report_error(errors, RecordError('Invalid Content-Length: '+length, start_line_num))
+      length = 0
+    body = reader.read(int(length))
+    if len(asynchttp.encode(body)) < int(length):
+      report_error(errors, RecordError('Body is shorter than its Content-Length.', start_line_num))
+    # The body can end in the middle of a line, with the rest of the line blank.
+    skip_to_separator(reader, errors, 'Non-blank line found after the body (is the Content-Length '
+                                      'right?).')
+  else:
+    body = reader.read_until(SEPARATOR_LINE_REGEX)
+    # The line break before the separator (or the end of the file) isn't part of the body.
+    if body.endswith('\n'):
+      body = body[:-2] if body.endswith('\r\n') else body[:-1]
+  return body
+
+
+def skip_to_separator(reader, errors, message):
+  """Read through the next STEP_SEPARATOR line (or the end of the file), reporting an error with
+  the "message" (if any) for each line that isn't blank."""
+  while True:
+    line_num, line = reader.readline() or (None, None)
+    if line is None or line == STEP_SEPARATOR:
+      return
+    if line.strip() and message:
+      report_error(errors, RecordError(message, line_num))
+
+
+class RequestFileReader(object):
+  """Reads the bytes of a request file by lines or by counts of bytes, decoding them to strings the
+  way asynchttp.decode() does. "line_num" is the number of the line the next byte is on."""
+
+  def __init__(self, data):
+    self.data = data
+    self.pos = 0
+    self.line_num = 1
+
+  def at_end(self):
+    return self.pos >= len(self.data)
+
+  def readline(self):
+    """Read the rest of the line. Returns a tuple of its line number and the line, without its line
+    break, or None at the end of the file."""
+    if self.pos >= len(self.data):
+      return None
+    line_num = self.line_num
+    end = self.data.find(b'\n', self.pos)
+    line = self.read_to(len(self.data) if end < 0 else end+1)
+    return line_num, line.rstrip('\r\n')
+
+  def peekline(self):
+    """Get what readline() would, without moving on."""
+    pos, line_num = self.pos, self.line_num
+    line = self.readline()
+    self.pos, self.line_num = pos, line_num
+    return line
+
+  def read(self, size):
+    """Read up to "size" bytes."""
+    return self.read_to(self.pos+size)
+
+  def read_until(self, regex):
+    """Read up to the next match of the bytes "regex", and skip past the match. If there's none,
+    read the rest of the file."""
+    match = regex.search(self.data, self.pos)
+    if not match:
+      return self.read_to(len(self.data))
+    data = self.read_to(match.start())
+    self.read_to(match.end())
+    return data
+
+  def read_to(self, end):
+    data = self.data[self.pos:end]
+    self.line_num += data.count(b'\n')
+    self.pos += len(data)
+    return asynchttp.decode(data)
+
+
+def parse_directive(line, line_num=None):
+  """Parse a directive line: "@extract name source argument", "@follow [max redirects]", or
+  "@speculative". Returns a tuple of the directive name and its arguments: ("extract", name, source,
+  argument), where the argument is optional for some sources, and is None when it's omitted,
+  ("follow", max redirects), which defaults to MAX_REDIRECTS, or ("speculative",)."""
+  fields = line[len(DIRECTIVE_PREFIX):].split(None, 3)
+  if fields == ['speculative']:
+    return ('speculative',)
+  if fields and fields[0] == 'follow':
+    if len(fields) == 1:
+      return ('follow', MAX_REDIRECTS)
+    if len(fields) == 2 and fields[1].isdigit():
+      return ('follow', int(fields[1]))
+    raise RecordError('Invalid directive (should look like "@follow [max redirects]"): '+line,
+                      line_num)
+  if len(fields) < 3 or fields[0] != 'extract' or fields[2] not in EXTRACT_SOURCES:
+    raise RecordError('Invalid directive (should look like "@extract name source argument", where '
+                      'source is one of {}): {}'.format(', '.join(EXTRACT_SOURCES), line), line_num)
+  if len(fields) == 3:
+    if fields[2] != 'location':
+      raise RecordError('Directive is missing its argument: '+line, line_num)
+    fields.append(None)
+  if fields[2] == 'body':
+    try:
+      re.compile(fields[3])
+    except re.error as error:
+      raise RecordError('Invalid regular expression ({}): {}'.format(error, line), line_num)
+  return tuple(fields)
+
+
+class RecordError(ValueError):
+  """A problem with a request file or response record. "line" is the line number it's on, if it's
+  on a particular line."""
+
+  def __init__(self, message, line=None):
+    ValueError.__init__(self, message)
+    self.message = message
+    self.line = line
+
+  def __str__(self):
+    if self.line is None:
+      return self.message
+    return 'line {}: {}'.format(self.line, self.message)
+
+
+def report_error(errors, error):
+  """Add the error to the list of "errors", or raise it if there is no list."""
+  if errors is None:
+    raise error
+  errors.append(error)
+
+
+def render_request(template, sysinfo, values=None):
+  """Fill in the placeholders in one step of a compiled request template, using values from a
+  SystemInfo. "values" is a dict of values extracted from earlier steps, which take precedence.
+  ${host} is the Host header's value (the host and any port the request is sent to), and
+  ${timestamp} and ${nonce} have the same value everywhere in the request.
+  Returns the same values as parse_request_file()."""
+  context = {'timestamp':str(int(time.time())), 'nonce':make_nonce()}
+  for key, value in template['headers']:
+    if key == 'Host':
+      context['host'] = render_placeholders(value, sysinfo, values, context)
+  headers = collections.OrderedDict()
+  for key, value in template['headers']:
+    headers[key] = render_placeholders(value, sysinfo, values, context)
+  path = render_placeholders(template['path'], sysinfo, values, context)
+  post_data = render_placeholders(template['body'], sysinfo, values, context)
+  return headers, template['method'], path, template['protocol'], post_data
+
+
+def check_request_file(request_path, sysinfo):
+  """Check a request file for errors, logging every one found. Returns 1 if there were any."""
+  errors = []
+  with open_request_file(request_path) as request_file:
+    template = compile_request_file(request_file, errors)
+  for error in errors:
+    logging.error('{}: {}'.format(request_path, error))
+  if errors:
+    return 1
+  check_request_template(template, sysinfo)
+
+
+def check_request_template(template, sysinfo):
+  """Render every step of a template, to check for errors. Values extracted from responses are
+  left blank."""
+  values = {}
+  for step in template['steps']:
+    render_request(step, sysinfo, values)
+    for name, source, argument in step['extract']:
+      values[name] = ''
+
+
+async def make_request_steps(template, sysinfo, pool=None, timeout=None):
+  """Make each request in a template, in order. Cookies set by each response are sent with the
+  requests after it, and values extracted from each response fill in the placeholders of the
+  requests after it. When they're to the same host, the requests all go over the same pooled
+  connection. Steps with an "@follow" directive follow the redirects in their responses (sending
+  the cookies along), and their values are extracted from the final response."""
+  pool = pool or asynchttp.ConnectionPool()
+  values = {}
+  cookies = collections.OrderedDict()
+  steps = template['steps']
+  for i, step in enumerate(steps):
+    headers, method, path, protocol, post_data = render_request(step, sysinfo, values)
+    if len(steps) > 1:
+      logging.debug('Step {} of {}: {} {}'.format(i+1, len(steps), method, path))
+    read_body = any(source in ('form', 'body') for name, source, argument in step['extract'])
+    scheme = 'http'
+    redirects = 0
+    while True:
+      if cookies:
+        headers['Cookie'] = merge_cookies(headers.get('Cookie'), cookies)
+      response, body = await make_request(headers, method, path, protocol, post_data, pool=pool,
+                                          timeout=timeout, read_body=read_body, scheme=scheme)
+      update_cookie_jar(cookies, response)
+      redirect = None
+      if redirects < step['follow']:
+        redirect = get_redirect(response, headers, method, scheme, path, post_data)
+      if not redirect:
+        break
+      headers, method, scheme, path, post_data = redirect
+      redirects += 1
+      logging.debug('Following redirect {} to {}://{}{}'.format(redirects, scheme, headers['Host'],
+                                                                path))
+    values.update(extract_values(step['extract'], response, body, cookies))
+  return response
+
+
+def get_redirect(response, headers, method, scheme, path, post_data):
+  """Work out the request that a response to make_request() redirects to.
+  Returns the new (headers, method, scheme, path, post data), or None if it's not a redirect."""
+  host, port = split_host(headers['Host'], scheme)
+  try:
+    redirect = asynchttp.get_redirect(response, method, scheme, host, port, path)
+  except ValueError as error:
+    logging.warning('Not following redirect: {}'.format(error))
+    return None
+  if redirect is None:
+    return None
+  new_method, scheme, host, port, path = redirect
+  headers = collections.OrderedDict(headers)
+  if port == asynchttp.DEFAULT_PORTS[scheme]:
+    headers['Host'] = host
+  else:
+    headers['Host'] = '{}:{}'.format(host, port)
+  if new_method != method:
+    # The body is dropped when a POST becomes a GET.
+    post_data = None
+    headers.pop('Content-Type', None)
+  return headers, new_method, scheme, path, post_data
+
+
+def update_cookie_jar(cookies, response):
+  """Add the cookies set by a response to the "cookies" dict."""
+  for header in response.get_all('Set-Cookie'):
+    name, equals, value = header.split(';', 1)[0].partition('=')
+    if equals and name.strip():
+      cookies[name.strip()] = value.strip()
+
+
+def merge_cookies(cookie_header, cookies):
+  """Combine the cookies in a request's Cookie header with the ones in the cookie jar. The ones in
+  the jar replace any with the same name in the header, since those are likely stale."""
+  merged = collections.OrderedDict()
+  for cookie in (cookie_header or '').split(';'):
+    name, equals, value = cookie.strip().partition('=')
+    if equals:
+      merged[name] = value
+  merged.update(cookies)
+  return '; '.join('{}={}'.format(name, value) for name, value in merged.items())
+
+
+def extract_values(extractions, response, body, cookies):
+  """Pull values out of a response, as directed by a list of (name, source, argument) tuples.
+  The sources are:
+    form:     The value of the <input> tag with the name "argument" (like a hidden form field).
+    body:     The first group matched by the regular expression "argument" in the body.
+    header:   The value of the response header named "argument".
+    location: The query parameter "argument" in the Location header, or the whole Location if no
+              argument is given.
+    cookie:   The value of the cookie named "argument", from any response so far.
+  Returns a dict mapping names to values. Values that can't be found are set to empty strings."""
+  values = {}
+  for name, source, argument in extractions:
+    value = None
+    if source == 'form':
+      value = get_form_value(body, argument)
+    elif source == 'body':
+      match = re.search(argument, body)
+      if match:
+        value = match.group(1) if match.groups() else match.group(0)
+    elif source == 'header':
+      value = response.getheader(argument)
+    elif source == 'location':
+      location = response.getheader('Location')
+      if location and argument:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(location).query)
+        value = query.get(argument, [None])[0]
       else:
-        raise AssertionError('Invalid colon location in header: '+line)
-    elif section == 'data':
-      post_data = substitute_placeholders(line)
-      section = 'done'
-    elif section == 'done':
-      # We should be done at this point.
-      assert not line, ('Non-blank lines found after the first POST data line. All '
-                                       'POST data must be on one line.')
-  return headers, method, path, protocol, post_data
+        value = location
+    elif source == 'cookie':
+      value = cookies.get(argument)
+    if value is None:
+      logging.warning('Could not extract "{}" from the {} of the response.'.format(name, source))
+      value = ''
+    else:
+      logging.debug('Extracted {}: {!r}'.format(name, value))
+    values[name] = value
+  return values
+
+
+def get_form_value(html, field_name):
+  """Find the value of the <input> tag named "field_name" in an HTML page, or None."""
+  for tag in INPUT_TAG_REGEX.findall(html):
+    attrs = {}
+    for match in TAG_ATTR_REGEX.finditer(tag):
+      attr_value = next(group for group in match.groups()[1:] if group is not None)
+      attrs[match.group(1).lower()] = attr_value
+    if attrs.get('name') == field_name:
+      value = attrs.get('value', '')
+      for entity, char in HTML_ENTITIES:
+        value = value.replace(entity, char)
+      return value
+  return None
+
+
+def load_request_template(request_path, templates=None):
+  """Get the compiled template for a request file, using the cached one beside it if it's current.
+  The cache is invalidated whenever the request file's modification time or size changes.
+  If "templates" is a dict, templates are also kept in it, and used from it if still current."""
+  signature = get_template_signature(request_path)
+  if templates is not None:
+    if request_path in templates and templates[request_path][0] == signature:
+      return templates[request_path][1]
+    template = load_request_template(request_path)
+    templates[request_path] = (signature, template)
+    return template
+  cache_path = get_template_cache_path(request_path)
+  try:
+    with open(cache_path, 'rb') as cache_file:
+      cached_signature, template = pickle.load(cache_file)
+    if cached_signature == signature:
+      logging.debug('Using compiled request file {}.'.format(cache_path))
+      return template
+  except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+    pass
+  with open_request_file(request_path) as request_file:
+    template = compile_request_file(request_file)
+  write_template_cache(request_path, signature, template)
+  return template
+
+
+def open_request_file(request_path):
+  """Open a request file for compile_request_file(). It's parsed as bytes, and any that aren't
+  valid UTF-8 are kept as surrogate escapes, and sent as the same bytes (see asynchttp.encode())."""
+  return open(request_path, 'rb')
+
+
+def get_template_signature(request_path):
+  stats = os.stat(request_path)
+  return (TEMPLATE_VERSION, stats.st_mtime, stats.st_size)
+
+
+def get_template_cache_path(request_path):
+  request_dir, request_filename = os.path.split(request_path)
+  return os.path.join(request_dir, TEMPLATE_CACHE_NAME.format(request_filename))
+
+
+def write_template_cache(request_path, signature, template):
+  try:
+    with open(get_template_cache_path(request_path), 'wb') as cache_file:
+      pickle.dump((signature, template), cache_file, pickle.HIGHEST_PROTOCOL)
+  except IOError as error:
+    logging.debug('Could not cache compiled request file: {}'.format(error))
+
+
+def compile_request_dir(request_dir, redirect_dir=None, manifest=None, jobs=None):
+  """Check every request file in request_dir and every response record in redirect_dir, compiling
+  and caching the valid request files. The files are processed in parallel by "jobs" processes
+  (default: one per CPU). Every error found is printed, with its file and line number, followed by a
+  summary. If "manifest" is a path, a JSON description of every file and its errors is written
+  there. Returns the number of files with errors."""
+  files = [('request', os.path.join(request_dir, filename))
+           for filename in sorted(load_request_index(request_dir)['files'])]
+  if redirect_dir and os.path.isdir(redirect_dir):
+    for filename in sorted(os.listdir(redirect_dir)):
+      path = os.path.join(redirect_dir, filename)
+      if not filename.startswith('.') and os.path.isfile(path):
+        files.append(('redirect', path))
+  start = time.time()
+  if len(files) > 1 and jobs != 1:
+    pool = multiprocessing.Pool(jobs)
+    try:
+      chunksize = max(1, len(files)//(4*(jobs or multiprocessing.cpu_count())))
+      results = pool.map(check_record_file, files, chunksize=chunksize)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = [check_record_file(job) for job in files]
+  elapsed = time.time() - start
+  failed = collections.Counter()
+  for result in results:
+    for error in result['errors']:
+      location = result['file'] if error['line'] is None else '{}:{}'.format(result['file'],
+                                                                              error['line'])
+      print('{}: {}'.format(location, error['message']))
+    if result['errors']:
+      failed[result['kind']] += 1
+  totals = collections.Counter(result['kind'] for result in results)
+  print('Checked {} request files ({} invalid) and {} redirect records ({} invalid) in {:0.2f}s.'
+        .format(totals['request'], failed['request'], totals['redirect'], failed['redirect'],
+                elapsed))
+  # Rebuild the fingerprint index now too, so the first identification doesn't have to.
+  if totals['redirect']:
+    load_fingerprint_index(redirect_dir)
+  if manifest:
+    data = collections.OrderedDict((('generated', time.time()),
+                                    ('template_version', TEMPLATE_VERSION),
+                                    ('fingerprint_version', FINGERPRINT_VERSION),
+                                    ('files', results)))
+    with open(manifest, 'w') as manifest_file:
+      json.dump(data, manifest_file, indent=2)
+  return sum(failed.values())
+
+
+def check_record_file(job):
+  """Check one file for compile_request_dir(). "job" is a tuple of its kind ("request" or
+  "redirect") and path. Valid request files are compiled and cached. Returns a dict describing the
+  file and listing its errors."""
+  kind, path = job
+  result = collections.OrderedDict((('file', path), ('kind', kind)))
+  errors = []
+  try:
+    if kind == 'request':
+      signature = get_template_signature(path)
+      with open_request_file(path) as request_file:
+        template = compile_request_file(request_file, errors)
+      if not errors:
+        write_template_cache(path, signature, template)
+        result['speculative'] = template['speculative']
+        result['steps'] = [describe_request_step(step) for step in template['steps']]
+    else:
+      with open(path, 'rb') as record:
+        status, headers, body = parse_response_record(record, errors)
+      result['status'] = status
+      fingerprints = get_fingerprints(headers, body)
+      result['fingerprints'] = [list(fingerprint) for fingerprint in fingerprints]
+  except EnvironmentError as error:
+    errors.append(RecordError(str(error)))
+  result['errors'] = [{'line':error.line, 'message':error.message} for error in errors]
+  return result
+
+
+def describe_request_step(step):
+  host = dict(step['headers']).get('Host')
+  return collections.OrderedDict((('method', step['method']),
+                                  ('host', host and format_placeholders(host)),
+                                  ('path', format_placeholders(step['path'])),
+                                  ('extract', [name for name, source, arg in step['extract']]),
+                                  ('follow', step['follow'])))
 
 
 def print_request(headers, method, path, protocol, post_data):
@@ -219,36 +1932,109 @@ def print_request(headers, method, path, protocol, post_data):
     print(post_data)
 
 
-def make_request(headers, method, path, protocol, post_data):
+async def make_request(headers, method, path, protocol, post_data, pool=None, timeout=None,
+                       read_body=False, scheme='http'):
+  """Send a request from a request file. Returns the response and, if "read_body", its body (up to
+  MAX_PROBE_BODY bytes, decoded). Otherwise the body is returned as an empty string.
+  The "timeout" covers the whole request, from connecting to reading the body."""
+  pool = pool or asynchttp.ConnectionPool()
   # Get the host and port from the headers.
   host_value = headers.get('Host')
   assert host_value, '"Host:" header not found.'
-  try:
-    host, port = host_value.split(':')
-    port = int(port)
-  except ValueError:
-    host = host_value
-    port = 80
-  # Edit the headers to remove some of the things which will be auto-filled by httplib.
+  host, port = split_host(host_value, scheme)
+  # Edit the headers to remove some of the things which will be auto-filled by asynchttp.
+  headers = collections.OrderedDict(headers)
   del(headers['Host'])
   if 'Content-Length' in headers:
     del(headers['Content-Length'])
-  #TODO: Maybe make a general http_request() function both this and is_connection_clear() can use.
-  #TODO: Encase in try/except.
-  logging.debug('Making connection to {}:{}..'.format(host, port))
-  connection = httplib.HTTPConnection(host, port)
-  logging.debug('Making request..')
-  # Have encountered a socket.gaierror here.
-  connection.request(method, path, post_data, headers)
-  logging.debug('Getting response..')
+  logging.debug('Making request to {}:{}..'.format(host, port))
   try:
-    connection.getresponse()
+    connection, response = await asynchttp.request(pool, method, scheme, host, port, path,
+                                                   post_data, headers, timeout=timeout)
   except Exception as e:
-    logging.warn('Login unsuccessful. Raised a '+type(e).__name__+' exception.')
+    logging.warning('Login unsuccessful. Raised a '+type(e).__name__+' exception.')
     raise
-  finally:
-    logging.debug('Closing connection..')
-    connection.close()
+  logging.debug('Login response status: {}.'.format(response.status))
+  body = ''
+  if read_body:
+    try:
+      chunks = [chunk async for chunk in read_chunks(response.read, MAX_PROBE_BODY)]
+    except (Exception, asyncio.CancelledError):
+      connection.close()
+      raise
+    body = asynchttp.decode(b''.join(chunks))
+  await pool.release(connection, response)
+  return response, body
+
+
+def split_host(host_value, scheme='http'):
+  """Split a Host header value into the host and port."""
+  try:
+    host, port = host_value.split(':')
+    return host, int(port)
+  except ValueError:
+    return host_value, asynchttp.DEFAULT_PORTS[scheme]
+
+
+class RetrySchedule(object):
+  """Decides how long to wait before retrying a failed HTTP request, and when to give up.
+  Failures to connect usually mean the network isn't ready yet, so they're retried quickly and don't
+  count against the retry limit. Only the deadline stops them. Failures after connecting mean the
+  server is there but not cooperating, so those back off exponentially (with random jitter) and are
+  only retried "retries" times. Nothing is retried past the deadline (a timestamp)."""
+
+  def __init__(self, retries, pause, max_pause, timeout, deadline):
+    self.retries_left = retries
+    self.pause = pause
+    self.max_pause = max_pause
+    self.timeout = timeout
+    self.deadline = deadline
+
+  def get_timeout(self):
+    """The timeout for the next attempt: the usual timeout, unless the deadline is sooner."""
+    return max(CONNECT_RETRY_PAUSE, min(self.timeout, self.deadline - time.time()))
+
+  def get_pause(self, error):
+    """How long to wait before retrying after the given error, or None to give up."""
+    if is_connect_error(error):
+      pause = CONNECT_RETRY_PAUSE
+    else:
+      if self.retries_left <= 0:
+        return None
+      self.retries_left -= 1
+      pause = min(self.max_pause, self.pause * random.uniform(0.5, 1.5))
+      self.pause *= 2
+    if time.time() + pause >= self.deadline:
+      return None
+    return pause
+
+
+async def call_with_retries(function, schedule, description, metrics=None, phase=None):
+  """Await function(timeout) until it succeeds, retrying on network errors as the RetrySchedule
+  says. Returns what the function returns, or re-raises the last error once the schedule gives up.
+  If "metrics" is given, each attempt is timed as a phase named "phase"."""
+  metrics = metrics or Metrics()
+  while True:
+    try:
+      with metrics.phase(phase or description):
+        return await function(schedule.get_timeout())
+    except asynchttp.NETWORK_ERRORS as error:
+      message = '{} failure. Raised a {}: {}'.format(description, type(error).__name__, error)
+      pause = schedule.get_pause(error)
+      if pause is None:
+        logging.warning(message+' Giving up.')
+        raise
+      if is_connect_error(error):
+        logging.debug(message)
+      else:
+        logging.warning(message)
+      logging.debug('Retrying in {:0.2f} seconds..'.format(pause))
+      await asyncio.sleep(pause)
+
+
+def is_connect_error(error):
+  """Whether an exception from an HTTP request means we never reached the server."""
+  return isinstance(error, asynchttp.ConnectError)
 
 
 def normalize_header_name(name):
@@ -260,104 +2046,441 @@ def normalize_header_name(name):
   return '-'.join(normalized_parts)
 
 
-def is_connection_clear(url, expected, timeout=2):
+async def is_connection_clear(url, expected, timeout=2, pool=None, interception=None):
   """Check whether the internet connection is being intercepted by an access point.
   This will make an HTTP request to the given URL and compare the result to the expected one.
   "expected" is a dict with at least two keys: "status" and "body".
   expected['status'] is the expected HTTP response code, as an int.
   expected['body'] is the actual expected response. If it's None, the body won't be checked."""
-  # Parse url.
-  scheme, host, path, query, fragment = urlparse.urlsplit(url)
-  path = path or '/'
-  if query:
-    path += '?'+query
-  # Make connection.
-  if scheme == 'http':
-    connection = httplib.HTTPConnection(host, timeout=timeout)
-  elif scheme == 'https':
-    connection = httplib.HTTPSConnection(host, timeout=timeout)
-  else:
-    raise AssertionError('URL scheme unrecognized: '+url)
   try:
-    connection.connect()
-    connection.request('GET', path)
-    response = connection.getresponse()
-  except socket.error as se:
+    return await test_connection(url, expected, timeout, pool=pool, interception=interception)
+  except OSError as se:
+    # Failures to connect get retried quickly, so don't fill the log with them.
+    log = logging.debug if is_connect_error(se) else logging.warning
     if se.errno == errno.ENETUNREACH:
-      logging.warn('Failed making HTTP connection to test if your connection is blocked. '
-                   'You may not be connected to wifi.')
+      log('Failed making HTTP connection to test if your connection is blocked. '
+          'You may not be connected to wifi.')
     else:
-      logging.warn('Failed making HTTP connection to test if your connection is blocked. '
-                   'Raised a '+type(se).__name__+' exception.')
+      log('Failed making HTTP connection to test if your connection is blocked. '
+          'Raised a '+type(se).__name__+' exception.')
     raise
   except Exception as e:
-    logging.warn('Failed making HTTP connection to test if your connection is blocked. '
-                 'Raised a '+type(e).__name__+' exception.')
+    logging.warning('Failed making HTTP connection to test if your connection is blocked. '
+                    'Raised a '+type(e).__name__+' exception.')
     raise
-  connection.close()
-  # Is the response as expected?
-  # If only an expected status is given (body is None), only that has to match.
-  # If a status and body is given, both have to match. This is a little verbose for clarity.
-  is_expected = False
-  logging.debug('Test URL HTTP response status: {} (expected: {}).'
-                .format(response.status, expected['status']))
-  if response.status == expected['status']:
-    if expected['body'] is None:
-      is_expected = True
-    else:
-      response_body = response.read(len(expected['body']))
-      logging.debug('Test URL response body:\n{}\nexpected:\n{}'
-                    .format(response_body[:100], expected['body'][:100]))
-      if response_body == expected['body']:
+
+
+async def test_connection(url, expected, timeout=2, pool=None, interception=None):
+  """Do the work of is_connection_clear(), without logging failures.
+  If the test is cancelled (like by probe_concurrently()), its connection is closed.
+  If "interception" is an empty dict and the response isn't the expected one, it's filled in with
+  the response's "status", "headers" (a dict with lowercase names), "body" (bytes, or at least
+  the first MAX_FINGERPRINT_BODY of them), and the IP "address" it came from (or None)."""
+  pool = pool or asynchttp.ConnectionPool()
+  scheme, host, port, path = asynchttp.split_url(url)
+  connection, response = await asynchttp.request(pool, 'GET', scheme, host, port, path,
+                                                 timeout=timeout)
+  try:
+    # Is the response as expected?
+    # If only an expected status is given (body is None), only that has to match.
+    # If a status and body is given, both have to match. This is a little verbose for clarity.
+    is_expected = False
+    reader = PrefixRecorder(response.read, MAX_FINGERPRINT_BODY)
+    logging.debug('Test URL HTTP response status: {} (expected: {}).'
+                  .format(response.status, expected['status']))
+    if response.status == expected['status']:
+      if expected['body'] is None:
         is_expected = True
+      else:
+        is_expected = await body_matches(reader.read, expected['body'])
+        logging.debug('Test URL response body:\n{}\nexpected:\n{}'
+                      .format(asynchttp.decode(reader.prefix[:100]), expected['body'][:100]))
+    if not is_expected and interception is not None and not interception:
+      # Claim it before reading the page, so concurrent probes (see probe_concurrently()) can't
+      # fill it in too. If reading the page fails, it keeps what was read so far.
+      peer = connection.writer.get_extra_info('peername')
+      interception.update(status=response.status, body=reader.prefix, address=peer and peer[0],
+                          headers={name.lower():value for name, value in response.headers})
+      interception['body'] = await read_portal_page(response.read, reader.prefix)
+  except (Exception, asyncio.CancelledError):
+    connection.close()
+    raise
+  await pool.release(connection, response)
   return is_expected
 
 
-def substitute_placeholders(string_in):
+async def body_matches(read, expected_body):
+  """Check a response body against the expected one, reading it in chunks with "read" (an async
+  function like Response.read()) and stopping as soon as the answer is known.
+  "expected_body" can be:
+  A literal string the body has to start with.
+  A hash of the whole body, like "sha1:[hex digest]".
+  "re:[regex]", a regular expression which has to match somewhere in a line of the body.
+  Bodies longer than MAX_PROBE_BODY never match a hash or regex."""
+  algorithm, colon, digest = expected_body.partition(':')
+  if colon and algorithm in HASH_ALGORITHMS:
+    hasher = hashlib.new(algorithm)
+    async for chunk in read_chunks(read, MAX_PROBE_BODY+1):
+      hasher.update(chunk)
+    return hasher.hexdigest() == digest.lower()
+  elif expected_body.startswith(REGEX_BODY_PREFIX):
+    regex = re.compile(expected_body[len(REGEX_BODY_PREFIX):])
+    line = b''
+    async for chunk in read_chunks(read, MAX_PROBE_BODY+1):
+      lines = (line+chunk).split(b'\n')
+      line = lines.pop()
+      for complete_line in lines:
+        if regex.search(asynchttp.decode(complete_line)):
+          return True
+    return bool(regex.search(asynchttp.decode(line)))
+  else:
+    expected_bytes = asynchttp.encode(expected_body)
+    offset = 0
+    async for chunk in read_chunks(read, len(expected_bytes)):
+      if chunk != expected_bytes[offset:offset+len(chunk)]:
+        return False
+      offset += len(chunk)
+    return offset == len(expected_bytes)
+
+
+async def read_chunks(read, limit):
+  """Read up to "limit" bytes with "read" (an async function like Response.read()), yielding them
+  in chunks."""
+  remaining = limit
+  while remaining > 0:
+    chunk = await read(min(READ_CHUNK_SIZE, remaining))
+    if not chunk:
+      return
+    remaining -= len(chunk)
+    yield chunk
+
+
+async def read_portal_page(read, body=b''):
+  """Read just enough of a portal page to identify the portal: up to the end of the <head>, which
+  holds any meta refresh tags. If there's no </head>, read the whole page. Either way, stop at
+  MAX_FINGERPRINT_BODY bytes. "body" is any part of the page that's already been read."""
+  end_tag = b'</head>'
+  start = 0
+  while True:
+    end = body[start:].lower().find(end_tag)
+    if end != -1:
+      return body[:start+end+len(end_tag)]
+    if len(body) >= MAX_FINGERPRINT_BODY:
+      return body[:MAX_FINGERPRINT_BODY]
+    chunk = await read(min(READ_CHUNK_SIZE, MAX_FINGERPRINT_BODY-len(body)))
+    if not chunk:
+      return body
+    start = max(0, len(body)-len(end_tag))
+    body += chunk
+
+
+def trim_portal_page(page):
+  """Cut a whole portal page down to the part read_portal_page() would read."""
+  page = page[:MAX_FINGERPRINT_BODY]
+  end = page.lower().find(b'</head>')
+  if end == -1:
+    return page
+  return page[:end+len(b'</head>')]
+
+
+class PrefixRecorder(object):
+  """Wraps an async read() function, remembering the first "limit" bytes read with it."""
+
+  def __init__(self, read, limit):
+    self._read = read
+    self.limit = limit
+    self.prefix = b''
+
+  async def read(self, size):
+    chunk = await self._read(size)
+    if len(self.prefix) < self.limit:
+      self.prefix += chunk[:self.limit-len(self.prefix)]
+    return chunk
+
+
+async def probe_concurrently(probes, quorum, timeout=2, pool=None, interception=None):
+  """Test the connection with several probes at once, deciding as soon as "quorum" of them agree.
+  "probes" is a list of dicts like the "expected" dict of is_connection_clear(), plus a "url" key.
+  Returns True if the connection looks clear. Probes still running once the result is decided are
+  cancelled, closing their connections. If no probe got a response, the exception raised by the
+  last one is re-raised.
+  "interception" is filled in by the first probe to be intercepted (see test_connection())."""
+  quorum = min(quorum, len(probes))
+  pool = pool or asynchttp.ConnectionPool()
+  tasks = [asyncio.ensure_future(run_probe(probe, timeout, pool, interception))
+           for probe in probes]
+  votes = {True:0, False:0}
+  exception = None
+  try:
+    for result in asyncio.as_completed(tasks):
+      url, clear, elapsed, exception_raised = await result
+      if exception_raised:
+        exception = exception_raised
+        logging.debug('Probe {} failed after {:0.3f}s. Raised a {}: {}'
+                      .format(url, elapsed, type(exception).__name__, exception))
+        continue
+      logging.debug('Probe {} says the connection is {} ({:0.3f}s).'
+                    .format(url, 'clear' if clear else 'intercepted', elapsed))
+      votes[clear] += 1
+      if votes[clear] >= quorum:
+        logging.info('{} of {} probes agree the connection is {}.'
+                     .format(votes[clear], len(probes), 'clear' if clear else 'intercepted'))
+        return clear
+  finally:
+    for task in tasks:
+      task.cancel()
+    # Let the cancelled probes close their connections before moving on.
+    await asyncio.gather(*tasks, return_exceptions=True)
+  if votes[True] or votes[False]:
+    logging.info('No quorum of probes agreed. Results: {} clear, {} intercepted.'
+                 .format(votes[True], votes[False]))
+    return votes[True] > votes[False]
+  raise exception
+
+
+async def run_probe(probe, timeout, pool, interception):
+  """Run test_connection() for probe_concurrently(). Returns a tuple of the result:
+  (url, clear, seconds elapsed, exception raised). Only network errors count as a failed probe.
+  Anything else (including being cancelled) is raised."""
+  start = time.time()
+  try:
+    clear = await test_connection(probe['url'], probe, timeout=timeout, pool=pool,
+                                  interception=interception)
+  except asynchttp.NETWORK_ERRORS as exception:
+    return (probe['url'], None, time.time()-start, exception)
+  return (probe['url'], clear, time.time()-start, None)
+
+
+def substitute_placeholders(string_in, sysinfo=None):
   """Parse a string containing ${placeholders}, substituting in their computed values."""
+  return render_placeholders(compile_placeholders(string_in), sysinfo or SystemInfo())
+
+
+def compile_placeholders(string_in):
+  """Break a string containing ${placeholders} into a list of operations for
+  render_placeholders(): literal strings, and (name, filters) tuples for the placeholders, where
+  "filters" is a tuple of the names of the PLACEHOLDER_FILTERS to apply to the value, in order,
+  like ${mac|upper|urlencode}. Aliases (PLACEHOLDER_ALIASES) are resolved here. An unknown filter
+  raises a ValueError. Empty literals are left out, so a string without placeholders compiles to
+  at most one literal."""
   # For fun, let's try implementing without examining every character in Python.
   # Instead, use str.split() to break the string into pieces around the placeholders.
   # - str.split() is in C: https://github.com/python/cpython/blob/master/Objects/stringlib/split.h
   # First, split on the starting pattern "${".
   chunks = string_in.split('${')
-  string_out = ''
-  for i, chunk in enumerate(chunks):
-    # Output the first chunk unaltered. This is the part of the string before the first "${".
-    if i == 0:
-      string_out += chunk
-      continue
+  # Output the first chunk unaltered. This is the part of the string before the first "${".
+  literal = chunks[0]
+  compiled = []
+  for chunk in chunks[1:]:
     bits = chunk.split('}')
     # No matching ending "}". Re-construct the original string.
     if len(bits) <= 1:
-      string_out += '${'+'}'.join(bits)
+      literal += '${'+'}'.join(bits)
       continue
-    placeholder = bits[0]
-    string_out += get_substitution(placeholder)
+    if literal:
+      compiled.append(literal)
+    compiled.append(compile_slot(bits[0]))
     # Output the parts after the "}". If there is more than one, it means there's unmatched "}"s.
     # Output those literally, without removing the "}"s.
-    string_out += '}'.join(bits[1:])
-  return string_out
+    literal = '}'.join(bits[1:])
+  if literal:
+    compiled.append(literal)
+  return compiled
+
 
+def compile_slot(placeholder):
+  """Parse what's between the braces of a placeholder, like "mac|upper", into a (name, filters)
+  tuple (see compile_placeholders())."""
+  fields = placeholder.split('|')
+  name = fields[0].strip()
+  filters = tuple(field.strip() for field in fields[1:])
+  for filter_name in filters:
+    if filter_name not in PLACEHOLDER_FILTERS:
+      raise ValueError('Unknown filter "{}" in placeholder ${{{}}} (should be one of {}).'
+                       .format(filter_name, placeholder, ', '.join(sorted(PLACEHOLDER_FILTERS))))
+  if name in PLACEHOLDER_ALIASES:
+    name, alias_filters = PLACEHOLDER_ALIASES[name]
+    filters = alias_filters + filters
+  return name, filters
 
-def get_substitution(placeholder):
-  #TODO: Way to generically request upper or lower case.
-  #TODO: 'host': The host name the request is being sent to.
-  #TODO: 'wifiip': The IP address of the router.
+
+def format_placeholders(compiled):
+  """Turn a string compiled by compile_placeholders() back into a string (aliases come back as what
+  they stand for, like ${mac|upper} for ${MAC})."""
+  return ''.join(op if isinstance(op, str) else '${'+'|'.join((op[0],)+op[1])+'}'
+                 for op in compiled)
+
+
+def render_placeholders(compiled, sysinfo, values=None, context=None):
+  """Fill in the placeholders in a string compiled by compile_placeholders().
+  Placeholders named in the "values" dict are filled in from it instead of the SystemInfo, and
+  then ones named in the "context" dict (see render_request())."""
+  if len(compiled) == 1 and compiled[0].__class__ is str:
+    return compiled[0]
+  parts = []
+  for op in compiled:
+    if op.__class__ is str:
+      parts.append(op)
+      continue
+    name, filters = op
+    if values and name in values:
+      value = values[name]
+    elif context and name in context:
+      value = context[name]
+    else:
+      value = get_substitution(name, sysinfo)
+      if value is None:
+        logging.warning('No value found for placeholder "{}".'.format(name))
+        value = ''
+    for filter_name in filters:
+      value = PLACEHOLDER_FILTERS[filter_name](value)
+    parts.append(value)
+  return ''.join(parts)
+
+
+def get_substitution(placeholder, sysinfo):
+  """Get the value of a placeholder from the system. Returns None if it's known but has no value,
+  and an empty string (with a warning) if it's unknown. "host" only has a value in a request (see
+  render_request())."""
   if placeholder == 'mac':
-    return maclib.get_mac().string
-  elif placeholder == 'MAC':
-    return maclib.get_mac().string.upper()
+    return sysinfo.mac
   elif placeholder == 'ip':
-    return ipwraplib.get_ip()
+    return sysinfo.ip
   elif placeholder == 'ssid':
-    return ipwraplib.get_wifi_info()[1]
+    return sysinfo.ssid
   elif placeholder == 'wifimac':
-    return ipwraplib.get_wifi_info()[2]
+    return sysinfo.wifimac
+  elif placeholder == 'gateway':
+    return sysinfo.gateway
+  elif placeholder == 'timestamp':
+    return str(int(time.time()))
+  elif placeholder == 'nonce':
+    return make_nonce()
+  elif placeholder == 'host':
+    return None
   else:
-    logging.warn('Unrecognized placeholder "{}".'.format(placeholder))
+    logging.warning('Unrecognized placeholder "{}".'.format(placeholder))
     return ''
 
 
+def make_nonce():
+  return os.urandom(NONCE_BYTES).hex()
+
+
+class SystemInfo(object):
+  """The information about this system and its connection that the script needs, like the SSID and
+  our MAC address. Each value is looked up the first time it's asked for, then remembered for the
+  rest of the run. Looking them up can mean running external commands, so this saves time when the
+  same value is needed in several places, and skips lookups for values never used.
+  The "backend" determines how values are looked up: "native" uses the netinfo module to ask the
+  kernel directly, "tools" uses the lib submodule, and "auto" tries native, then tools.
+  If an "interface" is given, everything is looked up for that interface. Otherwise, it's the first
+  connected wifi interface. The tools can't be told which interface to use, so they're only used for
+  a given interface when they report on that same one."""
+
+  def __init__(self, backend='auto', interface=None):
+    self.backend = backend
+    self._interface = interface
+    self._values = {}
+
+  def _lookup(self, name, native_function, tools_function):
+    try:
+      return self._values[name]
+    except KeyError:
+      pass
+    start = time.time()
+    value = None
+    backend = self.backend
+    if backend in ('auto', 'native'):
+      try:
+        value = native_function()
+        backend = 'native'
+      except netinfo.NetinfoError as error:
+        if backend == 'native':
+          raise
+        logging.debug('Native {} lookup failed: {}'.format(name, error))
+    if backend in ('auto', 'tools'):
+      value = tools_function()
+      backend = 'tools'
+    self._values[name] = value
+    logging.debug('Looked up {} with {} backend in {:0.3f}s.'
+                  .format(name, backend, time.time()-start))
+    return value
+
+  @property
+  def wifi_info(self):
+    """A tuple of (interface, SSID, access point MAC), like ipwraplib.get_wifi_info() returns."""
+    if self._interface:
+      return self._lookup('wifi info', lambda: netinfo.get_wifi_info(self._interface),
+                          self._get_tools_wifi_info)
+    return self._lookup('wifi info', netinfo.get_wifi_info, ipwraplib.get_wifi_info)
+
+  @property
+  def interface(self):
+    return self.wifi_info[0]
+
+  @property
+  def ssid(self):
+    return self.wifi_info[1]
+
+  @property
+  def wifimac(self):
+    return self.wifi_info[2]
+
+  @property
+  def mac(self):
+    return self._lookup('MAC address', lambda: netinfo.get_mac(self._get_interface()),
+                        self._for_tools_interface(lambda: maclib.get_mac().string))
+
+  @property
+  def ip(self):
+    return self._lookup('IP address', lambda: netinfo.get_ip(self._get_interface()),
+                        self._for_tools_interface(ipwraplib.get_ip))
+
+  @property
+  def gateway(self):
+    """The IP address of the default gateway, or None if there's none (or the default route is
+    on-link). The tools can't find it, but it only takes reading /proc, so it's always looked up
+    natively."""
+    return self._lookup('gateway', self._get_gateway, self._get_tools_gateway)
+
+  def _get_tools_wifi_info(self):
+    wifi_info = ipwraplib.get_wifi_info()
+    if wifi_info[0] != self._interface:
+      raise netinfo.NetinfoError('The tools report on {}, not {}.'
+                                 .format(wifi_info[0], self._interface))
+    return wifi_info
+
+  def _for_tools_interface(self, tools_function):
+    """Wrap a tools lookup so that, for a given interface, it fails unless the tools report on
+    that interface."""
+    if not self._interface:
+      return tools_function
+    def lookup():
+      self._get_tools_wifi_info()
+      return tools_function()
+    return lookup
+
+  def _get_gateway(self):
+    gateway = netinfo.get_default_gateway(self._get_interface())
+    if gateway == '0.0.0.0':
+      return None
+    return gateway
+
+  def _get_tools_gateway(self):
+    """The fallback for _get_gateway(): None if it fails, instead of an exception."""
+    try:
+      return self._get_gateway()
+    except netinfo.NetinfoError as error:
+      logging.debug('Could not find the default gateway: {}'.format(error))
+      return None
+
+  def _get_interface(self):
+    if not self.interface:
+      raise netinfo.NetinfoError('No wifi interface found.')
+    return self.interface
+
+
 def tone_down_logger():
   """Change the logging level names from all-caps to capitalized lowercase.
   E.g. "WARNING" -> "Warning" (turn down the volume a bit in your log files)"""